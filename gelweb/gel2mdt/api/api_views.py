@@ -25,7 +25,6 @@ from gel2mdt.api.serializers import *
 from django.http import Http404
 from django.db.models import Prefetch
 
-import pandas as pd
 
 from rest_framework.renderers import JSONRenderer
 from rest_framework.parsers import JSONParser
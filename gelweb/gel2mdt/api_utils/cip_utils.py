@@ -19,7 +19,9 @@ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
+from concurrent.futures import ThreadPoolExecutor
 from .poll_api import PollAPI
+from ..config import load_config
 
 
 class InterpretationList(object):
@@ -27,60 +29,78 @@ class InterpretationList(object):
     Represents the interpretation list from GeL CIP-API. Can be used to return
     a list of case numbers by status along with the hash of the current case
     data.
+
+    The first page of the list gives the total number of cases, from which
+    the remaining pages are fetched concurrently. When a single sample is
+    requested the list is filtered by the CIP-API, so only that sample's
+    cases are fetched.
+
+    Attributes:
+        sample_type (str): raredisease or cancer.
+        sample (str): optional GeL participant ID of a single proband.
+        page_size (int): cases per page, from the cip_api_page_size config
+            option. If not set, the CIP-API default is used.
+        workers (int): pages fetched at once, from the cip_api_workers
+            config option.
     """
-    def __init__(self, sample_type, sample=None):
+    def __init__(self, sample_type, sample=None, page_size=None, workers=None):
+        config_dict = load_config.LoadConfig().load()
         self.sample_type = sample_type
         self.sample = sample
+        self.page_size = page_size or config_dict.get_int('cip_api_page_size')
+        self.workers = max(workers or config_dict.get_int('cip_api_workers', 1), 1)
         self.all_cases = self.get_all_cases()
         self.cases_to_poll = self.get_poll_cases()
         self.blocked_cases = self.get_blocked_cases()
 
-    def get_all_cases(self):
+    def get_page(self, page):
         """
-        Invokes PollAPI to retrieve a list of all the cases available to a
-        given user.
+        Invokes PollAPI to retrieve one page of the list of cases.
         """
-        all_cases = []
-        last_page = False
-        page = 1
-        while not last_page:
-            request_list_poll = PollAPI(
-                "cip_api",
-                "interpretation-request?page={page}&category=100k".format(page=page)
-            )
-            request_list_poll.get_json_response()
-            request_list_results = request_list_poll.response_json["results"]
-
-            if self.sample:
-                all_cases += [{
-                    # add the ir_id, sample type, and latest status to dict
-                    "interpretation_request_id":
-                        result["interpretation_request_id"],
-                    "sample_type":
-                        result["sample_type"],
-                    "last_status":
-                        result["last_status"]}
-                    for result in request_list_results
-                    if result["sample_type"] == self.sample_type
-                    and result['proband'] == self.sample]
-            else:
-                all_cases += [{
-                    # add the ir_id, sample type, and latest status to dict
-                    "interpretation_request_id":
-                        result["interpretation_request_id"],
-                    "sample_type":
-                        result["sample_type"],
-                    "last_status":
-                        result["last_status"]}
-                    for result in request_list_results
-                    if result["sample_type"] == self.sample_type]
+        endpoint = "interpretation-request?page={page}&category=100k".format(page=page)
+        if self.page_size:
+            endpoint += "&page_size={page_size}".format(page_size=self.page_size)
+        if self.sample:
+            # filter server side to the families the sample is a member of
+            endpoint += "&members={sample}".format(sample=self.sample)
+        request_list_poll = PollAPI("cip_api", endpoint)
+        return request_list_poll.get_json_response()
 
-            if request_list_poll.response_json["next"]:
-                page += 1
-            else:
-                last_page = True
+    def get_all_cases(self):
+        """
+        Retrieve a list of all the cases available to a given user. The page
+        count is worked out from the first page, and the remaining pages are
+        fetched concurrently then kept in order.
+        """
+        first_page = self.get_page(1)
+        self.all_cases_count = first_page["count"]
+        pages = [first_page]
+        if first_page["next"] and first_page["results"]:
+            page_count = -(-self.all_cases_count // len(first_page["results"]))
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                pages += list(executor.map(self.get_page, range(2, page_count + 1)))
+            # cases added since the first page was fetched may spill over
+            while pages[-1]["next"]:
+                pages.append(self.get_page(len(pages) + 1))
 
-        self.all_cases_count = request_list_poll.response_json["count"]
+        all_cases = []
+        for request_list in pages:
+            all_cases += [{
+                # add the ir_id, sample type, latest status and
+                # modification time to dict
+                "interpretation_request_id":
+                    result["interpretation_request_id"],
+                "sample_type":
+                    result["sample_type"],
+                "last_status":
+                    result["last_status"],
+                "last_modified":
+                    result.get("last_modified")}
+                for result in request_list["results"]
+                if result["sample_type"] == self.sample_type
+                # the members filter also matches relatives, so keep only
+                # the sample's own cases
+                and (not self.sample or result['proband'] == self.sample)]
         return all_cases
 
     def get_poll_cases(self):
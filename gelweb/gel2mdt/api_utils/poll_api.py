@@ -20,15 +20,106 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 import os
+import sys
 import getpass
 import requests
 import json
 import time
+import threading
 import jwt
 import labkey as lk
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from ..config import load_config
 
 
+# response codes which are usually transient, so are retried with backoff
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_shared_session = None
+_shared_session_pid = None
+_shared_session_lock = threading.Lock()
+
+
+def get_shared_session():
+    """
+    Return the requests.Session shared by every PollAPI in this process.
+
+    The session keeps a pool of keep-alive connections to each host, so that
+    repeated polls of an API reuse one TLS connection, and asks for gzipped
+    responses. Connection errors and transient error codes are retried by
+    its adapter with exponential backoff, up to http_max_retries times.
+    Connections do not survive a fork, so a forked process (e.g. a Celery
+    worker) builds its own session on first use.
+    """
+    global _shared_session, _shared_session_pid
+    with _shared_session_lock:
+        if _shared_session is None or _shared_session_pid != os.getpid():
+            config = load_config.LoadConfig().load()
+            pool_size = config.get_int('http_pool_size', 20)
+            retries = Retry(
+                total=config.get_int('http_max_retries', 5),
+                backoff_factor=config.get_float('http_backoff', 1),
+                status_forcelist=RETRY_STATUSES,
+                raise_on_status=False)
+            adapter = HTTPAdapter(
+                pool_connections=pool_size, pool_maxsize=pool_size,
+                max_retries=retries)
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers["Accept-Encoding"] = "gzip, deflate"
+            _shared_session = session
+            _shared_session_pid = os.getpid()
+        return _shared_session
+
+
+class TokenCache(object):
+    """
+    Process-wide cache of CIP-API tokens, so that every PollAPI in a process
+    uses the same token and a new one is only requested once the cached
+    token is within refresh_margin seconds of expiry.
+
+    Attributes:
+        tokens (dict): k-v pairing of token source (the token URL, or Active
+            Directory) and a tuple of the token and its decoded payload.
+        refresh_margin (int): seconds before expiry at which a token is
+            refreshed.
+    """
+    refresh_margin = 60
+
+    def __init__(self):
+        self.tokens = {}
+        self.lock = threading.Lock()
+
+    def get_token(self, source, fetch_token):
+        """
+        Return the cached (token, decoded token) for source, calling
+        fetch_token() to get a new token if there is none or it is about to
+        expire. Threads wait for a refresh in progress rather than starting
+        their own.
+        """
+        with self.lock:
+            token, decoded = self.tokens.get(source, (None, None))
+            if token is None or time.time() > (decoded['exp'] - self.refresh_margin):
+                token = fetch_token()
+                decoded = jwt.decode(token, verify=False)
+                self.tokens[source] = (token, decoded)
+            return token, decoded
+
+    def invalidate(self, source, token):
+        """
+        Drop a token which has been rejected, unless another thread has
+        already replaced it.
+        """
+        with self.lock:
+            if self.tokens.get(source, (None, None))[0] == token:
+                del self.tokens[source]
+
+
+TOKEN_CACHE = TokenCache()
+
+
 class PollAPI(object):
     """
     Object entity representing a polling of an API.
@@ -66,9 +157,19 @@ class PollAPI(object):
             get_auth_headers()
         response_json (dict): the JSON response (as a dict) that returns from
             the polled API.
+        response_content (bytes): the raw body of the response which
+            response_json was decoded from.
         response_status (int): the HTTP response code received from the API
             response. Should be 200, but can be validated to check for aberrant
             codes such as 40x and 50x.
+        session (requests.Session): the session to poll with. If None, the
+            process-wide session from get_shared_session() is used.
+        max_attempts (int): the number of times a request is attempted if the
+            response is not valid JSON or the token is rejected, from the
+            http_max_retries config option.
+        backoff (float): seconds to wait before the first retry, doubling
+            with each further attempt. From the http_backoff config option.
+        timeout (int): seconds to wait for the server to respond.
 
     TODO:
         Refactor get_auth_headers() into cip_utils package, since this is
@@ -76,7 +177,7 @@ class PollAPI(object):
             but will cause issues in case we introduce another API which
             requires authentication.
     """
-    def __init__(self, api, endpoint):
+    def __init__(self, api, endpoint, session=None):
         """
         Initialises a PollAPI instance with an api and endpoint.
 
@@ -87,7 +188,7 @@ class PollAPI(object):
         self.config = load_config.LoadConfig().load()
         self.api = api
         self.endpoint = endpoint
-        if self.config['beta_testing'] == "True":
+        if self.config.get_bool('beta_testing'):
             cip_api_url = "https://cipapi-gms-beta.genomicsengland.nhs.uk/api/2/{endpoint}"
         else:
             cip_api_url = "https://cipapi.genomicsengland.nhs.uk/api/2/{endpoint}"
@@ -120,89 +221,71 @@ class PollAPI(object):
         self.token_url = None
         self.response_json = None  # set upon calling get_json_response()
         self.response_status = None
+        self.response_content = None  # raw bytes the response_json came from
 
         self.cipapi_token = None
         self.cipapi_token_decoded = None
 
+        self.session = session
+        self.token_source = None
+        self.max_attempts = max(self.config.get_int('http_max_retries', 5), 1)
+        self.backoff = self.config.get_float('http_backoff', 1)
+        self.timeout = 300
+
     def get_json_response(self, content=False):
         """
-        Creates a request session which polls the desired API for JSON.
-
-        Request will be tried 20 times (MAX_RETRIES) in the case of failure to
-        fetch a proper JSON. This covers connection/retrieval failures, but not
-        improper JSON objects which return despite a 200 code. This is instead
-        covered by a bool json_poll_sucess. At the end of each response, the
-        json library is used to attempt to decode the JSON into a dict. Upon a
-        failure, json_poll_sucess remains false and another request Session is
-        attempted.
+        Polls the desired API for JSON using the shared session.
+
+        Connection failures and transient error codes are retried by the
+        session's adapter. On top of that, the request is attempted up to
+        max_attempts times, with exponential backoff, if the response can not
+        be decoded as JSON or the CIP-API rejects the token. After the last
+        attempt the error is raised. Any other error code is raised as a
+        requests.HTTPError, unless content is set, in which case the body is
+        returned for the caller to inspect.
         """
-        json_poll_success = False
-        while not json_poll_success:
-            MAX_RETRIES = 20
-            session = requests.Session()
-            adapter = requests.adapters.HTTPAdapter(max_retries=MAX_RETRIES)
-            session.mount("https://", adapter)
-
-            # IF/ELIF/ELSE tree used to check several conditions. If headers
-            # are required (self.headers_required) and they have not yet been
-            # set (self.headers = None), then we must set the self.headers
-            # value. In the case of CIP-API, we need to fetch auth headers
-            # (first if statement), which is handled by the class method
-            # get_auth_headers(). If not, then standard headers can be set
-            # using get_headers() method instead. If headers are required and
-            # they HAVE been set, we can now use a GET method via the request
-            # Session to fetch the JSON API response, passing in the
-            # server/endpoint and the set headers. Finally, if headers are not
-            # required, we can call the GET response immediately without
-            # setting headers first.
+        session = self.session if self.session is not None else get_shared_session()
+        attempt = 0
+        while True:
+            attempt += 1
+            # If headers are required they must be set before polling. In
+            # the case of CIP-API we need auth headers, which are fetched on
+            # every attempt since get_auth_headers() refreshes the token if
+            # it has expired. Other APIs only need standard headers.
             if (self.headers_required) and (self.api.startswith('cip_api')):
-                # get auth headers, do this every time, if token is already set method will check if it's expired
-                # and refresh if necessary
                 self.get_auth_headers()
-            elif (self.headers_required) and (self.headers is None) and (self.api == 'genenames'):
-                self.get_headers()
-            elif (self.headers_required) and (self.headers is None) and (self.api == 'ensembl'):
+            elif (self.headers_required) and (self.headers is None):
                 self.get_headers()
-            if (self.headers_required) and (self.headers is not None):
-                # headers required; have been set
+
+            try:
                 response = session.get(
                     url=self.url,
-                    headers=self.headers)
-            elif not self.headers_required:
-                # no headers required
-                response = session.get(
-                    url=self.url)
+                    headers=self.headers if self.headers_required else None,
+                    timeout=self.timeout)
+                if response.status_code == 401 and self.api.startswith('cip_api'):
+                    # token revoked or expired early - fetch a new one
+                    self.invalidate_token()
+                    raise requests.HTTPError(
+                        "CIP-API rejected token for {}".format(self.url), response=response)
+                if not content and response.ok:
+                    response_json = response.json()
+            except (requests.RequestException, ValueError) as e:
+                if attempt >= self.max_attempts:
+                    raise
+                delay = min(self.backoff * 2 ** (attempt - 1), 60)
+                print("Polling {} failed ({}), retrying in {}s".format(self.url, e, delay))
+                time.sleep(delay)
+                continue
 
             if content:
                 return response.content  # return the content, which is a JSON
-            else:
-                # The response may not have a content section, particularly in
-                # the case of errors. In this case, the whole response can be
-                # treated as a JSON, and will contain error information. We can
-                # extract this for debugging purposes - if it is decodable.
-                try:
-                    self.response_json = response.json()
-                    self.response_status = response.status_code
-                    json_poll_success = True
-                except json.JSONDecodeError as e:
-                    continue
-
-                return response.json()
-
-    def token_expired(self):
-        """
-        If a cipapi JWT token is set, this method will check it's expiry time.
-
-        If the token is expired, or within 60 seconds of expiry, the method will return True
-
-        Returns:
-            Boolean
-        """
-        if self.cipapi_token:
-            # Check if it's expired or within 60 seconds of expiry
-            if time.time() > (self.cipapi_token_decoded['exp'] - 60):
-                return True
-            return False
+            # transient error codes have already been retried by the
+            # session's adapter, so any error left is final
+            response.raise_for_status()
+            self.response_json = response_json
+            self.response_status = response.status_code
+            self.response_content = response.content
+            return self.response_json
 
     def get_auth_headers(self):
         """
@@ -210,7 +293,9 @@ class PollAPI(object):
 
         Token is created based on CIP-API username and password, which should
         be environment variables; class method get_credentials() ensures this.
-        Once executed, headers will be set as a class instance attribute.
+        Tokens are held in the process-wide TOKEN_CACHE, so a new token is only
+        requested when the cached one is close to expiry. Once executed,
+        headers will be set as a class instance attribute.
 
         Args:
             None
@@ -225,35 +310,57 @@ class PollAPI(object):
 
         self.token_url = self.server.format(endpoint=token_endpoint)
         self.get_credentials()
-        # If self.headers not set, or token has expired, fetch a new token and set header
-        if not self.headers or self.token_expired():
-            if self.config['use_active_directory'] == "True":
-                token_response = requests.post(
-                    url="https://login.microsoftonline.com/{tenant_id}/oauth2/token".format(
-                        tenant_id=os.environ["tenant_id"]),
-                    data="grant_type=client_credentials",
-                    headers={'Content-Type': "application/x-www-form-urlencoded",},
-                    auth=(os.environ["client_id"], os.environ["client_secret"])
-                )
-                token_json = token_response.json()
-                self.cipapi_token = token_json.get("access_token")
-                self.cipapi_token_decoded = jwt.decode(self.cipapi_token, verify=False)
-            else:
-                token_response = requests.post(
-                    url=self.token_url,
-                    json=dict(
-                        username=os.environ["cip_api_username"],
-                        password=os.environ["cip_api_password"]
-                    ),
-                )
-                token_json = token_response.json()
-                self.cipapi_token = token_json.get("token")
-                self.cipapi_token_decoded = jwt.decode(self.cipapi_token, verify=False)
-
-            self.headers = {
-                "Accept": "application/json",
-                "Authorization": "JWT {token}".format(
-                    token=self.cipapi_token)}
+        # every PollAPI in the process shares one token per source, which is
+        # only fetched again once it is close to expiry
+        if self.config.get_bool('use_active_directory'):
+            self.token_source = "active_directory"
+            fetch_token = self.fetch_active_directory_token
+        else:
+            self.token_source = self.token_url
+            fetch_token = self.fetch_cip_api_token
+        self.cipapi_token, self.cipapi_token_decoded = TOKEN_CACHE.get_token(
+            self.token_source, fetch_token)
+        self.headers = {
+            "Accept": "application/json",
+            "Authorization": "JWT {token}".format(
+                token=self.cipapi_token)}
+
+    def fetch_active_directory_token(self):
+        """
+        Request a new CIP-API token from Active Directory.
+        """
+        token_response = get_shared_session().post(
+            url="https://login.microsoftonline.com/{tenant_id}/oauth2/token".format(
+                tenant_id=os.environ["tenant_id"]),
+            data="grant_type=client_credentials",
+            headers={'Content-Type': "application/x-www-form-urlencoded",},
+            auth=(os.environ["client_id"], os.environ["client_secret"]),
+            timeout=self.timeout
+        )
+        return token_response.json().get("access_token")
+
+    def fetch_cip_api_token(self):
+        """
+        Request a new token from the CIP-API.
+        """
+        token_response = get_shared_session().post(
+            url=self.token_url,
+            json=dict(
+                username=os.environ["cip_api_username"],
+                password=os.environ["cip_api_password"]
+            ),
+            timeout=self.timeout
+        )
+        return token_response.json().get("token")
+
+    def invalidate_token(self):
+        """
+        Drop the current token from the cache so the next attempt fetches a
+        new one.
+        """
+        if self.token_source is not None:
+            TOKEN_CACHE.invalidate(self.token_source, self.cipapi_token)
+        self.headers = None
 
     def get_headers(self):
         """
@@ -273,31 +380,53 @@ class PollAPI(object):
 
     def get_credentials(self):
         """
-        Sets AD/CIP-API credentials as environment variables if not already set.
+        Check that the AD/CIP-API credentials are set as environment
+        variables, prompting for them if not. See get_credentials().
+        """
+        get_credentials(self.config)
 
-        Will look for AD/CIP-API credentials in the execution shell's environment,
-        typically set up in gel2mdt/DAILY_UPDATE.sh for automation. If not set,
-        then the execution shell will prompt for a username and hidden password
-        to be set as enviroment fields, which will then be destroyed once the
-        execution shell terminates. Because this is interacting with the shell
-        environment, nothing needs to be returned
 
-        Args:
-            None
+def get_credentials(config=None):
+    """
+    Sets AD/CIP-API credentials as environment variables if not already set.
 
-        Returns:
-            None
-        """
-        if self.config['use_active_directory'] == "True":
-            try:
-                user = os.environ["tenant_id"]
-            except KeyError as e:
-                os.environ["tenant_id"] = input("Enter Tenant ID: ")
-                os.environ["client_id"] = input("Enter Client ID: ")
-                os.environ["client_secret"] = getpass.getpass("Enter Client Secret: ")
-        else:
-            try:
-                user = os.environ["cip_api_username"]
-            except KeyError as e:
-                os.environ["cip_api_username"] = input("Enter username: ")
-                os.environ["cip_api_password"] = getpass.getpass("Enter password: ")
\ No newline at end of file
+    Will look for AD/CIP-API credentials in the execution shell's environment,
+    typically set up in gel2mdt/DAILY_UPDATE.sh for automation. If not set,
+    then the execution shell will prompt for a username and hidden password
+    to be set as enviroment fields, which will then be destroyed once the
+    execution shell terminates. Because this is interacting with the shell
+    environment, nothing needs to be returned.
+
+    Only the main thread of a process attached to a terminal can prompt, so
+    call this before starting any worker threads. Elsewhere, such as in a
+    worker thread or a cron job, missing credentials raise a ValueError.
+
+    Args:
+        config (Config): the loaded config. Loaded if not given.
+
+    Returns:
+        None
+    """
+    if config is None:
+        config = load_config.LoadConfig().load()
+    if config.get_bool('use_active_directory'):
+        names = ("tenant_id", "client_id", "client_secret")
+    else:
+        names = ("cip_api_username", "cip_api_password")
+    if all(name in os.environ for name in names):
+        return
+
+    can_prompt = (
+        threading.current_thread() is threading.main_thread()
+        and sys.stdin is not None and sys.stdin.isatty())
+    if not can_prompt:
+        raise ValueError(
+            "CIP-API credentials are not set. Set {} in the environment "
+            "before running an update.".format(", ".join(names)))
+    if config.get_bool('use_active_directory'):
+        os.environ["tenant_id"] = input("Enter Tenant ID: ")
+        os.environ["client_id"] = input("Enter Client ID: ")
+        os.environ["client_secret"] = getpass.getpass("Enter Client Secret: ")
+    else:
+        os.environ["cip_api_username"] = input("Enter username: ")
+        os.environ["cip_api_password"] = getpass.getpass("Enter password: ")
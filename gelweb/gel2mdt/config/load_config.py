@@ -20,27 +20,74 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 import os
-import inspect
+import threading
+
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.txt")
+
+
+class Config(dict):
+    """
+    The options in config.txt. Values are kept as the strings written in
+    the file, so the config can be used as a dict as before, and the typed
+    accessors convert them.
+    """
+    def get_bool(self, key, default=False):
+        """
+        Return True if the option is set to True, False if it is set to
+        anything else, or default if it is not set.
+        """
+        value = self.get(key)
+        if value is None or value == '':
+            return default
+        return value.strip() == 'True'
+
+    def get_int(self, key, default=None):
+        value = self.get(key)
+        if value is None or value == '':
+            return default
+        return int(value)
+
+    def get_float(self, key, default=None):
+        value = self.get(key)
+        if value is None or value == '':
+            return default
+        return float(value)
 
 
 class LoadConfig():
     """
      Representation of an instance when loading the config file
+
+     The parsed config is shared by the whole process, and config.txt is
+     only read again once its modification time or size changes, so load()
+     can be called as often as needed. The returned Config is shared, so
+     must not be modified.
     """
+    _config = None
+    _stat = None
+    _lock = threading.Lock()
+
     def load(self):
         """
         Loads config data from config.txt
-        :return: dict containing key:configuration option value:configuration value
+        :return: Config, a dict containing key:configuration option value:configuration value
+        """
+        stat = os.stat(CONFIG_PATH)
+        stat = (stat.st_mtime_ns, stat.st_size)
+        with LoadConfig._lock:
+            if LoadConfig._config is None or LoadConfig._stat != stat:
+                LoadConfig._config = self.read(CONFIG_PATH)
+                LoadConfig._stat = stat
+            return LoadConfig._config
+
+    @staticmethod
+    def read(path):
+        """
+        Parse a config file into a Config.
         """
-        config_dict = {}
-        with open(
-            os.path.join(
-                os.path.dirname(
-                    os.path.abspath(
-                        inspect.stack()[0][1]
-                    )
-                ),
-                "config.txt"), 'r') as config_file:
+        config_dict = Config()
+        with open(path, 'r') as config_file:
             for line in config_file:
                 if not line.startswith('#'):
                     line = line.strip().split('=', 1)
@@ -37,6 +37,113 @@ from tqdm import tqdm
 from protocols.reports_6_0_0 import InterpretedGenome, InterpretationRequestRD, CancerInterpretationRequest, ClinicalReport
 
 
+def iter_sorted_json(value, depth=5):
+    """
+    Yield the output of json.dumps(value, sort_keys=True) in pieces.
+    Containers down to the given depth are written piece by piece and anything
+    deeper is dumped whole by the json encoder, so for a case json no piece is
+    much larger than a single variant.
+    """
+    if depth and isinstance(value, dict) and value:
+        separator = '{'
+        for key in sorted(value):
+            yield separator + json.dumps(key) + ': '
+            yield from iter_sorted_json(value[key], depth - 1)
+            separator = ', '
+        yield '}'
+    elif depth and isinstance(value, list) and value:
+        separator = '['
+        for item in value:
+            yield separator
+            yield from iter_sorted_json(item, depth - 1)
+            separator = ', '
+        yield ']'
+    else:
+        yield json.dumps(value, sort_keys=True)
+
+
+def hash_case_json(case_json):
+    """
+    Return the SHA512 hash of a case json, sorting the keys so that the hash
+    does not depend on key order. The sorted json is hashed as it is written,
+    without building the whole string in memory.
+    """
+    hash_hex = hashlib.sha512()
+    for piece in iter_sorted_json(case_json):
+        hash_hex.update(piece.encode('utf-8'))
+    hash_digest = hash_hex.hexdigest()
+    return hash_digest
+
+
+# the attributes of a Case which are costly to parse from its json
+PARSED_FIELDS = (
+    'ir_obj',
+    'json_hash',
+    'ig_objs',
+    'clinical_report_objs',
+    'variants',
+    'svs',
+    'strs',
+)
+
+
+def parse_case(case_json, pullt3=True):
+    """
+    Parse the PARSED_FIELDS of a case json. Used by the MultipleCaseAdder to
+    parse cases in a process pool: only the dict of parsed fields is pickled
+    back to the parent process, which passes it to Case as parsed along with
+    the json it already holds.
+    """
+    case = Case(
+        case_json=case_json,
+        panel_manager=None,
+        variant_manager=None,
+        gene_manager=None,
+        pullt3=pullt3)
+    return {field: getattr(case, field) for field in PARSED_FIELDS}
+
+
+def join_transcript_entries(case_transcripts, case_variants, variant_entries,
+                            transcript_entries, genome_assembly):
+    """
+    Set the variant_entry and transcript_entry of each CaseTranscript from
+    the Variant and Transcript entries of its case. The entries are indexed
+    on (case_id, variant_count), (chromosome, position, ref, alt) and
+    (transcript name, assembly), so the cost grows linearly with the number
+    of transcripts rather than with transcripts x variants.
+
+    CaseTranscripts with no Transcript entry, as we don't make entries for
+    transcripts with no Gene, have their transcript_entry set to None.
+    """
+    # the first CaseVariant for each variant in the case
+    case_variant_index = {}
+    for variant in case_variants:
+        case_variant_index.setdefault(
+            (variant.case_id, variant.variant_count), variant)
+    variant_entry_index = {
+        (entry.chromosome, entry.position, entry.reference, entry.alternate): entry
+        for entry in variant_entries}
+    transcript_entry_index = {}
+    for entry in transcript_entries:
+        transcript_entry_index.setdefault(
+            (entry.name, entry.genome_assembly_id), entry)
+    genome_assembly_id = genome_assembly.pk if genome_assembly else None
+
+    for case_transcript in case_transcripts:
+        case_variant = case_variant_index.get(
+            (case_transcript.case_id, case_transcript.variant_count))
+        if case_variant is not None:
+            variant_entry = variant_entry_index.get((
+                case_variant.chromosome, case_variant.position,
+                case_variant.ref, case_variant.alt))
+            if variant_entry is not None:
+                case_transcript.variant_entry = variant_entry
+
+        if transcript_entries:
+            case_transcript.transcript_entry = transcript_entry_index.get(
+                (case_transcript.transcript_name, genome_assembly_id))
+
+
 class Case(object):
     """
     Entity object which represents a case and it's associated details.
@@ -49,9 +156,10 @@ class Case(object):
         json (dict): upon initialisation of the Case, this is the full json
             response from PollAPI. This is edited during the database update
             process to keep relevant information together in the datastructure.
-        raw_json (dict): a deepcopy of the json, which remains unmodified, for
-            the purpose of saving the json to disk once a Case has been added
-            or updated in the database.
+        raw_content (bytes): the CIP-API response body which the json was
+            decoded from, which is saved to disk unchanged once a Case has been
+            added or updated in the database. None if the json was not polled,
+            in which case the json itself is saved.
         json_case_data (dict): a sub-dict within the json which refers to the
             interpretation_request_data.
         json_request_data (dict): a sub-dict of json_case_data which holds the
@@ -85,9 +193,10 @@ class Case(object):
             same genomic position) has identical information between b37/b38
             cases.
         gene_manager (multiple_case_adder.GeneManager): instance of the control
-            class GeneManager, which ensures that GeneNames is not polled twice
-            for the same gene in one run of the MCA, ie. before a new gene is
-            added the database and hence won't be found by check_found_in_db
+            class GeneManager, which resolves genes from the local HGNC store
+            and ensures that the same gene is only resolved once in one run
+            of the MCA, ie. before a new gene is added the database and hence
+            won't be found by check_found_in_db
         panels (dict): the "analysisPanels" section of the JSON. This only
             applies for rare disease cases; cancer cases do not have panels so
             this attribute is None in those cases.
@@ -107,32 +216,33 @@ class Case(object):
             updated in the database, then the MCA will create (in the correct
             order) CaseAttributeManagers for each model type for each case.
     """
-    def __init__(self, case_json, panel_manager, variant_manager, gene_manager, skip_demographics=False, pullt3=True):
+    def __init__(self, case_json, panel_manager, variant_manager, gene_manager, skip_demographics=False, pullt3=True,
+                 raw_content=None, parsed=None):
         """
         Initialise a Case with the json, then pull out relevant sections.
 
-        The JSON is deepcopied for raw_json, then the relevant sections are
-        extracted by dictionary accessors or standalone functions (in the case
-        of proband, family_members, tools_and_versions). A SHA512 hash is also
-        calculated for the JSON, to later check if the JSON used for a case
-        has changed in the CIP API.
+        The relevant sections are extracted by dictionary accessors or
+        standalone functions (in the case of proband, family_members,
+        tools_and_versions). A SHA512 hash is also calculated for the JSON, to
+        later check if the JSON used for a case has changed in the CIP API.
+        If the dict of PARSED_FIELDS returned by parse_case() is given as
+        parsed, those are used rather than parsed again.
         """
-
-        self.json = case_json
-        # raw json created to dump at the end; json attr is modified
         self.pullt3 = pullt3
-        self.raw_json = copy.deepcopy(case_json)
-        self.json_case_data = self.json["interpretation_request_data"]
-        self.json_request_data = self.json_case_data["json_request"]
+        self.set_json(case_json, raw_content)
         self.request_id = str(
             self.json["interpretation_request_id"]) \
             + "-" + str(self.json["version"])
-        if self.json["sample_type"] == 'raredisease':
-            self.ir_obj = InterpretationRequestRD.fromJsonDict(self.json_request_data)
-        elif self.json['sample_type'] == 'cancer':
-            self.ir_obj = CancerInterpretationRequest.fromJsonDict(self.json_request_data)
+        if parsed is not None:
+            for field in PARSED_FIELDS:
+                setattr(self, field, parsed[field])
+        else:
+            if self.json["sample_type"] == 'raredisease':
+                self.ir_obj = InterpretationRequestRD.fromJsonDict(self.json_request_data)
+            elif self.json['sample_type'] == 'cancer':
+                self.ir_obj = CancerInterpretationRequest.fromJsonDict(self.json_request_data)
+            self.json_hash = self.hash_json()
 
-        self.json_hash = self.hash_json()
         self.proband = self.get_proband_json()
         if self.json["sample_type"] == 'raredisease':
             self.proband_sample = self.proband.samples[0].sampleId
@@ -148,10 +258,12 @@ class Case(object):
 
         self.panels = self.get_panels_json()
 
-        self.ig_objs = []  # List of interpreteted genome objects
-        self.clinical_report_objs = []  # ClinicalReport objects
-        self.variants, self.svs, self.strs = self.get_case_variants()
+        if parsed is None:
+            self.ig_objs = []  # List of interpreteted genome objects
+            self.clinical_report_objs = []  # ClinicalReport objects
+            self.variants, self.svs, self.strs = self.get_case_variants()
         self.transcripts = []  # set by MCM with a call to vep_utils
+        # dicts of participant/family ID to LabKey rows, set by the MCA
         self.demographics = None
         self.clinicians = None
         self.diagnosis = None
@@ -162,16 +274,22 @@ class Case(object):
         self.skip_demographics = skip_demographics
         self.attribute_managers = {}
 
+    def set_json(self, case_json, raw_content=None):
+        """
+        Set the json of a Case, and the raw content it was decoded from.
+        """
+        self.json = case_json
+        self.raw_content = raw_content
+        self.json_case_data = self.json["interpretation_request_data"]
+        self.json_request_data = self.json_case_data["json_request"]
+
     def hash_json(self):
         """
         Hash the given json for this Case, sorting the keys to ensure
         that order is preserved, or else different order -> different
         hash.
         """
-        hash_buffer = json.dumps(self.json, sort_keys=True).encode('utf-8')
-        hash_hex = hashlib.sha512(hash_buffer)
-        hash_digest = hash_hex.hexdigest()
-        return hash_digest
+        return hash_case_json(self.json)
 
     def get_proband_json(self):
         """
@@ -533,7 +651,7 @@ class CaseAttributeManager(object):
             search_term = 'participant_identifiers_id'
         # load in site specific details from config file
         if not self.case.skip_demographics:
-            for row in self.case.clinicians:
+            for row in self.case.clinicians.get(str(family_id), []):
                 try:
                     if row[search_term] == family_id:
                         if row.get('consultant_details_full_name_of_responsible_consultant'):
@@ -569,7 +687,7 @@ class CaseAttributeManager(object):
         }
 
         if not self.case.skip_demographics:
-            for row in self.case.demographics:
+            for row in self.case.demographics.get(str(participant_id), []):
                 try:
                     if row['participant_id'] == participant_id:
                         participant_demographics["surname"] = row.get(
@@ -611,7 +729,7 @@ class CaseAttributeManager(object):
         if not self.case.skip_demographics:
             # set up LabKey to get recruited disease
             if self.case.json['sample_type'] == 'raredisease':
-                for row in self.case.diagnosis:
+                for row in self.case.diagnosis.get(str(participant_id), []):
                     try:
                         if row['participant_identifiers_id'] == participant_id:
                             disease_group = row.get('gel_disease_information_disease_group', None)
@@ -783,11 +901,14 @@ class CaseAttributeManager(object):
     def get_panels(self):
         """
         Poll panelApp to fetch information about a panel, then create a
-        ManyCaseModel with this information.
+        ManyCaseModel with this information. Panels which have been mirrored
+        by the sync_panelapp command are read from the database instead.
         """
         config_dict = load_config.LoadConfig().load()
         panelapp_storage = config_dict['panelapp_storage']
         if self.case.panels:
+            self.case.panel_manager.load_mirrored_panels([
+                (panel.panelName, panel.panelVersion) for panel in self.case.panels])
             for panel in self.case.panels:
                 polled = self.case.panel_manager.fetch_panel_response(
                     panelapp_id=panel.panelName,
@@ -897,8 +1018,6 @@ class CaseAttributeManager(object):
                                     gene_list.append({'EnsembleGeneIds': gene.ensemblId,
                                                       'GeneSymbol': gene.geneSymbol})
 
-        self.case.gene_manager.load_genes()
-
         for transcript in self.case.transcripts:
             if transcript.gene_ensembl_id and transcript.gene_hgnc_id:
                 gene_list.append({
@@ -908,26 +1027,18 @@ class CaseAttributeManager(object):
                 })
                 self.case.gene_manager.add_searched(transcript.gene_ensembl_id, str(transcript.gene_hgnc_id))
 
-        for gene in tqdm(gene_list, desc=self.case.request_id):
+        # resolve the whole gene list against the local HGNC store at once
+        self.case.gene_manager.resolve_genes([
+            gene['EnsembleGeneIds'] for gene in gene_list if gene['EnsembleGeneIds']])
+
+        for gene in gene_list:
             gene['HGNC_ID'] = None
             if gene['EnsembleGeneIds']:
                 polled = self.case.gene_manager.fetch_searched(gene['EnsembleGeneIds'])
-                if polled == 'Not_found':
-                    gene['HGNC_ID'] = None
-                elif not polled:
-                    genename_poll = PollAPI(
-                        "genenames", "search/{gene}/".format(
-                            gene=gene["EnsembleGeneIds"])
-                    )
-                    genename_response = genename_poll.get_json_response()
-                    if genename_response['response']['docs']:
-                        hgnc_id = genename_response['response']['docs'][0]['hgnc_id'].split(':')
-                        gene['HGNC_ID'] = str(hgnc_id[1])
-                        self.case.gene_manager.add_searched(gene["EnsembleGeneIds"], str(hgnc_id[1]))
-                    else:
-                        self.case.gene_manager.add_searched(gene["EnsembleGeneIds"], 'Not_found')
-                else:
+                if polled and polled != 'Not_found':
                     gene['HGNC_ID'] = polled
+                    if not gene['GeneSymbol']:
+                        gene['GeneSymbol'] = self.case.gene_manager.fetch_symbol(gene['EnsembleGeneIds'])
 
         cleaned_gene_list = []
         for gene in gene_list:
@@ -936,8 +1047,6 @@ class CaseAttributeManager(object):
                 new_gene = self.case.gene_manager.fetch_gene(gene)
                 cleaned_gene_list.append(new_gene)
 
-        self.case.gene_manager.write_genes()
-
         genes = ManyCaseModel(Gene, [{
             "ensembl_id": gene["EnsembleGeneIds"],  # TODO: which ID to use?
             "hgnc_name": gene["GeneSymbol"],
@@ -970,8 +1079,20 @@ class CaseAttributeManager(object):
                 genome_assembly = tool
 
         genes = self.case.attribute_managers[Gene].case_model.case_models
+        # index the gene entries by hgnc_id, and look up the preferred
+        # transcript of every gene in one query
+        gene_entries = {gene.entry.hgnc_id: gene.entry for gene in genes}
+        preferred_transcripts = {}
+        if self.case.json['sample_type'] == 'raredisease':
+            preferred_transcripts = {
+                gene_id: transcript_name
+                for gene_id, transcript_name
+                in PreferredTranscript.objects.filter(
+                    gene__in=list(gene_entries.values()),
+                    genome_assembly=genome_assembly
+                ).values_list('gene_id', 'transcript__name')}
         case_transcripts = self.case.transcripts
-        # for each transcript, add an FK to the gene with matching ensg ID
+        # for each transcript, add an FK to the gene with matching hgnc ID
         for transcript in case_transcripts:
             # convert canonical to bools:
             transcript.canonical = transcript.transcript_canonical == "YES"
@@ -980,19 +1101,14 @@ class CaseAttributeManager(object):
             if not transcript.gene_hgnc_id:
                 # if the transcript has no recognised gene associated
                 continue  # don't bother checking genes
-            transcript.gene_model = None
-            for gene in genes:
-                if gene.entry.hgnc_id == transcript.gene_hgnc_id:
-                    transcript.gene_model = gene.entry
-                    if self.case.json['sample_type'] == 'raredisease':
-                        preferred_transcript = PreferredTranscript.objects.filter(gene=gene.entry,
-                                                                                  genome_assembly=genome_assembly)
-                        if preferred_transcript:
-                            preferred_transcript = preferred_transcript.first()
-                            if preferred_transcript.transcript.name == transcript.transcript_name:
-                                transcript.selected = True
-                        else:
-                            transcript.selected = transcript.transcript_canonical == "YES"
+            transcript.gene_model = gene_entries.get(transcript.gene_hgnc_id)
+            if transcript.gene_model and self.case.json['sample_type'] == 'raredisease':
+                preferred_transcript = preferred_transcripts.get(transcript.gene_model.pk)
+                if preferred_transcript:
+                    if preferred_transcript == transcript.transcript_name:
+                        transcript.selected = True
+                else:
+                    transcript.selected = transcript.transcript_canonical == "YES"
 
         transcripts = ManyCaseModel(Transcript, [{
             "gene": transcript.gene_model,
@@ -1217,44 +1333,10 @@ class CaseAttributeManager(object):
         variant_entries = [variant.entry
                            for variant in variant_manager.case_models]
 
-        # for each CaseTranscript (which contains necessary info):
-        for case_transcript in self.case.transcripts:
-            # get information to hook up transcripts with variants
-            case_id = case_transcript.case_id
-            variant_id = case_transcript.variant_count
-            for variant in self.case.variants:
-                if (
-                    case_id == variant.case_id and
-                    variant_id == variant.variant_count
-                ):
-                    case_variant = variant
-                    break
-
-            # name to hook up CaseTranscript with Transcript
-            transcript_name = case_transcript.transcript_name
-
-            # add the corresponding Variant entry
-            for variant_entry in variant_entries:
-                # find the matching variant entry
-                if (
-                    variant_entry.chromosome == case_variant.chromosome and
-                    variant_entry.position == case_variant.position and
-                    variant_entry.reference == case_variant.ref and
-                    variant_entry.alternate == case_variant.alt
-                ):
-                    # add match to the case_transcript
-                    case_transcript.variant_entry = variant_entry
-
-            # add the corresponding Transcript entry
-            for transcript_entry in transcript_entries:
-                found = False
-                if transcript_entry.name == transcript_name and transcript_entry.genome_assembly == genome_assembly:
-                    case_transcript.transcript_entry = transcript_entry
-                    found = True
-                    break
-                if not found:
-                    # we don't make entries for tx with no Gene
-                    case_transcript.transcript_entry = None
+        # hook up each CaseTranscript with its Variant and Transcript
+        join_transcript_entries(
+            self.case.transcripts, self.case.variants, variant_entries,
+            transcript_entries, genome_assembly)
 
         # use the updated CaseTranscript instances to create an MCM
         transcript_variants = ManyCaseModel(TranscriptVariant, [{
@@ -1441,10 +1523,12 @@ class CaseAttributeManager(object):
         proband_variants = [proband_variant.entry for proband_variant
                             in self.case.attribute_managers[ProbandVariant].case_model.case_models]
 
+        proband_variants = {
+            proband_variant.variant_id: proband_variant
+            for proband_variant in proband_variants}
         for transcript in self.case.transcripts:
-            for proband_variant in proband_variants:
-                if proband_variant.variant == transcript.variant_entry:
-                    transcript.proband_variant_entry = proband_variant
+            if transcript.variant_entry and transcript.variant_entry.pk in proband_variants:
+                transcript.proband_variant_entry = proband_variants[transcript.variant_entry.pk]
 
         if self.case.json['sample_type'] == 'cancer':
             for transcript in self.case.transcripts:
@@ -1777,358 +1861,20 @@ class CaseModel(object):
         self.model_type = model_type
 
         self.model_attributes = model_attributes.copy()
-        self.escaped_model_attributes = model_attributes.copy()
-        self.string_escape_model_attributes()  # prevent sql injection
 
         self.model_objects = model_objects
         self.entry = self.check_found_in_db(self.model_objects)
 
-    def string_escape_model_attributes(self):
-        # string escape ' characters in model attributes for use with raw sql
-        for k, v in self.escaped_model_attributes.items():
-            if isinstance(self.escaped_model_attributes[k], str):
-                self.escaped_model_attributes[k] = self.escaped_model_attributes[k].replace(
-                    "'", "''"  # psql takes '' when ' is used in string to avoid term
-                )
-
-    def set_sql_cmd(self):
-        # set raw sql to run against database to fetch matching record
-        if self.model_type == Clinician:
-            if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.mysql':
-                table = 'SELECT * FROM Clinician'
-                cmd = ''.join([
-                    " WHERE BINARY name = '{name}'",
-                    " AND BINARY hospital = '{hospital}'",
-                    " AND BINARY email = '{email}'"
-                ]).format(
-                    name=self.escaped_model_attributes["name"],
-                    hospital=self.escaped_model_attributes["hospital"],
-                    email=self.escaped_model_attributes["email"]
-                )
-            else:
-                table = 'SELECT * FROM "Clinician"'
-                cmd = ''.join([
-                    " WHERE name = '{name}'",
-                    " AND hospital = '{hospital}'",
-                    " AND email = '{email}'"
-                ]).format(
-                    name=self.escaped_model_attributes["name"],
-                    hospital=self.escaped_model_attributes["hospital"],
-                    email=self.escaped_model_attributes["email"]
-                )
-        elif self.model_type == Proband:
-            if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.mysql':
-                table = 'SELECT * FROM Proband'
-            else:
-                table = 'SELECT * FROM "Proband"'
-            cmd = ''.join([
-                " WHERE gel_id = '{gel_id}'"
-            ]).format(
-                gel_id=self.escaped_model_attributes["gel_id"]
-            )
-        elif self.model_type == Family:
-            if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.mysql':
-                table = 'SELECT * FROM Family'
-            else:
-                table = 'SELECT * FROM "Family"'
-            cmd = ''.join([
-                " WHERE gel_family_id = '{gel_family_id}'"
-            ]).format(
-                gel_family_id=self.escaped_model_attributes["gel_family_id"]
-            )
-        elif self.model_type == Relative:
-            if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.mysql':
-                table = 'SELECT * FROM Relative'
-            else:
-                table = 'SELECT * FROM "Relative"'
-            cmd = ''.join([
-                " WHERE gel_id = '{gel_id}'",
-                " AND proband_id = {proband_id}"
-            ]).format(
-                gel_id=self.escaped_model_attributes["gel_id"],
-                proband_id=self.escaped_model_attributes["proband"].id
-            )
-        elif self.model_type == Phenotype:
-            if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.mysql':
-                table = 'SELECT * FROM Phenotype'
-            else:
-                table = 'SELECT * FROM "Phenotype"'
-            cmd = ''.join([
-                " WHERE hpo_terms = '{hpo_terms}'"
-            ]).format(
-                hpo_terms=self.escaped_model_attributes["hpo_terms"]
-            )
-        elif self.model_type == InterpretationReportFamily:
-            if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.mysql':
-                table = 'SELECT * FROM InterpretationReportFamily'
-            else:
-                table = 'SELECT * FROM "InterpretationReportFamily"'
-            cmd = ''.join([
-                " WHERE ir_family_id = '{ir_family_id}'",
-            ]).format(
-                ir_family_id=self.escaped_model_attributes["ir_family_id"]
-            )
-        elif self.model_type == Panel:
-            if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.mysql':
-                table = 'SELECT * FROM Panel'
-            else:
-                table = 'SELECT * FROM "Panel"'
-            cmd = ''.join([
-                " WHERE panelapp_id = '{panelapp_id}'",
-            ]).format(
-                panelapp_id=self.escaped_model_attributes["panelapp_id"]
-            )
-        elif self.model_type == PanelVersion:
-            if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.mysql':
-                table = 'SELECT * FROM PanelVersion'
-            else:
-                table = 'SELECT * FROM "PanelVersion"'
-            cmd = ''.join([
-                " WHERE panel_id = '{panel_id}'",
-                " AND version_number = '{version_number}'"
-            ]).format(
-                panel_id=self.escaped_model_attributes["panel"].id,
-                version_number=self.escaped_model_attributes["version_number"]
-            )
-        elif self.model_type == InterpretationReportFamilyPanel:
-            if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.mysql':
-                table = 'SELECT * FROM gel2mdt_interpretationreportfamilypanel'
-            else:
-                table = 'SELECT * FROM "gel2mdt_interpretationreportfamilypanel"'
-            cmd = ''.join([
-                " WHERE ir_family_id = {ir_family_id}",  # no ' because FKID
-                " AND panel_id = {panel_id}"
-            ]).format(
-                ir_family_id=self.escaped_model_attributes["ir_family"].id,
-                panel_id=self.escaped_model_attributes["panel"].id
-            )
-        elif self.model_type == Gene:
-            if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.mysql':
-                table = 'SELECT * FROM Gene'
-            else:
-                table = 'SELECT * FROM "Gene"'
-            cmd = ''.join([
-                " WHERE hgnc_id = '{hgnc_id}'",
-            ]).format(
-                hgnc_id=self.escaped_model_attributes["hgnc_id"]
-            )
-        elif self.model_type == Transcript:
-            if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.mysql':
-                table = 'SELECT * FROM Transcript'
-            else:
-                table = 'SELECT * FROM "Transcript"'
-            cmd = ''.join([
-                " WHERE name = '{name}'",
-                " AND genome_assembly_id = {genome_assembly_id}"
-            ]).format(
-                name=self.escaped_model_attributes["name"],
-                genome_assembly_id=self.escaped_model_attributes["genome_assembly"].id
-            )
-        elif self.model_type == GELInterpretationReport:
-            if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.mysql':
-                table = 'SELECT * FROM GELInterpretationReport'
-            else:
-                table = 'SELECT * FROM "GELInterpretationReport"'
-            cmd = ''.join([
-                " WHERE sha_hash = '{sha_hash}'",
-            ]).format(
-                sha_hash=self.escaped_model_attributes["sha_hash"]
-            )
-        elif self.model_type == Variant:
-            if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.mysql':
-                table = 'SELECT * FROM Variant'
-            else:
-                table = 'SELECT * FROM "Variant"'
-            cmd = ''.join([
-                " WHERE chromosome = '{chromosome}'",
-                " AND position = {position}"
-                " AND reference = '{reference}'"
-                " AND alternate = '{alternate}'"
-                " AND genome_assembly_id = {genome_assembly_id}"
-            ]).format(
-                chromosome=self.escaped_model_attributes["chromosome"],
-                position=self.escaped_model_attributes["position"],
-                reference=self.escaped_model_attributes["reference"],
-                alternate=self.escaped_model_attributes["alternate"],
-                genome_assembly_id=self.escaped_model_attributes["genome_assembly"].id
-            )
-        elif self.model_type == TranscriptVariant:
-            if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.mysql':
-                table = 'SELECT * FROM TranscriptVariant'
-            else:
-                table = 'SELECT * FROM "TranscriptVariant"'
-            cmd = ''.join([
-                " WHERE transcript_id = {transcript_id}",
-                " AND variant_id = {variant_id}"
-            ]).format(
-                transcript_id=self.escaped_model_attributes["transcript"].id,
-                variant_id=self.escaped_model_attributes["variant"].id
-            )
-        elif self.model_type == ProbandVariant:
-            if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.mysql':
-                table = 'SELECT * FROM ProbandVariant'
-            else:
-                table = 'SELECT * FROM "ProbandVariant"'
-            cmd = ''.join([
-                " WHERE variant_id = {variant_id}",
-                " AND interpretation_report_id = {interpretation_report_id}"
-            ]).format(
-                variant_id=self.escaped_model_attributes["variant"].id,
-                interpretation_report_id=self.escaped_model_attributes["interpretation_report"].id
-            )
-        elif self.model_type == PVFlag:
-            if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.mysql':
-                table = 'SELECT * FROM PVFlag'
-            else:
-                table = 'SELECT * FROM "PVFlag"'
-            cmd = ''.join([
-                " WHERE proband_variant_id = {proband_variant_id}",
-                " AND flag_name = '{flag_name}'"
-            ]).format(
-                proband_variant_id=self.escaped_model_attributes["proband_variant"].id,
-                flag_name=self.escaped_model_attributes["flag_name"]
-            )
-        elif self.model_type == ProbandTranscriptVariant:
-            if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.mysql':
-                table = 'SELECT * FROM ProbandTranscriptVariant'
-            else:
-                table = 'SELECT * FROM "ProbandTranscriptVariant"'
-            cmd = ''.join([
-                " WHERE transcript_id = {transcript_id}",
-                " AND proband_variant_id = {proband_variant_id}"
-            ]).format(
-                transcript_id=self.escaped_model_attributes["transcript"].id,
-                proband_variant_id=self.escaped_model_attributes["proband_variant"].id
-            )
-        elif self.model_type == ReportEvent:
-            if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.mysql':
-                table = 'SELECT * FROM ReportEvent'
-            else:
-                table = 'SELECT * FROM "ReportEvent"'
-            cmd = ''.join([
-                " WHERE re_id = '{re_id}'",
-                " AND proband_variant_id = {proband_variant_id}"
-            ]).format(
-                re_id=self.escaped_model_attributes["re_id"],
-                proband_variant_id=self.escaped_model_attributes["proband_variant"].id
-            )
-        elif self.model_type == ToolOrAssemblyVersion:
-            if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.mysql':
-                table = 'SELECT * FROM ToolOrAssemblyVersion'
-            else:
-                table = 'SELECT * FROM "ToolOrAssemblyVersion"'
-            cmd = ''.join([
-                " WHERE tool_name = '{tool_name}'",
-                " AND version_number = '{version_number}'"
-            ]).format(
-                tool_name=self.escaped_model_attributes["tool_name"],
-                version_number=self.escaped_model_attributes["version_number"]
-            )
-        elif self.model_type == SVRegion:
-            if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.mysql':
-                table = 'SELECT * FROM SVRegion'
-            else:
-                table = 'SELECT * FROM "SVRegion"'
-            cmd = ''.join([
-                f" WHERE chromosome = '{self.escaped_model_attributes['chromosome']}'",
-                f" AND sv_start = {self.escaped_model_attributes['sv_start']}"
-                f" AND sv_end = '{self.escaped_model_attributes['sv_end']}'"
-                f" AND genome_assembly_id = {self.escaped_model_attributes['genome_assembly'].id}"])
-        elif self.model_type == SV:
-            if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.mysql':
-                table = 'SELECT * FROM SV'
-            else:
-                table = 'SELECT * FROM "SV"'
-            if self.escaped_model_attributes['sv_region2'] is None:
-                cmd = ''.join([
-                    f" WHERE sv_region1_id = {self.escaped_model_attributes['sv_region1'].id}",
-                    f" AND variant_type = '{self.escaped_model_attributes['variant_type']}'"
-                ])
-            else:
-                cmd = ''.join([
-                    f" WHERE sv_region1_id = {self.escaped_model_attributes['sv_region1'].id}",
-                    f" WHERE sv_region2_id = {self.escaped_model_attributes['sv_region2'].id}",
-                    f" AND variant_type = '{self.escaped_model_attributes['variant_type']}'"
-                ])
-        elif self.model_type == ProbandSV:
-            if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.mysql':
-                table = 'SELECT * FROM ProbandSV'
-            else:
-                table = 'SELECT * FROM "ProbandSV"'
-            cmd = ''.join([
-                f" WHERE interpretation_report_id = {self.escaped_model_attributes['interpretation_report'].id}",
-                f" AND sv_id = {self.escaped_model_attributes['sv'].id}",
-            ])
-        elif self.model_type == ProbandSVGene:
-            if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.mysql':
-                table = 'SELECT * FROM ProbandSVGene'
-            else:
-                table = 'SELECT * FROM "ProbandSVGene"'
-            cmd = ''.join([
-                f" WHERE proband_sv_id = {self.escaped_model_attributes['proband_sv'].id}",
-                f" AND gene_id = '{self.escaped_model_attributes['gene'].id}'"
-            ])
-        elif self.model_type == STRVariant:
-            if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.mysql':
-                table = 'SELECT * FROM STRVariant'
-            else:
-                table = 'SELECT * FROM "STRVariant"'
-            cmd = ''.join([
-                f" WHERE chromosome = '{self.escaped_model_attributes['chromosome']}'",
-                f" AND str_start = '{self.escaped_model_attributes['str_start']}'"
-                f" AND str_end = '{self.escaped_model_attributes['str_end']}'"
-                f" AND repeated_sequence = '{self.escaped_model_attributes['repeated_sequence']}'"
-                f" AND normal_threshold = '{self.escaped_model_attributes['normal_threshold']}'"
-                f" AND pathogenic_threshold = '{self.escaped_model_attributes['pathogenic_threshold']}'"
-                f" AND genome_assembly_id = {self.escaped_model_attributes['genome_assembly'].id}"])
-        elif self.model_type == ProbandSTR:
-            if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.mysql':
-                table = 'SELECT * FROM ProbandSTR'
-            else:
-                table = 'SELECT * FROM "ProbandSTR"'
-            cmd = ''.join([
-                f" WHERE interpretation_report_id = {self.escaped_model_attributes['interpretation_report'].id}",
-                f" AND str_variant_id = {self.escaped_model_attributes['str_variant'].id}",
-            ])
-        elif self.model_type == ProbandSTRGene:
-            if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.mysql':
-                table = 'SELECT * FROM ProbandSTRGene'
-            else:
-                table = 'SELECT * FROM "ProbandSTRGene"'
-            cmd = ''.join([
-                f" WHERE proband_str_id = {self.escaped_model_attributes['proband_str'].id}",
-                f" AND gene_id = '{self.escaped_model_attributes['gene'].id}'"
-            ])
-
-        sql =  ''.join([
-            table,
-            cmd
-        ])
-        return sql
-
-    def check_found_in_db(self, queryset):
+    def check_found_in_db(self, model_objects):
         """
-        Queries the database for a model of the given type with the given
-        attributes. Returns True if found, False if not.
+        Looks up this CaseModel's natural key with the NaturalKeyResolver for
+        its model type. Returns the entry if the key has already been resolved,
+        otherwise returns False and the entry is set when the resolver next
+        runs resolve().
         """
-        sql_cmd = self.set_sql_cmd()
-
-        entry = [
-            db_obj for db_obj in self.model_type.objects.raw(sql_cmd)
-        ]
-        # tqdm.write(sql_cmd + "\t>>>\t" + str(entry))
-
-        if len(entry) == 1:
-            entry = entry[0]
-            # also need to set self.entry here as it may not be called in init
-            self.entry = entry
-        elif len(entry) == 0:
-            entry = False
-            self.entry = entry
-        else:
-            print(entry)
-            raise ValueError("Multiple entries found for same object.")
-
+        entry = model_objects.fetch(self)
+        # also need to set self.entry here as it may not be called in init
+        self.entry = entry
         return entry
 
 
@@ -2147,7 +1893,11 @@ class ManyCaseModel(object):
             CaseModel(model_type, model_attributes, model_objects)
             for model_attributes in model_attributes_list
         ]
-        self.entries = self.get_entry_list()
+
+    @property
+    def entries(self):
+        # entries may be set after init by NaturalKeyResolver.resolve()
+        return self.get_entry_list()
 
     def get_entry_list(self):
         entries = []
@@ -0,0 +1,271 @@
+"""Copyright (c) 2018 Great Ormond Street Hospital for Children NHS Foundation
+Trust & Birmingham Women's and Children's NHS Foundation Trust
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import os
+import re
+import gzip
+import json
+import fcntl
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+
+# legacy storage wrote each case to {request_id}-{archived_version}.json
+LEGACY_FILENAME = re.compile(r'^(?P<request_id>\d+-\d+)-(?P<archived_version>\d+)\.json$')
+
+
+class CaseStorage(object):
+    """
+    Compressed, indexed store for the CIP-API case jsons in cip_api_storage.
+
+    Each case is compressed as a separate gzip member and appended to the
+    current archive file (cases_0001.json.gz, cases_0002.json.gz, ...), which
+    is rolled over once it reaches max_archive_size. Because concatenated gzip
+    members are themselves a valid gzip file, archives can still be read with
+    standard tools. An SQLite index in the same directory records where each
+    case is stored, so a single case is read with one seek, and whole
+    archives can be scanned in order for reprocessing.
+
+    Writes hold an flock on index.lock, so separate ingest processes sharing
+    the directory never append to an archive at the same time. A batch of
+    cases is synced to disk and indexed together.
+
+    Cases which are not in the index are read from the plain json files
+    written before the archive was introduced; these can be moved into the
+    archive with the migrate_cip_api_storage management command.
+
+    Attributes:
+        storage_dir (str): the cip_api_storage directory.
+        max_archive_size (int): size in bytes at which a new archive is
+            started.
+        compresslevel (int): gzip compression level used for each case.
+        index (sqlite3.Connection): connection to the index database, shared
+            between threads under lock.
+        lock_path (str): the file locked by writers in every process.
+    """
+    max_archive_size = 1024 ** 3
+    compresslevel = 6
+
+    def __init__(self, storage_dir):
+        self.storage_dir = storage_dir
+        self.lock = threading.Lock()
+        self.index = sqlite3.connect(
+            os.path.join(storage_dir, 'index.sqlite3'),
+            check_same_thread=False)
+        self.index.execute(
+            "CREATE TABLE IF NOT EXISTS stored_case ("
+            "request_id TEXT NOT NULL, "
+            "archived_version INTEGER NOT NULL, "
+            "sha_hash TEXT, "
+            "archive TEXT NOT NULL, "
+            "offset INTEGER NOT NULL, "
+            "size INTEGER NOT NULL, "
+            "PRIMARY KEY (request_id, archived_version))")
+        self.index.execute(
+            "CREATE INDEX IF NOT EXISTS stored_case_archive "
+            "ON stored_case (archive)")
+        self.index.commit()
+        self.lock_path = os.path.join(storage_dir, 'index.lock')
+
+    @contextmanager
+    def write_lock(self):
+        """
+        Hold the thread lock and an exclusive flock on lock_path for the
+        duration of the block.
+        """
+        with self.lock, open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def get_current_archive(self):
+        """
+        Return the name of the archive being appended to, looked up in the
+        index rather than by listing the storage directory, which may still
+        hold many legacy json files. Call under write_lock, since another
+        process may have started a new archive.
+        """
+        latest = self.index.execute(
+            "SELECT MAX(archive) FROM stored_case").fetchone()[0]
+        return latest or 'cases_0001.json.gz'
+
+    @staticmethod
+    def get_next_archive(archive):
+        number = int(archive[len('cases_'):-len('.json.gz')]) + 1
+        return 'cases_{:04d}.json.gz'.format(number)
+
+    def write(self, request_id, archived_version, content, sha_hash=None):
+        """
+        Compress and append the content (bytes) of a case json to the current
+        archive, then index it. Writing a case which is already stored points
+        the index at the new copy.
+        """
+        self.write_many([(request_id, archived_version, content, sha_hash)])
+
+    def write_many(self, cases):
+        """
+        Compress and append a batch of case jsons to the current archive,
+        starting the next archive whenever the current one would grow past
+        max_archive_size. The archive is synced to disk once and the index
+        committed once for the whole batch.
+        :param cases: list of tuples of request_id, archived_version, content
+            (bytes) and sha_hash
+        """
+        members = [
+            (request_id, int(archived_version), sha_hash,
+             gzip.compress(content, compresslevel=self.compresslevel))
+            for request_id, archived_version, content, sha_hash in cases]
+        if not members:
+            return
+        rows = []
+        with self.write_lock():
+            archive = self.get_current_archive()
+            f = open(os.path.join(self.storage_dir, archive), 'ab')
+            try:
+                # anything appended by another process is already on disk
+                offset = os.fstat(f.fileno()).st_size
+                for request_id, archived_version, sha_hash, member in members:
+                    if offset != 0 and offset + len(member) > self.max_archive_size:
+                        f.flush()
+                        os.fsync(f.fileno())
+                        f.close()
+                        archive = self.get_next_archive(archive)
+                        f = open(os.path.join(self.storage_dir, archive), 'ab')
+                        offset = os.fstat(f.fileno()).st_size
+                    f.write(member)
+                    rows.append((request_id, archived_version, sha_hash,
+                                 archive, offset, len(member)))
+                    offset += len(member)
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                f.close()
+            self.index.executemany(
+                "INSERT OR REPLACE INTO stored_case "
+                "(request_id, archived_version, sha_hash, archive, offset, size) "
+                "VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self.index.commit()
+
+    def lookup(self, request_id, archived_version):
+        """
+        Return the index row (sha_hash, archive, offset, size) of a stored
+        case, or None if it is not in the archive.
+        """
+        with self.lock:
+            return self.index.execute(
+                "SELECT sha_hash, archive, offset, size FROM stored_case "
+                "WHERE request_id = ? AND archived_version = ?",
+                (request_id, int(archived_version))).fetchone()
+
+    def get_legacy_path(self, request_id, archived_version):
+        return os.path.join(
+            self.storage_dir,
+            '{}-{}.json'.format(request_id, archived_version))
+
+    def contains(self, request_id, archived_version):
+        """
+        Check whether a case is stored, either archived or as a legacy file.
+        """
+        return (self.lookup(request_id, archived_version) is not None
+                or os.path.isfile(self.get_legacy_path(request_id, archived_version)))
+
+    def get_hash(self, request_id, archived_version):
+        """
+        Return the hash a case was archived with, or None if it is unknown.
+        """
+        row = self.lookup(request_id, archived_version)
+        if row:
+            return row[0]
+        return None
+
+    def read_member(self, archive, offset, size):
+        with open(os.path.join(self.storage_dir, archive), 'rb') as f:
+            f.seek(offset)
+            return gzip.decompress(f.read(size))
+
+    def read(self, request_id, archived_version):
+        """
+        Return the stored content (bytes) of a case, or None if it has not
+        been stored.
+        """
+        row = self.lookup(request_id, archived_version)
+        if row:
+            sha_hash, archive, offset, size = row
+            return self.read_member(archive, offset, size)
+        legacy_path = self.get_legacy_path(request_id, archived_version)
+        if os.path.isfile(legacy_path):
+            with open(legacy_path, 'rb') as f:
+                return f.read()
+        return None
+
+    def load_json(self, request_id, archived_version):
+        """
+        Return the stored json of a case as a dict, or None if it has not
+        been stored.
+        """
+        content = self.read(request_id, archived_version)
+        if content is None:
+            return None
+        return json.loads(content.decode('utf-8'))
+
+    def scan(self):
+        """
+        Yield (request_id, archived_version, content) for every archived case
+        in storage order, reading each archive sequentially. Cases which were
+        written more than once are only yielded for their latest copy.
+        """
+        with self.lock:
+            rows = self.index.execute(
+                "SELECT request_id, archived_version, archive, offset, size "
+                "FROM stored_case ORDER BY archive, offset").fetchall()
+        current_archive = None
+        f = None
+        try:
+            for request_id, archived_version, archive, offset, size in rows:
+                if archive != current_archive:
+                    if f:
+                        f.close()
+                    f = open(os.path.join(self.storage_dir, archive), 'rb')
+                    current_archive = archive
+                if f.tell() != offset:
+                    f.seek(offset)
+                yield request_id, archived_version, gzip.decompress(f.read(size))
+        finally:
+            if f:
+                f.close()
+
+    def legacy_files(self):
+        """
+        Yield (request_id, archived_version, path) for each legacy json file
+        in the storage directory.
+        """
+        for filename in sorted(os.listdir(self.storage_dir)):
+            match = LEGACY_FILENAME.match(filename)
+            if match:
+                yield (match.group('request_id'),
+                       int(match.group('archived_version')),
+                       os.path.join(self.storage_dir, filename))
+
+    def close(self):
+        self.index.close()
@@ -1,8 +1,27 @@
+import json
+import datetime
+from concurrent.futures import ThreadPoolExecutor
 import labkey as lk
+from django.db import transaction
+from django.utils import timezone
 from ..config import load_config
+from ..models import LabKeyCache
 
 
 class DemographicsHandler:
+    """
+    Looks up participant demographics, clinicians and diagnoses in LabKey.
+
+    IDs are sent to LabKey in chunks of chunk_size, and the chunks of every
+    lookup are queried concurrently. The rows found for each ID are kept in
+    the LabKeyCache table, so only IDs which are new or older than
+    labkey_cache_ttl hours are sent to LabKey. Lookups return a dict of ID
+    to the LabKey rows for that ID.
+    """
+    chunk_size = 200
+    # maximum IDs per query when reading the cache
+    cache_chunk_size = 500
+
     def __init__(self, sample_type):
         self.sample_type = sample_type
 
@@ -13,53 +32,122 @@ class DemographicsHandler:
             self.labkey_server_request = self.config_dict['labkey_cancer_server_request']
         self.server_context = lk.utils.create_server_context(
             'gmc.genomicsengland.nhs.uk', self.labkey_server_request, '/labkey', use_ssl=True)
+        self.workers = max(self.config_dict.get_int('labkey_workers', 4), 1)
+        self.ttl = datetime.timedelta(hours=self.config_dict.get_float('labkey_cache_ttl', 24))
 
-    def get_demographics(self, participant_ids):
+    def get_query(self, lookup):
+        """
+        Return the (schema_name, query_name, ID column) queried for a lookup,
+        or None if the lookup does not apply to this sample type.
+        """
         if self.sample_type == 'raredisease':
-            schema_name = 'gel_rare_diseases'
+            queries = {
+                'demographics': ('gel_rare_diseases', 'participant_identifier', 'participant_id'),
+                'clinicians': ('gel_rare_diseases', 'rare_diseases_registration', 'family_id'),
+                'diagnosis': ('gel_rare_diseases', 'rare_diseases_diagnosis', 'participant_identifiers_id'),
+            }
         else:
-            schema_name = 'gel_cancer'
-        query = ';'.join(participant_ids)
-        results = lk.query.select_rows(
-            server_context=self.server_context,
-            schema_name=schema_name,
-            query_name='participant_identifier',
-            filter_array=[
-                lk.query.QueryFilter('participant_id', query, 'in')
-            ]
-        )
-        return results['rows']
+            queries = {
+                'demographics': ('gel_cancer', 'participant_identifier', 'participant_id'),
+                'clinicians': ('gel_cancer', 'cancer_registration', 'participant_identifiers_id'),
+            }
+        return queries.get(lookup)
 
-    def get_clinicians(self, family_ids):
-        if self.sample_type == 'raredisease':
-            schema_name = 'gel_rare_diseases'
-            query_name = 'rare_diseases_registration'
-            filter_type = 'family_id'
-        else:
-            schema_name = 'gel_cancer'
-            query_name = 'cancer_registration'
-            filter_type = 'participant_identifiers_id'
-        query = ';'.join(family_ids)
+    def select_rows(self, schema_name, query_name, column, ids):
         results = lk.query.select_rows(
             server_context=self.server_context,
             schema_name=schema_name,
             query_name=query_name,
             filter_array=[
-                lk.query.QueryFilter(filter_type, query, 'in')
+                lk.query.QueryFilter(column, ';'.join(ids), 'in')
             ]
         )
         return results['rows']
 
+    def read_cache(self, lookup, ids):
+        """
+        Return a dict of ID to cached rows for each of ids which has been
+        looked up within the TTL.
+        """
+        cached = {}
+        fresh_after = timezone.now() - self.ttl
+        ids = list(ids)
+        for start in range(0, len(ids), self.cache_chunk_size):
+            for entry in LabKeyCache.objects.filter(
+                    sample_type=self.sample_type, lookup=lookup,
+                    lookup_id__in=ids[start:start + self.cache_chunk_size],
+                    fetched_at__gte=fresh_after):
+                cached[entry.lookup_id] = json.loads(entry.rows)
+        return cached
+
+    def write_cache(self, lookup, fetched):
+        """
+        Replace the cached rows of each ID in fetched, a dict of ID to rows.
+        """
+        now = timezone.now()
+        ids = list(fetched)
+        with transaction.atomic():
+            for start in range(0, len(ids), self.cache_chunk_size):
+                LabKeyCache.objects.filter(
+                    sample_type=self.sample_type, lookup=lookup,
+                    lookup_id__in=ids[start:start + self.cache_chunk_size]).delete()
+            LabKeyCache.objects.bulk_create([
+                LabKeyCache(
+                    sample_type=self.sample_type, lookup=lookup, lookup_id=lookup_id,
+                    rows=json.dumps(rows), fetched_at=now)
+                for lookup_id, rows in fetched.items()])
+
+    def lookup(self, lookups):
+        """
+        Take a dict of lookup name ('demographics', 'clinicians' or
+        'diagnosis') to a list of IDs. Return a dict of lookup name to a dict
+        of ID to the LabKey rows for that ID, or to None if the lookup does
+        not apply to this sample type. IDs not in the cache are fetched from
+        LabKey in concurrent chunks and cached.
+        """
+        results = {}
+        chunks = []
+        for lookup, ids in lookups.items():
+            query = self.get_query(lookup)
+            if query is None:
+                results[lookup] = None
+                continue
+            ids = set(str(lookup_id) for lookup_id in ids if lookup_id)
+            results[lookup] = self.read_cache(lookup, ids)
+            missing = sorted(ids - set(results[lookup]))
+            for start in range(0, len(missing), self.chunk_size):
+                chunks.append((lookup, query, missing[start:start + self.chunk_size]))
+
+        if chunks:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                futures = [
+                    (lookup, query, chunk, executor.submit(self.select_rows, *query, chunk))
+                    for lookup, query, chunk in chunks]
+                for lookup, query, chunk, future in futures:
+                    fetched = {lookup_id: [] for lookup_id in chunk}
+                    for row in future.result():
+                        lookup_id = str(row.get(query[2]))
+                        if lookup_id in fetched:
+                            fetched[lookup_id].append(row)
+                    self.write_cache(lookup, fetched)
+                    results[lookup].update(fetched)
+        return results
+
+    def get_rows(self, lookup, ids):
+        """
+        Return the LabKey rows of a single lookup as one list.
+        """
+        rows_by_id = self.lookup({lookup: ids})[lookup]
+        if rows_by_id is None:
+            return None
+        return [row for rows in rows_by_id.values() for row in rows]
+
+    def get_demographics(self, participant_ids):
+        return self.get_rows('demographics', participant_ids)
+
+    def get_clinicians(self, family_ids):
+        return self.get_rows('clinicians', family_ids)
+
     def get_diagnosis(self, participant_ids):
         # search in LabKey for recruited disease
-        if self.sample_type == 'raredisease':
-            query = ';'.join(participant_ids)
-            results = lk.query.select_rows(
-                server_context=self.server_context,
-                schema_name='gel_rare_diseases',
-                query_name='rare_diseases_diagnosis',
-                filter_array=[
-                    lk.query.QueryFilter('participant_identifiers_id', query, 'in')
-                ]
-            )
-            return results['rows']
+        return self.get_rows('diagnosis', participant_ids)
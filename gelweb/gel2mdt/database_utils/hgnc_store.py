@@ -0,0 +1,168 @@
+"""Copyright (c) 2018 Great Ormond Street Hospital for Children NHS Foundation
+Trust & Birmingham Women's and Children's NHS Foundation Trust
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import io
+import os
+import csv
+import sqlite3
+import datetime
+import threading
+from ..api_utils.poll_api import get_shared_session
+
+
+# the HGNC complete set, one tab-separated row per approved gene
+HGNC_COMPLETE_SET_URL = (
+    'https://storage.googleapis.com/public-download-files/hgnc/tsv/tsv/'
+    'hgnc_complete_set.txt')
+# name of the store in the gene_storage directory
+HGNC_STORE_FILENAME = 'hgnc_complete_set.sqlite3'
+
+
+class HGNCStore(object):
+    """
+    Local, indexed copy of the HGNC complete set, mapping Ensembl gene IDs
+    to HGNC IDs and symbols so that genes can be resolved without polling
+    genenames.org.
+
+    The store is an SQLite database in gene_storage, filled from the HGNC
+    complete set download by the refresh_hgnc management command. The whole
+    mapping is small, so it is read into memory on first use and every
+    lookup after that is a dict access.
+
+    Attributes:
+        path (str): location of the SQLite database.
+        db (sqlite3.Connection): connection to the database, shared between
+            threads under lock.
+        genes (dict): k-v pairing of Ensembl gene ID and (HGNC ID, symbol),
+            loaded on first use.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS hgnc_gene ("
+            "ensembl_id TEXT PRIMARY KEY, "
+            "hgnc_id TEXT NOT NULL, "
+            "symbol TEXT NOT NULL)")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS hgnc_release ("
+            "loaded_at TEXT NOT NULL, "
+            "source TEXT NOT NULL, "
+            "gene_count INTEGER NOT NULL)")
+        self.db.commit()
+        self.genes = None
+
+    @staticmethod
+    def parse_complete_set(lines):
+        """
+        Read the rows of the HGNC complete set which have an Ensembl gene ID.
+        HGNC IDs are returned without their "HGNC:" prefix, as stored in
+        the Gene table.
+        :return: Generator of (ensembl_id, hgnc_id, symbol) tuples
+        """
+        reader = csv.DictReader(lines, delimiter='\t')
+        for row in reader:
+            ensembl_id = (row.get('ensembl_gene_id') or '').strip()
+            hgnc_id = (row.get('hgnc_id') or '').strip()
+            if not ensembl_id or not hgnc_id:
+                continue
+            if row.get('status') and row['status'] != 'Approved':
+                continue
+            if hgnc_id.startswith('HGNC:'):
+                hgnc_id = hgnc_id.split(':')[1]
+            yield ensembl_id, hgnc_id, row['symbol']
+
+    def load(self, lines, source):
+        """
+        Replace the contents of the store with the genes in an iterable of
+        lines of the HGNC complete set. The old genes are kept if the new set
+        is empty.
+        :return: The number of genes loaded
+        """
+        genes = list(self.parse_complete_set(lines))
+        if not genes:
+            raise ValueError('No genes found in {}'.format(source))
+        with self.lock:
+            with self.db:
+                self.db.execute("DELETE FROM hgnc_gene")
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO hgnc_gene (ensembl_id, hgnc_id, symbol) "
+                    "VALUES (?, ?, ?)", genes)
+                self.db.execute(
+                    "INSERT INTO hgnc_release (loaded_at, source, gene_count) "
+                    "VALUES (?, ?, ?)",
+                    (datetime.datetime.now().isoformat(), source, len(genes)))
+            self.genes = None
+        return len(genes)
+
+    def refresh(self, url=HGNC_COMPLETE_SET_URL):
+        """
+        Download the HGNC complete set and load it into the store.
+        :return: The number of genes loaded
+        """
+        response = get_shared_session().get(url, timeout=300)
+        response.raise_for_status()
+        response.encoding = 'utf-8'
+        return self.load(io.StringIO(response.text), url)
+
+    def last_release(self):
+        """
+        Return (loaded_at, source, gene_count) for the last load of the store,
+        or None if it has never been loaded.
+        """
+        with self.lock:
+            return self.db.execute(
+                "SELECT loaded_at, source, gene_count FROM hgnc_release "
+                "ORDER BY loaded_at DESC LIMIT 1").fetchone()
+
+    def get_genes(self):
+        """
+        Return the in-memory mapping of Ensembl gene ID to (HGNC ID, symbol),
+        reading it from the database on first use.
+        """
+        with self.lock:
+            if self.genes is None:
+                self.genes = {
+                    ensembl_id: (hgnc_id, symbol)
+                    for ensembl_id, hgnc_id, symbol
+                    in self.db.execute(
+                        "SELECT ensembl_id, hgnc_id, symbol FROM hgnc_gene")}
+            return self.genes
+
+    def is_empty(self):
+        return not self.get_genes()
+
+    def resolve(self, ensembl_ids):
+        """
+        Resolve a list of Ensembl gene IDs in one pass.
+        :return: Dict of Ensembl gene ID to (HGNC ID, symbol) for each ID
+            which is in the store
+        """
+        genes = self.get_genes()
+        return {
+            ensembl_id: genes[ensembl_id]
+            for ensembl_id in ensembl_ids
+            if ensembl_id in genes}
+
+    def close(self):
+        with self.lock:
+            self.db.close()
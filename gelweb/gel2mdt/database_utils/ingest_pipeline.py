@@ -0,0 +1,294 @@
+"""Copyright (c) 2018 Great Ormond Street Hospital for Children NHS Foundation
+Trust & Birmingham Women's and Children's NHS Foundation Trust
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import queue
+import logging
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from ..models import *
+from tqdm import tqdm
+
+logger = logging.getLogger(__name__)
+
+# passed along a queue once a stage has handed on all of its cases
+END_OF_CASES = object()
+
+
+class IngestPipeline(object):
+    """
+    Runs a MultipleCaseAdder update as four stages - fetch, parse, annotate
+    and write - which hand cases to each other through queues. The first
+    three run in background threads while the write stage runs in the
+    thread which calls run(), so all four work at the same time. The
+    fetch stage takes a slot from a semaphore of high_water_mark slots
+    before polling each case, and the slot is only given back once the case
+    has been written, skipped as unchanged or has failed. No more than
+    high_water_mark cases are therefore held by all of the stages together,
+    however many are polled, and the update runs at the pace of its slowest
+    stage rather than the sum of all of them.
+
+    A batch must fit within the high-water mark, so batch_size is capped at
+    high_water_mark. For the annotate stage to fill a batch while the
+    previous one is written, batch_size should be at most half of it.
+
+    Attributes:
+        case_adder (MultipleCaseAdder): the case adder whose managers,
+            settings and database methods are used by each stage.
+        high_water_mark (int): the maximum number of cases held by the
+            pipeline at once.
+        batch_size (int): the number of cases annotated and written to the
+            database together, no more than high_water_mark.
+        slots (threading.Semaphore): one slot per case which may be held.
+        fetched (queue.Queue): futures of polled case jsons, in poll order.
+        parsed (queue.Queue): tuples of Case and whether it is an update.
+        annotated (queue.Queue): tuples of a batch of parsed cases and the
+            traceback of their annotation, or None if it succeeded.
+        stop (threading.Event): set when a stage fails, so that the other
+            stages stop rather than wait on a full or empty queue.
+        errors (list): tracebacks of the stages which failed.
+        unchanged (list): tuples of request ID and json hash of the cases
+            found unchanged by the parse stage, waiting for the write stage
+            to record their sync state.
+    """
+    def __init__(self, case_adder, high_water_mark=200, batch_size=100):
+        self.case_adder = case_adder
+        self.high_water_mark = high_water_mark
+        # a larger batch could never be filled without going over the mark
+        self.batch_size = min(batch_size, high_water_mark)
+        self.slots = threading.Semaphore(high_water_mark)
+
+        # the queues need no bound of their own, since every case in them
+        # holds a slot
+        self.fetched = queue.Queue()
+        self.parsed = queue.Queue()
+        self.annotated = queue.Queue()
+        self.stop = threading.Event()
+        self.errors = []
+        self.unchanged = []
+        self.unchanged_lock = threading.Lock()
+
+        self.family_ids = set()
+        self.latest_hashes = {}
+
+    def run(self, cases_to_poll):
+        """
+        Run every stage over a list of case dicts from InterpretationList,
+        writing to the database in this thread while the other stages run in
+        background threads.
+        """
+        # snapshot of the database used by the parse stage to decide whether
+        # each case is new, updated or unchanged
+        self.family_ids = set(
+            InterpretationReportFamily.objects.values_list(
+                'ir_family_id', flat=True))
+        self.latest_hashes = dict(
+            GELInterpretationReport.objects.latest_cases_by_sample_type(
+                sample_type=self.case_adder.sample_type
+            ).values_list('ir_family__ir_family_id', 'sha_hash'))
+
+        stages = [
+            threading.Thread(
+                target=self.run_stage,
+                args=(self.fetch, self.fetched, cases_to_poll),
+                name="fetch"),
+            threading.Thread(
+                target=self.run_stage,
+                args=(self.parse, self.parsed),
+                name="parse"),
+            threading.Thread(
+                target=self.run_stage,
+                args=(self.annotate, self.annotated),
+                name="annotate"),
+        ]
+        for stage in stages:
+            stage.daemon = True
+            stage.start()
+
+        try:
+            self.write()
+        except Exception:
+            self.stop.set()
+            raise
+        finally:
+            for stage in stages:
+                stage.join()
+
+        if self.errors:
+            raise Exception(
+                "Ingest pipeline failed:\n" + "\n".join(self.errors))
+
+    def run_stage(self, stage, output_queue, *args):
+        """
+        Run a stage, then tell the next stage that no more cases will come.
+        If the stage fails, every other stage is stopped.
+        """
+        try:
+            stage(*args)
+        except Exception:
+            error = traceback.format_exc()
+            print(error)
+            self.errors.append(error)
+            self.stop.set()
+        finally:
+            self.put(output_queue, END_OF_CASES)
+
+    def put(self, stage_queue, item):
+        """
+        Put an item on a queue, waiting while it is full unless the pipeline
+        has been stopped.
+        """
+        while not self.stop.is_set():
+            try:
+                stage_queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def acquire_slot(self):
+        """
+        Wait for a free slot for one more case, returning False if the
+        pipeline is stopped first.
+        """
+        while not self.stop.is_set():
+            if self.slots.acquire(timeout=1):
+                return True
+        return False
+
+    def release_slots(self, count=1):
+        for _ in range(count):
+            self.slots.release()
+
+    def iterate(self, stage_queue):
+        """
+        Yield items from a queue until the previous stage has finished or the
+        pipeline has been stopped.
+        """
+        while not self.stop.is_set():
+            try:
+                item = stage_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            if item is END_OF_CASES:
+                return
+            yield item
+
+    def fetch(self, cases_to_poll):
+        """
+        Poll the CIP API for each case using the case adder's worker threads.
+        Each case takes a slot before it is polled, so polling pauses
+        whenever the high-water mark is reached.
+        """
+        case_adder = self.case_adder
+        with ThreadPoolExecutor(max_workers=case_adder.workers) as executor:
+            for case in cases_to_poll:
+                if not self.acquire_slot():
+                    break
+                self.put(self.fetched, (case, executor.submit(
+                    case_adder.poll_case_json, case)))
+
+    def parse(self):
+        """
+        Build a Case from each polled json, using the case adder's process
+        pool if it has one, and pass on the new and updated cases. Unchanged
+        cases are dropped here so they are never annotated, keeping only
+        their hash so the write stage can record their sync state.
+        """
+        case_adder = self.case_adder
+        polled_cases = self.iterate(self.fetched)
+        # cases which fail to fetch or parse give their slots back
+        for case, c in case_adder.build_cases(
+                polled_cases, on_failed=lambda case: self.release_slots()):
+            if c.request_id not in self.family_ids:
+                self.put(self.parsed, (c, False))
+            elif self.latest_hashes.get(c.request_id) != c.json_hash:
+                self.put(self.parsed, (c, True))
+            else:
+                case_adder.cases_to_skip.append(c.request_id)
+                with self.unchanged_lock:
+                    self.unchanged.append((c.request_id, c.json_hash))
+                self.release_slots()
+
+    def annotate(self):
+        """
+        Collect parsed cases into batches of batch_size and annotate each
+        batch. A batch which fails to annotate is still passed on with its
+        traceback so the failure can be recorded.
+        """
+        batch = []
+        for item in self.iterate(self.parsed):
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                self.annotate_batch(batch)
+                batch = []
+        if batch and not self.stop.is_set():
+            self.annotate_batch(batch)
+
+    def annotate_batch(self, batch):
+        error = None
+        try:
+            self.case_adder.annotate_cases([case for case, update in batch])
+        except Exception as e:
+            print("Encountered error:", e)
+            error = traceback.format_exc()
+            print(error)
+        self.put(self.annotated, (batch, error))
+
+    def write(self):
+        """
+        Write each annotated batch to the database with the case adder,
+        recording each batch as a ListUpdate, along with the sync state of
+        the cases found unchanged so far.
+        """
+        case_adder = self.case_adder
+        batch_count = 1
+        for batch, error in self.iterate(self.annotated):
+            print("Writing batch", batch_count, "of", len(batch), "cases")
+            case_adder.list_of_cases = [case for case, update in batch]
+            case_adder.cases_to_add = [
+                case for case, update in batch if not update]
+            case_adder.cases_to_update = [
+                case for case, update in batch if update]
+            if error:
+                case_adder.record_update(False, error, [], [])
+            else:
+                case_adder.update_database(annotate=False)
+            batch_count += 1
+            # drop the batch before its slots are reused
+            case_adder.list_of_cases = []
+            case_adder.cases_to_add = []
+            case_adder.cases_to_update = []
+            self.release_slots(len(batch))
+            batch = None
+            self.record_unchanged()
+        if not self.stop.is_set():
+            self.record_unchanged()
+
+    def record_unchanged(self):
+        """
+        Record the sync state of the cases found unchanged since the last
+        call, so they are not polled again by the next update.
+        """
+        with self.unchanged_lock:
+            unchanged, self.unchanged = self.unchanged, []
+        if unchanged:
+            self.case_adder.record_sync_state(unchanged)
@@ -22,12 +22,23 @@ SOFTWARE.
 import os
 import traceback
 import json
+import functools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
+from django.db import connections
+from django.db.models import Q
 from ..models import *
-from ..api_utils.poll_api import PollAPI
+from ..api_utils.poll_api import PollAPI, get_credentials
 from ..api_utils.cip_utils import InterpretationList
 from ..vep_utils.run_vep_batch import generate_transcripts
-from .case_handler import Case, CaseAttributeManager
+from .case_handler import Case, CaseAttributeManager, hash_case_json, parse_case
+from .natural_keys import NaturalKeyResolver
+from .upsert import BulkUpserter
+from .stage_scheduler import StageScheduler
+from .ingest_pipeline import IngestPipeline
+from .case_storage import CaseStorage
+from .hgnc_store import HGNCStore, HGNC_STORE_FILENAME
 from ..config import load_config
 import pprint
 import logging
@@ -48,7 +59,8 @@ class MultipleCaseAdder(object):
     """
     def __init__(self, sample_type, head=None, test_data=False,
                  skip_demographics=False, sample=None, pullt3=True,
-                 bins=None):
+                 workers=None, high_water_mark=None, batch_size=None,
+                 parse_processes=None):
         """
         Initiliase an instance of a MultipleCaseAdder to start managing
         a database update. This will get the list of cases available to
@@ -57,6 +69,17 @@ class MultipleCaseAdder(object):
         :param test_data: Boolean. Use test data or not. Default = False
         :param sample: If you want to add a single sample, set this the GELID
         :param pullt3: Boolean to pull t3 variants
+        :param workers: Number of cases to fetch from the CIP API at once.
+            Defaults to cip_api_workers in the config file, or 1.
+        :param high_water_mark: Maximum number of cases held by the ingest
+            pipeline at once. Defaults to ingest_high_water_mark in the
+            config file, or 200.
+        :param batch_size: Number of cases annotated and written to the
+            database together, capped at high_water_mark. Defaults to
+            ingest_batch_size in the config file, or 100.
+        :param parse_processes: Number of processes used to parse case jsons
+            and extract their variants. Defaults to case_parse_processes in
+            the config file, or 1 to parse in this process.
         """
         print("Initialising a MultipleCaseAdder.")
 
@@ -76,6 +99,39 @@ class MultipleCaseAdder(object):
         self.pullt3 = pullt3
         # get the config file for datadumps
         self.config = load_config.LoadConfig().load()
+        # how many cases to fetch from the CIP API concurrently
+        if workers is None:
+            workers = self.config.get_int('cip_api_workers', 1)
+        self.workers = max(int(workers), 1)
+        # cases which could not be fetched, reported without stopping the update
+        self.failed_cases = []
+        # cases skipped as unchanged since they were last synced
+        self.unchanged_cases = []
+        # InterpretationList case dicts by request ID, built when first used
+        self.poll_metadata = None
+        # archive of case jsons in cip_api_storage, opened when first used
+        self._case_storage = None
+        # bounds on the number of cases held in memory by the ingest pipeline
+        if high_water_mark is None:
+            high_water_mark = self.config.get_int('ingest_high_water_mark', 200)
+        self.high_water_mark = max(int(high_water_mark), 1)
+        if batch_size is None:
+            batch_size = self.config.get_int('ingest_batch_size', 100)
+        self.batch_size = max(int(batch_size), 1)
+        # parse cases in a process pool if more than one process is given
+        if parse_processes is None:
+            parse_processes = self.config.get_int('case_parse_processes', 1)
+        self.parse_processes = max(int(parse_processes), 1)
+        # forked by start_parse_pool() before any other threads start
+        self.parse_pool = None
+        # rows per INSERT when writing new entries to the database
+        self.upsert_batch_size = max(
+            self.config.get_int('upsert_batch_size', 500), 1)
+        # stream the largest variant tables with COPY on PostgreSQL
+        self.postgres_copy = self.config.get_bool('postgres_copy', True)
+        # how many model stages of add_cases to write at once
+        self.stage_workers = max(
+            self.config.get_int('ingest_stage_workers', 1), 1)
 
         # instantiate a PanelManager for the Case classes to use
         self.panel_manager = PanelManager()
@@ -95,11 +151,17 @@ class MultipleCaseAdder(object):
             self.cases_to_skip = []
             self.update_database()
         elif sample:
+            # the fetch threads cannot prompt for credentials
+            get_credentials(self.config)
             interpretation_list_poll = InterpretationList(sample_type=sample_type, sample=sample)
             self.cases_to_poll = interpretation_list_poll.cases_to_poll
             self.blocked_cases = interpretation_list_poll.blocked_cases
             self.block_cases()
-            self.list_of_cases = self.fetch_api_data()
+            self.start_parse_pool()
+            try:
+                self.list_of_cases = self.fetch_api_data()
+            finally:
+                self.stop_parse_pool()
             self.cases_to_update = self.list_of_cases
             print(self.cases_to_update)
             self.cases_to_add = []
@@ -109,6 +171,8 @@ class MultipleCaseAdder(object):
             # set list_of_cases to cases of interest from API
             print("Fetching live API data.")
             print("Polling for list of available cases...")
+            # the page and fetch threads cannot prompt for credentials
+            get_credentials(self.config)
             interpretation_list_poll = InterpretationList(sample_type=sample_type)
             self.blocked_cases = interpretation_list_poll.blocked_cases
             self.block_cases()
@@ -118,74 +182,40 @@ class MultipleCaseAdder(object):
             print("Determining which cases to poll...")
             # reverse update, do the newest first!
             self.total_cases_to_poll = interpretation_list_poll.cases_to_poll[::-1]
+            print("Checking which cases have changed since last update...")
+            self.total_cases_to_poll = self.filter_unchanged_cases(
+                self.total_cases_to_poll)
+            print("Skipping", len(self.unchanged_cases), "unchanged cases")
             if head:
                 self.total_cases_to_poll = self.total_cases_to_poll[:head]
             self.num_cases_to_poll = len(self.total_cases_to_poll)
 
-            if bins:
-                bin_size = int(bins)
-                print("bin size", bin_size)
-                # work out how many hundreds in fetched cases
-                num_full_bins = self.num_cases_to_poll // bin_size
-
-                bin_ranges = []
-                for i in range(num_full_bins):
-                    bin_ranges.append(
-                        [
-                            (bin_size * i),            # e.g 0, 100
-                            (bin_size * i) + bin_size  # e.g 100, 200 - SLICE so not inclusive
-                        ]
-                    )   # [0, 100], [100, 200] etc
-                bin_ranges.append([num_full_bins * bin_size, None])
-                print("bin ranges", bin_ranges)
-
-                bin_count = 1
-                for b in bin_ranges:
-                    print("Fetching cases", b[0], "to", b[1], "(bin", bin_count, "of", str(len(bin_ranges)) + ")")
-                    self.cases_to_poll = self.total_cases_to_poll[b[0]: b[1]]
-
-                    print("Fetching API JSON data for cases to poll...")
-                    self.list_of_cases = self.fetch_api_data()
-                    if head:
-                        # take a certain number of cases off the top
-                        self.list_of_cases = self.list_of_cases[:head]
-                    print("Fetched all required CIP API data.")
-                    print("Checking which cases to add.")
-                    self.cases_to_add = self.check_cases_to_add()
-                    print("Checking which cases require updating.")
-                    self.cases_to_update = self.check_cases_to_update()
-                    self.cases_to_skip = set(self.list_of_cases) - \
-                        set(self.cases_to_add) - \
-                        set(self.cases_to_update)
-                    self.update_database()
-
-                    for case in self.cases_to_add:
-                        del case
-                    for case in self.cases_to_update:
-                        del case
-
-                    bin_count += 1
+            # fetch, parse, annotate and write cases concurrently, holding
+            # a bounded number of cases in memory at once
+            self.cases_to_poll = self.total_cases_to_poll
+            # request IDs of cases the pipeline found unchanged after polling
+            self.cases_to_skip = []
+            print("Running ingest pipeline for", self.num_cases_to_poll, "cases")
+            pipeline = IngestPipeline(
+                self,
+                high_water_mark=self.high_water_mark,
+                batch_size=self.batch_size)
+            self.start_parse_pool()
+            try:
+                pipeline.run(self.cases_to_poll)
+            finally:
+                self.stop_parse_pool()
+
+    @property
+    def case_storage(self):
+        """
+        The CaseStorage archive in the cip_api_storage directory.
+        """
+        if self._case_storage is None:
+            self._case_storage = CaseStorage(self.config['cip_api_storage'])
+        return self._case_storage
 
-            else:
-                # no bins, update as normal
-                print("Fetching all cases.")
-                self.cases_to_poll = self.total_cases_to_poll
-                print("Fetching API JSON data for cases to poll...")
-                self.list_of_cases = self.fetch_api_data()
-                if head:
-                    # take a certain number of cases off the top
-                    self.list_of_cases = self.list_of_cases[:head]
-                print("Fetched all required CIP API data.")
-                print("Checking which cases to add.")
-                self.cases_to_add = self.check_cases_to_add()
-                print("Checking which cases require updating.")
-                self.cases_to_update = self.check_cases_to_update()
-                self.cases_to_skip = set(self.list_of_cases) - \
-                    set(self.cases_to_add) - \
-                    set(self.cases_to_update)
-                self.update_database()
-
-    def update_database(self):
+    def update_database(self, annotate=True):
         # begin update process
         # --------------------
         error = None
@@ -194,9 +224,13 @@ class MultipleCaseAdder(object):
         try:
             logger.info("Adding cases from cases_to_add.")
             print("Adding", len(self.cases_to_add), "cases")
-            added_cases = self.add_cases()
+            added_cases = self.add_cases(annotate=annotate)
             print("Updating", len(self.cases_to_update), "cases")
-            updated_cases = self.add_cases(update=True)
+            updated_cases = self.add_cases(update=True, annotate=annotate)
+            if self.cases_to_poll:
+                self.record_sync_state([
+                    (case.request_id, case.json_hash)
+                    for case in self.list_of_cases])
             success = True
         except Exception as e:
             print("Encountered error:", e)
@@ -205,20 +239,25 @@ class MultipleCaseAdder(object):
             success = False
         finally:
             print("Recording update")
-            # record the update in ListUpdate
-            listupdate = ListUpdate.objects.create(
-                update_time=timezone.now(),
-                success=success,
-                cases_added=len(self.cases_to_add),
-                cases_updated=len(self.cases_to_update),
-                sample_type=self.sample_type,
-                error=error
-            )
-            listupdate.reports_added.add(*added_cases)
-            listupdate.reports_updated.add(*updated_cases)
+            self.record_update(success, error, added_cases, updated_cases)
 
             # Add in case alert
 
+    def record_update(self, success, error, added_cases, updated_cases):
+        """
+        Record an update of cases_to_add and cases_to_update in ListUpdate.
+        """
+        listupdate = ListUpdate.objects.create(
+            update_time=timezone.now(),
+            success=success,
+            cases_added=len(self.cases_to_add),
+            cases_updated=len(self.cases_to_update),
+            sample_type=self.sample_type,
+            error=error
+        )
+        listupdate.reports_added.add(*added_cases)
+        listupdate.reports_updated.add(*updated_cases)
+
     def fetch_test_data(self):
         """
         This will run and convert our test data to a list of jsons if
@@ -249,31 +288,206 @@ class MultipleCaseAdder(object):
         return list_of_cases
 
     def fetch_api_data(self):
+        """
+        Fetch the JSON for each case in self.cases_to_poll from the CIP API
+        using self.workers threads, which share one session and token. Cases
+        are returned in the order of self.cases_to_poll. A case which cannot
+        be fetched or parsed is reported and added to self.failed_cases
+        rather than stopping the update.
+        """
         list_of_cases = []
-        # list comprehension, calling self.get_case_json each time for poll
-        for case in tqdm(self.cases_to_poll):
-            tqdm.write("Polling for: {case}".format(case=case["interpretation_request_id"]))
-
-            c = Case(
-                # instatiate a new case with the polled json
-                case_json=self.get_case_json(case["interpretation_request_id"]),
-                panel_manager=self.panel_manager,
-                variant_manager=self.variant_manager,
-                gene_manager=self.gene_manager,
-                skip_demographics=self.skip_demographics,
-                pullt3=self.pullt3
-            )
-            list_of_cases.append(c)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [
+                executor.submit(self.poll_case_json, case)
+                for case in self.cases_to_poll]
+
+            # collect in submission order so newest cases stay first
+            for case, c in tqdm(self.build_cases(zip(self.cases_to_poll, futures)),
+                                total=len(futures)):
+                list_of_cases.append(c)
 
         print("Successfully fetched", len(list_of_cases), "cases from CIP API.")
+        if self.failed_cases:
+            print("Failed to fetch", len(self.failed_cases), "cases:",
+                  ", ".join(self.failed_cases))
         return list_of_cases
 
+    def start_parse_pool(self):
+        """
+        Fork the process pool used by build_cases if parse_processes is more
+        than 1. Forking a process while other threads hold locks is unsafe,
+        so this is called from the main thread before the fetch and pipeline
+        threads start. The database connections are closed first so that the
+        workers do not inherit them; Django reopens them when next used.
+        """
+        if self.parse_processes == 1 or self.parse_pool is not None:
+            return
+        connections.close_all()
+        self.parse_pool = ProcessPoolExecutor(max_workers=self.parse_processes)
+        # workers are forked as tasks are submitted, so start them all now
+        list(self.parse_pool.map(abs, range(self.parse_processes)))
+
+    def stop_parse_pool(self):
+        if self.parse_pool is not None:
+            self.parse_pool.shutdown()
+            self.parse_pool = None
+
+    def build_case(self, case_json, raw_content=None, parsed=None):
+        """
+        Instantiate a new Case from a polled case json and the raw content it
+        was decoded from, along with the fields parse_case parsed from it if
+        it went through the process pool.
+        """
+        return Case(
+            case_json=case_json,
+            raw_content=raw_content,
+            panel_manager=self.panel_manager,
+            variant_manager=self.variant_manager,
+            gene_manager=self.gene_manager,
+            skip_demographics=self.skip_demographics,
+            pullt3=self.pullt3,
+            parsed=parsed
+        )
+
+    def build_cases(self, polled_cases, on_failed=None):
+        """
+        Build Cases from an iterable of case dicts and futures of their
+        polled jsons, yielding tuples of case dict and Case in the same
+        order. If the process pool has been started by start_parse_pool(),
+        up to parse_processes cases are parsed in it at once; otherwise each
+        case is parsed in this process. A case which could not be fetched or
+        parsed is reported and added to self.failed_cases, then skipped.
+        :param on_failed: optional function called with the case dict of
+            each skipped case
+        """
+        pool = self.parse_pool
+        in_flight = deque()
+        for case, future in polled_cases:
+            tqdm.write("Polling for: {case}".format(
+                case=case["interpretation_request_id"]))
+            try:
+                case_json, raw_content = future.result()
+            except Exception as e:
+                self.report_failed_case(case, e)
+                if on_failed is not None:
+                    on_failed(case)
+                continue
+
+            parse_future = None
+            if pool is not None:
+                parse_future = pool.submit(parse_case, case_json, self.pullt3)
+            in_flight.append((case, case_json, raw_content, parse_future))
+
+            if len(in_flight) >= self.parse_processes:
+                built = self.finish_case(*in_flight.popleft(), on_failed=on_failed)
+                if built:
+                    yield built
+        while in_flight:
+            built = self.finish_case(*in_flight.popleft(), on_failed=on_failed)
+            if built:
+                yield built
+
+    def finish_case(self, case, case_json, raw_content, parse_future,
+                    on_failed=None):
+        """
+        Return a tuple of case dict and Case, either parsing the case json
+        here or building the Case from the fields parsed in the process pool.
+        If parsing failed, the case is reported, passed to on_failed and None
+        is returned.
+        """
+        try:
+            parsed = None
+            if parse_future is not None:
+                parsed = parse_future.result()
+            c = self.build_case(case_json, raw_content, parsed=parsed)
+        except Exception as e:
+            self.report_failed_case(case, e)
+            if on_failed is not None:
+                on_failed(case)
+            return None
+        return case, c
+
+    def report_failed_case(self, case, error):
+        """
+        Report a case which could not be fetched or parsed.
+        """
+        interpretation_request_id = case["interpretation_request_id"]
+        tqdm.write("Failed to fetch {case}: {error}".format(
+            case=interpretation_request_id, error=error))
+        logger.error(traceback.format_exc())
+        self.failed_cases.append(interpretation_request_id)
+
+    def filter_unchanged_cases(self, cases_to_poll):
+        """
+        Remove cases whose InterpretationList metadata matches their
+        CaseSyncState and whose latest report in the database still has the
+        synced hash, so their full JSON is never downloaded. If the metadata
+        matches but the database has since changed, the case is kept and
+        marked to be loaded from the stored copy in the cip_api_storage archive
+        instead of polling the CIP API.
+        :param cases_to_poll: list of case dicts from InterpretationList
+        :returns: list of case dicts which need fetching
+        """
+        sync_states = {
+            state.interpretation_request_id: state
+            for state in CaseSyncState.objects.filter(
+                sample_type=self.sample_type)
+        }
+        latest_hashes = dict(
+            GELInterpretationReport.objects.latest_cases_by_sample_type(
+                sample_type=self.sample_type
+            ).values_list('ir_family__ir_family_id', 'sha_hash')
+        )
+
+        self.unchanged_cases = []
+        cases_to_fetch = []
+        for case in cases_to_poll:
+            interpretation_request_id = case["interpretation_request_id"]
+            state = sync_states.get(interpretation_request_id)
+            if state is None or not state.matches(case):
+                cases_to_fetch.append(case)
+                continue
+            if latest_hashes.get(interpretation_request_id) == state.sha_hash:
+                self.unchanged_cases.append(interpretation_request_id)
+                continue
+            if state.archived_version is not None and self.case_storage.contains(
+                    interpretation_request_id, state.archived_version):
+                case = dict(
+                    case, archived_version=state.archived_version,
+                    sha_hash=state.sha_hash)
+            cases_to_fetch.append(case)
+
+        return cases_to_fetch
+
+    def poll_case_json(self, case):
+        """
+        Get the json for a case dict from InterpretationList. If the case
+        was marked by filter_unchanged_cases, the stored copy is used as long
+        as it still has the synced hash; otherwise the CIP API is polled.
+        :param case: case dict from InterpretationList
+        :returns: tuple of the case json and the raw content it was decoded
+            from
+        """
+        if case.get("archived_version") is not None:
+            try:
+                raw_content = self.case_storage.read(
+                    case["interpretation_request_id"], case["archived_version"])
+                if raw_content is not None:
+                    case_json = json.loads(raw_content.decode('utf-8'))
+                    if hash_case_json(case_json) == case["sha_hash"]:
+                        return case_json, raw_content
+            except (IOError, ValueError):
+                pass
+        return self.get_case_json(case["interpretation_request_id"])
+
     def get_case_json(self, interpretation_request_id):
         """
         Take an interpretation request ID, then get the json for that case
         using the PollAPI class defined in .database_utils
         :param interpretation_request_id: an IR ID of the format XXXX-X
-        :returns: A case json associated with the given IR ID from CIP-API
+        :returns: tuple of the case json associated with the given IR ID from
+            CIP-API and the raw response content it was decoded from
         """
         request_poll = PollAPI(
             # instantiate a poll of CIP API for a given case json
@@ -281,7 +495,58 @@ class MultipleCaseAdder(object):
                 id=interpretation_request_id.split("-")[0],
                 version=interpretation_request_id.split("-")[1]))
         response = request_poll.get_json_response()
-        return response
+        return response, request_poll.response_content
+
+    def record_sync_state(self, synced_cases):
+        """
+        Save the InterpretationList metadata for each fetched case whose
+        latest report in the database matches its hash, so the case can be
+        skipped by filter_unchanged_cases until it changes in the CIP API.
+        Only the reports of the given cases are looked up, and their
+        CaseSyncStates are written with one upsert.
+        :param synced_cases: list of tuples of request ID and the hash of
+            the case json
+        """
+        if self.poll_metadata is None:
+            self.poll_metadata = {
+                case["interpretation_request_id"]: case
+                for case in self.cases_to_poll
+            }
+        request_ids = [request_id for request_id, json_hash in synced_cases]
+        latest_reports = {
+            ir_family_id: (sha_hash, archived_version)
+            for ir_family_id, sha_hash, archived_version
+            in GELInterpretationReport.objects.filter(
+                ir_family__ir_family_id__in=request_ids
+            ).latest_versions().values_list(
+                'ir_family__ir_family_id', 'sha_hash', 'archived_version')
+        }
+
+        synced_at = timezone.now()
+        sync_states = []
+        for request_id, json_hash in synced_cases:
+            metadata = self.poll_metadata.get(request_id)
+            sha_hash, archived_version = latest_reports.get(
+                request_id, (None, None))
+            if metadata is None or sha_hash != json_hash:
+                continue
+            sync_states.append({
+                "interpretation_request_id": request_id,
+                "sample_type": self.sample_type,
+                "last_status": metadata["last_status"],
+                "last_modified": metadata.get("last_modified"),
+                "sha_hash": json_hash,
+                "archived_version": archived_version,
+                "synced_at": synced_at,
+            })
+
+        upserter = BulkUpserter(
+            CaseSyncState, NaturalKeyResolver(CaseSyncState),
+            batch_size=self.upsert_batch_size,
+            update_fields=(
+                "sample_type", "last_status", "last_modified", "sha_hash",
+                "archived_version", "synced_at"))
+        upserter.upsert(sync_states)
 
     def check_cases_to_add(self):
         """
@@ -351,182 +616,211 @@ class MultipleCaseAdder(object):
                 report.save(overwrite=True)
 
 
-    def add_cases(self, update=False):
+    def add_cases(self, update=False, annotate=True):
         """
         Adds the cases to the database which required adding.
+        :param update: add cases_to_update rather than cases_to_add
+        :param annotate: run annotate_cases on the cases first. Set False if
+            they have already been annotated, e.g. by the IngestPipeline.
         """
-        update_order = (
-            # tuple of tuples to preserve update order. each sub-tuple is the
-            # key to access the attribute manager and whether is has many objs
-            (Clinician, False),
-            (Family, False),
-            (Phenotype, True),
-            (Panel, True),
-            (PanelVersion, True),
-            (Gene, True),
-            (ToolOrAssemblyVersion, True),
-            (Transcript, True),
-            (Variant, True),
-            (Proband, False),
-            (Relative, True),
-            (InterpretationReportFamily, False),
-            (InterpretationReportFamilyPanel, True),
-            (GELInterpretationReport, False),
-            (ProbandVariant, True),
-            (PVFlag, True),
-            (TranscriptVariant, True),
-            (ProbandTranscriptVariant, True),
-            (SVRegion, True),
-            (SV, True),
-            (ProbandSV, True),
-            (ProbandSVGene, True),
-            (STRVariant, True),
-            (ProbandSTR, True),
-            (ProbandSTRGene, True),
-            #(ReportEvent, True)
+        stages = (
+            # tuple of tuples, one per model. each sub-tuple is the key to
+            # access the attribute manager, whether it has many objs, and
+            # the models whose entries its CaseAttributeManager reads. a
+            # model is written as soon as those models have been written
+            (Clinician, False, ()),
+            (Family, False, (Clinician,)),
+            (Phenotype, True, ()),
+            (Panel, True, ()),
+            (PanelVersion, True, (Panel,)),
+            (Gene, True, (Panel,)),
+            (ToolOrAssemblyVersion, True, ()),
+            (Transcript, True, (ToolOrAssemblyVersion, Gene)),
+            (Variant, True, (ToolOrAssemblyVersion,)),
+            (Proband, False, (Family, Clinician)),
+            (Relative, True, (Proband,)),
+            (InterpretationReportFamily, False, (Family,)),
+            (InterpretationReportFamilyPanel, True, (InterpretationReportFamily, PanelVersion)),
+            (GELInterpretationReport, False, (InterpretationReportFamily, ToolOrAssemblyVersion, Proband, Variant)),
+            (ProbandVariant, True, (GELInterpretationReport, Proband, Variant)),
+            (PVFlag, True, (ProbandVariant,)),
+            (TranscriptVariant, True, (ToolOrAssemblyVersion, Transcript, Variant)),
+            (ProbandTranscriptVariant, True, (ProbandVariant, TranscriptVariant)),
+            (SVRegion, True, (ToolOrAssemblyVersion,)),
+            (SV, True, (SVRegion,)),
+            (ProbandSV, True, (SV, GELInterpretationReport)),
+            (ProbandSVGene, True, (Gene, ProbandSV, GELInterpretationReport)),
+            (STRVariant, True, (ToolOrAssemblyVersion,)),
+            (ProbandSTR, True, (STRVariant, GELInterpretationReport)),
+            (ProbandSTRGene, True, (Gene, ProbandSTR, GELInterpretationReport)),
+            #(ReportEvent, True, (ProbandVariant,))
         )
 
         if update:
             cases = self.cases_to_update
         elif not update:
             cases = self.cases_to_add
-        if cases:
-            # we need vep results for all cases, which needs to be done in batch
-            variants = []
-            case_id_map = {}
-            for case in cases:
-                # map case id to cases to easily assign transcripts from variant
-                case_id_map[case.request_id] = case
-                variants += case.variants
-
-            # fetch the transcripts and put them into TranscriptManager
-            transcripts = generate_transcripts(variants)
-            for transcript in transcripts:
-                case_id = transcript.case_id
-                case = case_id_map[case_id]
-                self.transcript_manager.add_transcript(transcript, case.tools_and_versions['genome_build'] )
-
-            # assign transcripts
-            i = 0
-            while i < len(transcripts):  # keep going until no transcripts left
-                transcript = transcripts.pop(0) # check to see if transcript already exists in transcript manager
-                case_id = transcript.case_id
-                case = case_id_map[case_id]
-                fetched_transcript = self.transcript_manager.fetch_transcript(transcript)
-                # Reassigning case details
-                transcript.transcript_canonical = fetched_transcript.transcript_canonical
-                transcript.gene_model = fetched_transcript.gene_model
-                # Append to case transcripts
-                case.transcripts.append(transcript)
-
-            # Labkey lookup for all cases
-            if not self.skip_demographics:
-                family_ids = []
-                participant_ids = []
-                demographic_handler = DemographicsHandler(self.sample_type)
-                if self.sample_type == 'raredisease':
-                    for case in cases:
-                        family_ids.append(case.json["family_id"])
-                        participant_ids.append(case.json["proband"])
-                        for family_member in case.family_members:
-                            participant_ids.append(family_member['gel_id'])
-                    demographics = demographic_handler.get_demographics(participant_ids)
-                    clinicians = demographic_handler.get_clinicians(family_ids)
-                    diagnosis = demographic_handler.get_diagnosis(participant_ids)
-                elif self.sample_type == 'cancer':
-                    for case in cases:
-                        participant_ids.append(case.json["proband"])
-                        for family_member in case.family_members:  # Shouldn't be any but just for futureproofing!
-                            participant_ids.append(family_member['gel_id'])
-                    demographics = demographic_handler.get_demographics(participant_ids)
-                    clinicians = demographic_handler.get_clinicians(participant_ids)
-                    diagnosis = None
+        if cases and annotate:
+            self.annotate_cases(cases)
 
-                for case in cases:
-                    case.demographics = demographics
-                    case.clinicians = clinicians
-                    case.diagnosis = diagnosis
+        # load the mirrored panels of every case in one query, rather than
+        # one query per case when the Panel stage is parsed
+        self.panel_manager.load_mirrored_panels([
+            (panel.panelName, panel.panelVersion)
+            for case in cases for panel in (case.panels or [])])
 
         # ------------------- #
         # BULK UPDATE PROCESS #
         # ------------------- #
-        for model_type, many in update_order:
-
-            # prefetch database entries for check_found_in_db()
-            lookups = self.get_prefetch_lookups(model_type)
-            if lookups:
-                model_objects = model_type.objects.all().values(*lookups)
-            elif not lookups:
-                model_objects = model_type.objects.all()
-            for case in tqdm(cases, desc="Parsing {model_type} into DB".format(model_type=model_type.__name__)):
-                # create a CaseAttributeManager for the case
-                tqdm.write(case.request_id)
-                case.attribute_managers[model_type] = CaseAttributeManager(
-                    case, model_type, model_objects)
-                # use thea attribute manager to set the case models
-                attribute_manager = case.attribute_managers[model_type]
-                attribute_manager.get_case_model()
-
-            if not many:
-                # get a list of CaseModels
-                model_list = [
-                    case.attribute_managers[model_type].case_model
-                    for case in cases
-                ]
-            elif many:
-                model_list = []
-                for case in tqdm(cases, desc="Parsing {model_type} into DB".format(model_type=model_type.__name__)):
-                    tqdm.write(case.request_id)
-                    attribute_manager = case.attribute_managers[model_type]
-                    many_case_model = attribute_manager.case_model
-                    for case_model in tqdm(many_case_model.case_models, desc=case.request_id):
-                        model_list.append(case_model)
-
-            # now create the required new Model instances from CaseModel lists
-            if model_type == GELInterpretationReport:
-                # GEL_IR is a special case, preprocessing version no. means
-                # Model.objects.bulk_create() is not available
-                self.save_new(model_type, model_list)
-            else:
-                print("attempting to bulk create", model_type)
-                self.bulk_create_new(model_type, model_list)
-
-            # refresh CaseAttributeManagers with new CaseModels
-            lookups = self.get_prefetch_lookups(model_type)
-            if lookups:
-                model_objects = model_type.objects.all().values(*lookups)
-            elif not lookups:
-                model_objects = model_type.objects.all()
-            for model in model_list:
-                if model.entry is False:
-                    model.check_found_in_db(model_objects)
-
-        # finally, save jsons to disk storage
-        cip_api_storage = self.config['cip_api_storage']
+        scheduler = StageScheduler(workers=self.stage_workers)
+        for model_type, many, dependencies in stages:
+            scheduler.add_stage(
+                model_type,
+                functools.partial(self.add_model, cases, model_type, many),
+                dependencies)
+        scheduler.run()
+
+        # finally, save jsons to the cip_api_storage archive
+        ir_families = [
+            case.attribute_managers[InterpretationReportFamily].case_model.entry
+            for case in cases]
+        latest_reports = {
+            report.ir_family_id: report
+            for report in GELInterpretationReport.objects.filter(
+                ir_family__in=ir_families).latest_versions()}
         case_reports = []
-        for case in cases:
-            ir_family = case.attribute_managers[InterpretationReportFamily].case_model.entry
-            latest_case = GELInterpretationReport.objects.filter(
-                ir_family=ir_family
-            ).latest('polled_at_datetime')
+        stored_cases = []
+        for case, ir_family in zip(cases, ir_families):
+            latest_case = latest_reports[ir_family.pk]
             case_reports.append(latest_case)
 
-            with open(
-                    os.path.join(
-                        cip_api_storage,
-                        '{}.json'.format(
-                            case.request_id + "-" + str(latest_case.archived_version)
-                        )), 'w') as f:
-                json.dump(case.raw_json, f)
+            # store the response exactly as it was received
+            content = case.raw_content
+            if content is None:
+                content = json.dumps(case.json).encode('utf-8')
+            stored_cases.append((
+                case.request_id, latest_case.archived_version, content,
+                case.json_hash))
+        self.case_storage.write_many(stored_cases)
         return case_reports
 
 
+    def add_model(self, cases, model_type, many):
+        """
+        Write the new entries of one model type for a list of cases, and set
+        the entry of every CaseModel of that type. Run as a stage of
+        add_cases once the models it depends on have been written.
+        """
+        # collect the natural keys of every case before looking them up
+        model_objects = NaturalKeyResolver(model_type)
+        for case in tqdm(cases, desc="Parsing {model_type} into DB".format(model_type=model_type.__name__)):
+            # create a CaseAttributeManager for the case, which sets the
+            # case models and registers them with the resolver
+            tqdm.write(case.request_id)
+            case.attribute_managers[model_type] = CaseAttributeManager(
+                case, model_type, model_objects)
+        model_objects.resolve()
+
+        if not many:
+            # get a list of CaseModels
+            model_list = [
+                case.attribute_managers[model_type].case_model
+                for case in cases
+            ]
+        elif many:
+            model_list = []
+            for case in tqdm(cases, desc="Parsing {model_type} into DB".format(model_type=model_type.__name__)):
+                tqdm.write(case.request_id)
+                attribute_manager = case.attribute_managers[model_type]
+                many_case_model = attribute_manager.case_model
+                for case_model in tqdm(many_case_model.case_models, desc=case.request_id):
+                    model_list.append(case_model)
+
+        # now create the required new Model instances from CaseModel lists
+        if model_type == GELInterpretationReport:
+            # GEL_IR is a special case, version numbers are worked out
+            # by GELInterpretationReport.objects.bulk_create_versions()
+            self.save_new(model_type, model_list)
+        else:
+            print("attempting to bulk create", model_type)
+            self.bulk_create_new(model_type, model_list, model_objects)
+
+        # refresh CaseAttributeManagers with new CaseModels
+        for model in model_list:
+            if model.entry is False:
+                model.check_found_in_db(model_objects)
+        model_objects.resolve()
+
+    def annotate_cases(self, cases):
+        """
+        Annotate a list of cases ready to be added to the database: run VEP
+        on their variants to set case.transcripts, and look up their
+        demographics, clinicians and diagnosis in LabKey.
+        """
+        # we need vep results for all cases, which needs to be done in batch
+        variants = []
+        case_id_map = {}
+        for case in cases:
+            # map case id to cases to easily assign transcripts from variant
+            case_id_map[case.request_id] = case
+            variants += case.variants
+
+        # fetch the transcripts and put them into TranscriptManager
+        transcripts = generate_transcripts(variants)
+        for transcript in transcripts:
+            case_id = transcript.case_id
+            case = case_id_map[case_id]
+            self.transcript_manager.add_transcript(transcript, case.tools_and_versions['genome_build'] )
+
+        # assign transcripts
+        for transcript in transcripts:
+            # check to see if transcript already exists in transcript manager
+            case_id = transcript.case_id
+            case = case_id_map[case_id]
+            fetched_transcript = self.transcript_manager.fetch_transcript(transcript)
+            # Reassigning case details
+            transcript.transcript_canonical = fetched_transcript.transcript_canonical
+            transcript.gene_model = fetched_transcript.gene_model
+            # Append to case transcripts
+            case.transcripts.append(transcript)
+
+        # Labkey lookup for all cases
+        if not self.skip_demographics:
+            family_ids = []
+            participant_ids = []
+            demographic_handler = DemographicsHandler(self.sample_type)
+            if self.sample_type == 'raredisease':
+                for case in cases:
+                    family_ids.append(case.json["family_id"])
+                    participant_ids.append(case.json["proband"])
+                    for family_member in case.family_members:
+                        participant_ids.append(family_member['gel_id'])
+            elif self.sample_type == 'cancer':
+                for case in cases:
+                    participant_ids.append(case.json["proband"])
+                    for family_member in case.family_members:  # Shouldn't be any but just for futureproofing!
+                        participant_ids.append(family_member['gel_id'])
+                # cancer registrations are looked up by participant
+                family_ids = participant_ids
+            # dicts of ID to the LabKey rows for that ID
+            labkey_rows = demographic_handler.lookup({
+                'demographics': participant_ids,
+                'clinicians': family_ids,
+                'diagnosis': participant_ids,
+            })
+
+            for case in cases:
+                case.demographics = labkey_rows['demographics']
+                case.clinicians = labkey_rows['clinicians']
+                case.diagnosis = labkey_rows['diagnosis']
+
     def save_new(self, model_type, model_list):
         """
         Takes a list of CaseModel isntances of a given type, then saves any
         that are new into the database. This function is for models such as
-        GELInterpretationReport which require preprocessing and so cannot be
-        bulk created (which does not call the object.save() function)
+        GELInterpretationReport which require preprocessing of the version
+        number, so they go through the model's bulk_create_versions rather
+        than a plain bulk_create.
         """
         # get the attribute dicts for ModelCases which have no database entry
         new_attributes = [
@@ -542,18 +836,17 @@ class MultipleCaseAdder(object):
                 for attribute_dict
                 in new_attributes])]
         # save database entries from the list of unique new attributes
+        model_type.objects.bulk_create_versions([
+            model_type(**attributes)
+            for attributes in new_attributes])
 
-
-        for attributes in new_attributes:
-            obj = model_type(**attributes)
-            obj.save()
-
-    def bulk_create_new(self, model_type, model_list):
+    def bulk_create_new(self, model_type, model_list, model_objects):
         """
         Takes a list of CaseModel instances of a given model_type, then creates
         a list of unique attribute sets for that particular list of instances.
-        This list of unique attributes can then be passed to a bulk_create
-        function to update the database.
+        These are upserted in batches on their natural key, which also adds
+        the entry for each key to the NaturalKeyResolver model_objects, so
+        the CaseModels do not need to be looked up again.
         """
 
         # get the attribute dicts for ModelCases which have no database entry
@@ -561,59 +854,11 @@ class MultipleCaseAdder(object):
             case_model.model_attributes
             for case_model in model_list
             if case_model.entry is False]
-        # use sets and tuples to remove duplicate dictionaries
-        new_attributes = [
-            dict(attribute_tuple)
-            for attribute_tuple
-            in set([
-                tuple(attribute_dict.items())
-                for attribute_dict
-                in new_attributes])]
-
-
-        model_type.objects.bulk_create([
-            model_type(**attributes)
-            for attributes in new_attributes])
 
-    def get_prefetch_lookups(self, model_type):
-        """
-        Takes a model type and returns list of the ForeignKey fields which
-        need to be passed to prefetch_related() when creating a QuerySet to
-        quickly get related items.
-
-        When adding new tables to the database, add their FKs here.
-        """
-        lookup_dict = {
-            Clinician: ['id','name', 'hospital', 'email'],
-            Phenotype: ['id','hpo_terms'],
-            Family: ['id',"gel_family_id"],
-            FamilyPhenotype: ['id',"family", "phenotype"],
-            Gene: ['id','hgnc_id'],
-            Panel: ['id','panelapp_id'],
-            PanelVersion: ['id',"panel", 'version_number'],
-            PanelVersionGene: ['id',"panel_version", "gene"],
-            ToolOrAssemblyVersion: ['id','tool_name','version_number'],
-            InterpretationReportFamily: ['id',"ir_family_id"],
-            InterpretationReportFamilyPanel: ['id',"ir_family", "panel"],
-            GELInterpretationReport: ['id',"sha_hash"],
-            Proband: ['id',"gel_id"],
-            Relative: ['id',"gel_id", "proband"],
-            Variant: ['id','chromosome', 'position', 'reference', 'alternate', "genome_assembly"],
-            Transcript: ['id',"name", 'genome_assembly'],
-            TranscriptVariant: ['id',"transcript", "variant"],
-            ProbandVariant: ['id',"variant", "interpretation_report", 'max_tier'],
-            PVFlag: ['id', "proband_variant", "flag_name"],
-            ProbandTranscriptVariant: ['id',"transcript", "proband_variant"],
-            ReportEvent: ['id',"proband_variant", "re_id"],
-            SVRegion: ['id', 'chromosome', 'sv_start', 'sv_end', "genome_assembly"],
-            SV: ['id', 'sv_region1', 'sv_region2', 'variant_type'],
-            ProbandSV: ['id', "sv", "interpretation_report"],
-            ProbandSVGene: ['id', "proband_sv", 'gene'],
-            STRVariant: ['id', 'chromosome', 'str_start', 'str_end', "genome_assembly", "repeated_sequence", "normal_threshold", "pathogenic_threshold"],
-            ProbandSTR: ['id', "str_variant", "interpretation_report"],
-            ProbandSTRGene: ['id', "proband_str", 'gene'],
-        }
-        return lookup_dict[model_type]
+        upserter = BulkUpserter(
+            model_type, model_objects, batch_size=self.upsert_batch_size,
+            use_copy=self.postgres_copy)
+        upserter.upsert(new_attributes)
 
     def update_cases(self):
         """
@@ -641,11 +886,27 @@ class TranscriptManager(object):
 
 
 class GeneManager(object):
-
+    """
+    A class which manages the genes seen across cases, resolving their
+    Ensembl IDs to HGNC IDs from the local HGNCStore so that each gene is only
+    looked up once and genenames.org is not polled.
+    """
     def __init__(self):
         self.fetched_genes = {}
         self.searched_genes = {}
+        self.gene_symbols = {}
         self.config_dict = load_config.LoadConfig().load()
+        self._hgnc_store = None
+
+    @property
+    def hgnc_store(self):
+        """
+        The HGNCStore in gene_storage, opened on first use.
+        """
+        if self._hgnc_store is None:
+            self._hgnc_store = HGNCStore(os.path.join(
+                self.config_dict['gene_storage'], HGNC_STORE_FILENAME))
+        return self._hgnc_store
 
     def add_gene(self, gene):
         if gene['HGNC_ID'] not in self.fetched_genes:
@@ -660,19 +921,44 @@ class GeneManager(object):
     def fetch_searched(self, ensembl_id):
         return self.searched_genes.get(ensembl_id, None)
 
-    def write_genes(self):
-        output = open(os.path.join(self.config_dict['gene_storage'], 'saved_genes.tsv'), 'w')
-        for key in self.searched_genes:
-            output.write(f'{key}\t{self.searched_genes[key]}\n')
-        output.close()
+    def fetch_symbol(self, ensembl_id):
+        return self.gene_symbols.get(ensembl_id, None)
 
-    def load_genes(self):
-        if os.path.isfile(os.path.join(self.config_dict['gene_storage'], 'saved_genes.tsv')):
-            with open(os.path.join(self.config_dict['gene_storage'], 'saved_genes.tsv')) as f:
-                for line in f:
-                    word = line.rstrip().split('\t')
-                    if len(word) > 1:
-                        self.searched_genes[word[0]] = word[1]
+    def resolve_genes(self, ensembl_ids):
+        """
+        Resolve every Ensembl ID in a list which has not been searched before
+        against the HGNCStore in one pass, recording 'Not_found' for IDs
+        which are not in it. If the store has never been loaded with the
+        refresh_hgnc command, genenames.org is polled instead.
+        """
+        unsearched = set(
+            ensembl_id for ensembl_id in ensembl_ids
+            if ensembl_id not in self.searched_genes)
+        if not unsearched:
+            return
+        if self.hgnc_store.is_empty():
+            logger.warning(
+                "HGNC store is empty, polling genenames.org. Run the "
+                "refresh_hgnc command to resolve genes locally.")
+            for ensembl_id in unsearched:
+                genename_response = PollAPI(
+                    "genenames", "search/{gene}/".format(gene=ensembl_id)
+                ).get_json_response()
+                if genename_response['response']['docs']:
+                    hgnc_id = genename_response['response']['docs'][0]['hgnc_id'].split(':')
+                    self.add_searched(ensembl_id, str(hgnc_id[1]))
+                else:
+                    self.add_searched(ensembl_id, 'Not_found')
+            return
+
+        resolved = self.hgnc_store.resolve(unsearched)
+        for ensembl_id in unsearched:
+            if ensembl_id in resolved:
+                hgnc_id, symbol = resolved[ensembl_id]
+                self.add_searched(ensembl_id, hgnc_id)
+                self.gene_symbols[ensembl_id] = symbol
+            else:
+                self.add_searched(ensembl_id, 'Not_found')
 
 class VariantManager(object):
 
@@ -712,6 +998,7 @@ class PanelManager(object):
     def __init__(self):
         self.fetched_panels = {}  # should be {(id, version): PanelResponse}
         self.panel_names = {}
+        self.searched_panels = set()  # (id, version) already looked up in the mirror
 
     def add_panel_response(self, panelapp_id, panel_version, panelapp_response):
         """
@@ -742,6 +1029,45 @@ class PanelManager(object):
     def fetch_panel_names(self, panelapp_id):
         return self.panel_names.get(panelapp_id, None)
 
+    def load_mirrored_panels(self, panel_keys):
+        """
+        Take a list of (panelApp ID, version number) tuples and add those
+        which have been mirrored into the database by the sync_panelapp
+        command, but are not already in fetched_panels. The genes of each
+        version are read from PanelVersionGene in the same shape as a
+        panelApp response. Keys which have already been looked up are not
+        queried again, so the panels of a whole batch of cases can be loaded
+        with one query before the cases are parsed.
+        """
+        panel_keys = set(
+            (panelapp_id, panel_version) for panelapp_id, panel_version in panel_keys
+            if (panelapp_id, panel_version) not in self.searched_panels
+            and not self.fetch_panel_response(panelapp_id, panel_version))
+        if not panel_keys:
+            return
+        self.searched_panels.update(panel_keys)
+        panel_filter = Q()
+        for panelapp_id, panel_version in panel_keys:
+            panel_filter |= Q(panel__panelapp_id=panelapp_id, version_number=panel_version)
+        panel_versions = PanelVersion.objects.filter(
+            panel_filter, mirrored_at__isnull=False
+        ).select_related('panel').prefetch_related('panelversiongene_set__gene')
+        for panel_version in panel_versions:
+            self.add_panel_response(
+                panelapp_id=panel_version.panel.panelapp_id,
+                panel_version=panel_version.version_number,
+                panelapp_response={
+                    'SpecificDiseaseName': panel_version.panel.panel_name,
+                    'DiseaseGroup': panel_version.panel.disease_group,
+                    'DiseaseSubGroup': panel_version.panel.disease_subgroup,
+                    'version': panel_version.version_number,
+                    'Genes': [{
+                        'EnsembleGeneIds': panel_version_gene.gene.ensembl_id,
+                        'GeneSymbol': panel_version_gene.gene.hgnc_name,
+                        'LevelOfConfidence': panel_version_gene.level_of_confidence,
+                    } for panel_version_gene in panel_version.panelversiongene_set.all()],
+                })
+
 
 
 class PanelResponse(object):
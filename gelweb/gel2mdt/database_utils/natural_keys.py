@@ -0,0 +1,182 @@
+"""Copyright (c) 2018 Great Ormond Street Hospital for Children NHS Foundation
+Trust & Birmingham Women's and Children's NHS Foundation Trust
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+from django.db.models import Q
+from ..models import *
+
+
+# The fields which identify a database entry for each model handled by the
+# MultipleCaseAdder. When adding new tables to the database, add their
+# natural key here.
+NATURAL_KEYS = {
+    Clinician: ('name', 'hospital', 'email'),
+    Phenotype: ('hpo_terms',),
+    Family: ('gel_family_id',),
+    FamilyPhenotype: ('family', 'phenotype'),
+    Gene: ('hgnc_id',),
+    Panel: ('panelapp_id',),
+    PanelVersion: ('panel', 'version_number'),
+    PanelVersionGene: ('panel_version', 'gene'),
+    ToolOrAssemblyVersion: ('tool_name', 'version_number'),
+    InterpretationReportFamily: ('ir_family_id',),
+    InterpretationReportFamilyPanel: ('ir_family', 'panel'),
+    GELInterpretationReport: ('sha_hash',),
+    Proband: ('gel_id',),
+    Relative: ('gel_id', 'proband'),
+    Variant: ('chromosome', 'position', 'reference', 'alternate', 'genome_assembly'),
+    Transcript: ('name', 'genome_assembly'),
+    TranscriptVariant: ('transcript', 'variant'),
+    ProbandVariant: ('variant', 'interpretation_report'),
+    PVFlag: ('proband_variant', 'flag_name'),
+    ProbandTranscriptVariant: ('transcript', 'proband_variant'),
+    ReportEvent: ('proband_variant', 're_id'),
+    SVRegion: ('chromosome', 'sv_start', 'sv_end', 'genome_assembly'),
+    SV: ('sv_region1', 'sv_region2', 'variant_type'),
+    ProbandSV: ('sv', 'interpretation_report'),
+    ProbandSVGene: ('proband_sv', 'gene'),
+    STRVariant: ('chromosome', 'str_start', 'str_end', 'genome_assembly',
+                 'repeated_sequence', 'normal_threshold', 'pathogenic_threshold'),
+    ProbandSTR: ('str_variant', 'interpretation_report'),
+    ProbandSTRGene: ('proband_str', 'gene'),
+    CaseSyncState: ('interpretation_request_id',),
+}
+
+
+class NaturalKeyResolver(object):
+    """
+    Resolves CaseModels of a single model type against the database by their
+    natural key, in bulk.
+
+    CaseModels register their natural key with the resolver when they are
+    created. Once every case has built its CaseModels for a model type,
+    resolve() looks up all of the pending keys in a handful of chunked,
+    parameterised queries and sets the entry on every waiting CaseModel. Keys
+    which have been resolved once are held in memory, so the same key seen in
+    another case costs nothing.
+
+    Attributes:
+        model_type (django.db.models.Model): the model being resolved.
+        key_fields (tuple): the natural key field names for model_type, taken
+            from NATURAL_KEYS.
+        chunk_size (int): the maximum number of keys looked up per query.
+        entries (dict): k-v pairing of natural key tuple and the matching
+            database entry.
+        pending (dict): k-v pairing of natural key tuple and a list of the
+            CaseModels waiting for that key to be resolved.
+    """
+    def __init__(self, model_type, chunk_size=500):
+        self.model_type = model_type
+        self.key_fields = NATURAL_KEYS[model_type]
+        self.fields = [model_type._meta.get_field(name) for name in self.key_fields]
+        self.chunk_size = chunk_size
+        self.entries = {}
+        self.pending = {}
+
+    def get_key(self, model_attributes):
+        """
+        Build the natural key tuple for a dict of model attributes. Related
+        instances are reduced to their primary key and other values are
+        coerced to the field's python type, so that keys built from parsed
+        JSON compare equal to keys built from database rows.
+        """
+        key = []
+        for field in self.fields:
+            value = model_attributes.get(field.name)
+            if field.is_relation:
+                value = value.pk if value else None
+            elif value is not None:
+                value = field.to_python(value)
+            key.append(value)
+        return tuple(key)
+
+    def get_entry_key(self, entry):
+        """
+        Build the natural key tuple for an instance fetched from the database.
+        """
+        return tuple(getattr(entry, field.attname) for field in self.fields)
+
+    def fetch(self, case_model):
+        """
+        Return the database entry for a CaseModel if its key has already been
+        resolved. Otherwise queue the CaseModel for the next call to
+        resolve() and return False.
+        """
+        key = self.get_key(case_model.model_attributes)
+        entry = self.entries.get(key)
+        if entry is not None:
+            return entry
+        self.pending.setdefault(key, []).append(case_model)
+        return False
+
+    def resolve(self):
+        """
+        Look up every pending key in the database and set the entry of each
+        waiting CaseModel, leaving entry as False where none was found.
+        """
+        keys = list(self.pending)
+        for start in range(0, len(keys), self.chunk_size):
+            chunk = keys[start:start + self.chunk_size]
+            for entry in self.model_type.objects.filter(self.get_chunk_filter(chunk)):
+                key = self.get_entry_key(entry)
+                if key not in self.pending:
+                    # the database matched a value the key does not hold,
+                    # e.g. a case insensitive collation
+                    continue
+                if key in self.entries and self.entries[key].pk != entry.pk:
+                    print(self.entries[key], entry)
+                    raise ValueError("Multiple entries found for same object.")
+                self.entries[key] = entry
+
+        for key, case_models in self.pending.items():
+            entry = self.entries.get(key, False)
+            for case_model in case_models:
+                case_model.entry = entry
+        self.pending = {}
+
+    def get_chunk_filter(self, keys):
+        """
+        Build a filter matching exactly the keys in a chunk. A single column
+        key is matched with one IN list; otherwise each key becomes its own
+        AND of column lookups and the keys are OR'ed together, so that the
+        query only returns the rows asked for and each branch can use the
+        unique index on the key columns.
+        """
+        if len(self.fields) == 1:
+            attname = self.fields[0].attname
+            values = set(key[0] for key in keys)
+            chunk_filter = Q()
+            if None in values:
+                values.discard(None)
+                chunk_filter |= Q(**{attname + '__isnull': True})
+            if values:
+                chunk_filter |= Q(**{attname + '__in': values})
+            return chunk_filter
+
+        chunk_filter = Q()
+        for key in keys:
+            key_filter = {}
+            for field, value in zip(self.fields, key):
+                if value is None:
+                    key_filter[field.attname + '__isnull'] = True
+                else:
+                    key_filter[field.attname] = value
+            chunk_filter |= Q(**key_filter)
+        return chunk_filter
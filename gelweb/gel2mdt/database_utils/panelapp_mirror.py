@@ -0,0 +1,205 @@
+"""Copyright (c) 2018 Great Ormond Street Hospital for Children NHS Foundation
+Trust & Birmingham Women's and Children's NHS Foundation Trust
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import os
+import re
+import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from django.db import transaction
+from django.utils import timezone
+from ..models import Panel, PanelVersion, PanelVersionGene, Gene
+from ..api_utils.poll_api import PollAPI, get_shared_session
+from ..config import load_config
+from .multiple_case_adder import GeneManager
+
+
+# panels are saved in panelapp_storage as {panelapp_id}_{version}.json
+PANEL_FILENAME = re.compile(r'^(?P<panelapp_id>.+)_(?P<version>[^_]+)\.json$')
+
+
+class PanelAppMirror(object):
+    """
+    Mirrors the PanelApp panels used by our cases into the Panel,
+    PanelVersion and PanelVersionGene tables.
+
+    Panel versions are found from the PanelVersion table and the panel jsons
+    in panelapp_storage. Versions which have already been mirrored are
+    skipped, since a panel version does not change once released. The rest
+    are read from panelapp_storage, or fetched concurrently from PanelApp
+    and saved there, and their genes are written to PanelVersionGene in one
+    transaction per version. Gene Ensembl IDs are resolved to HGNC IDs by
+    the GeneManager.
+
+    Attributes:
+        panelapp_storage (str): directory of the saved panel jsons.
+        workers (int): number of panels fetched from PanelApp at once.
+        gene_manager (GeneManager): resolves panel genes to HGNC IDs.
+        failed_panels (list): (panelapp_id, version, error) for each panel
+            version which could not be mirrored.
+    """
+    def __init__(self, workers=4):
+        config_dict = load_config.LoadConfig().load()
+        self.panelapp_storage = config_dict['panelapp_storage']
+        self.workers = max(int(workers), 1)
+        self.gene_manager = GeneManager()
+        self.failed_panels = []
+
+    def get_panel_file(self, panelapp_id, version):
+        return os.path.join(
+            self.panelapp_storage, '{}_{}.json'.format(panelapp_id, version))
+
+    def find_panels(self):
+        """
+        Return the set of (panelapp_id, version) tuples which are used but
+        have not been mirrored yet.
+        """
+        panels = set(PanelVersion.objects.filter(
+            mirrored_at__isnull=True
+        ).values_list('panel__panelapp_id', 'version_number'))
+        if os.path.isdir(self.panelapp_storage):
+            for filename in os.listdir(self.panelapp_storage):
+                match = PANEL_FILENAME.match(filename)
+                if match:
+                    panels.add((match.group('panelapp_id'), match.group('version')))
+        mirrored = set(PanelVersion.objects.filter(
+            mirrored_at__isnull=False
+        ).values_list('panel__panelapp_id', 'version_number'))
+        return panels - mirrored
+
+    def fetch_panel(self, panelapp_id, version, session):
+        """
+        Read a panel version from panelapp_storage, or fetch it from PanelApp
+        and save it there if it is missing or unreadable.
+        :return: The "result" of the PanelApp response
+        """
+        panel_file = self.get_panel_file(panelapp_id, version)
+        if os.path.isfile(panel_file):
+            try:
+                with open(panel_file) as f:
+                    return json.load(f)['result']
+            except (ValueError, KeyError):
+                pass
+        panelapp_poll = PollAPI(
+            "panelapp", "get_panel/{}/?version={}".format(panelapp_id, version),
+            session=session)
+        panelapp_response = panelapp_poll.get_json_response()
+        with open(panel_file, 'w') as f:
+            json.dump(panelapp_response, f)
+        return panelapp_response['result']
+
+    def get_gene_entries(self, panel_genes):
+        """
+        Return the Gene entries for a list of PanelApp genes keyed by HGNC
+        ID, creating those which are not in the database yet. Genes whose
+        Ensembl ID can not be resolved to an HGNC ID are left out.
+        """
+        genes = {}
+        for gene in panel_genes:
+            ensembl_id = gene.get('EnsembleGeneIds')
+            if isinstance(ensembl_id, list):
+                ensembl_id = ensembl_id[0] if ensembl_id else None
+            # a lot of pilot panels just have E for this
+            if not ensembl_id or ensembl_id == 'E':
+                continue
+            genes[ensembl_id] = gene
+        self.gene_manager.resolve_genes(list(genes))
+
+        resolved = {}
+        for ensembl_id, gene in genes.items():
+            hgnc_id = self.gene_manager.fetch_searched(ensembl_id)
+            if hgnc_id and hgnc_id != 'Not_found':
+                resolved[hgnc_id] = (ensembl_id, gene)
+
+        entries = {
+            gene.hgnc_id: gene
+            for gene in Gene.objects.filter(hgnc_id__in=list(resolved))}
+        new_genes = [
+            Gene(ensembl_id=ensembl_id,
+                 hgnc_name=gene.get('GeneSymbol') or self.gene_manager.fetch_symbol(ensembl_id) or '',
+                 hgnc_id=hgnc_id)
+            for hgnc_id, (ensembl_id, gene) in resolved.items()
+            if hgnc_id not in entries]
+        if new_genes:
+            Gene.objects.bulk_create(new_genes)
+            for gene in Gene.objects.filter(hgnc_id__in=[gene.hgnc_id for gene in new_genes]):
+                entries[gene.hgnc_id] = gene
+        return {
+            hgnc_id: (entries[hgnc_id], gene)
+            for hgnc_id, (ensembl_id, gene) in resolved.items()}
+
+    def store_panel(self, panelapp_id, version, result):
+        """
+        Write a panel version and its genes to the database, replacing any
+        genes already recorded for it.
+        """
+        with transaction.atomic():
+            panel, created = Panel.objects.update_or_create(
+                panelapp_id=panelapp_id,
+                defaults={
+                    'panel_name': result['SpecificDiseaseName'],
+                    'disease_group': result['DiseaseGroup'],
+                    'disease_subgroup': result['DiseaseSubGroup'],
+                })
+            # the ingest names versions by the version PanelApp returns
+            version = str(result.get('version') or version)
+            panel_version = PanelVersion.objects.filter(
+                panel=panel, version_number=version).first()
+            if panel_version is None:
+                panel_version = PanelVersion.objects.create(
+                    panel=panel, version_number=version)
+
+            genes = self.get_gene_entries(result.get('Genes', []))
+            PanelVersionGene.objects.filter(panel_version=panel_version).delete()
+            PanelVersionGene.objects.bulk_create([
+                PanelVersionGene(
+                    panel_version=panel_version,
+                    gene=gene_entry,
+                    level_of_confidence=gene.get('LevelOfConfidence') or '')
+                for gene_entry, gene in genes.values()])
+
+            panel_version.mirrored_at = timezone.now()
+            panel_version.save()
+        return panel_version
+
+    def sync(self, panels=None):
+        """
+        Mirror each (panelapp_id, version) tuple in panels, or every panel
+        version found by find_panels. Panels are fetched concurrently and
+        written to the database as they arrive.
+        :return: The number of panel versions mirrored
+        """
+        if panels is None:
+            panels = self.find_panels()
+        mirrored = 0
+        session = get_shared_session()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {
+                executor.submit(self.fetch_panel, panelapp_id, version, session):
+                    (panelapp_id, version)
+                for panelapp_id, version in panels}
+            for future in as_completed(futures):
+                panelapp_id, version = futures[future]
+                try:
+                    self.store_panel(panelapp_id, version, future.result())
+                    mirrored += 1
+                except Exception as e:
+                    self.failed_panels.append((panelapp_id, version, str(e)))
+        return mirrored
@@ -0,0 +1,102 @@
+"""Copyright (c) 2018 Great Ormond Street Hospital for Children NHS Foundation
+Trust & Birmingham Women's and Children's NHS Foundation Trust
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from django.db import connection
+
+
+class StageScheduler(object):
+    """
+    Runs a set of stages, each declared with the stages it depends on. A
+    stage starts as soon as all of its dependencies have finished, so with
+    more than one worker independent stages run at the same time, each in
+    its own thread and so on its own database connection.
+
+    With a single worker the stages run one after another in this thread, in
+    the order they were added, which must then respect their dependencies.
+
+    Attributes:
+        workers (int): the number of stages run at once.
+        stages (OrderedDict): k-v pairing of stage key and a tuple of the
+            function to call and the keys of the stages it depends on.
+    """
+    def __init__(self, workers=1):
+        self.workers = max(int(workers), 1)
+        self.stages = OrderedDict()
+
+    def add_stage(self, key, function, dependencies=()):
+        """
+        Add a stage, which calls function with no arguments once every stage
+        in dependencies has finished. Dependencies must already be added.
+        """
+        if key in self.stages:
+            raise ValueError("Stage {} added twice.".format(key))
+        for dependency in dependencies:
+            if dependency not in self.stages:
+                raise ValueError("Stage {} depends on {}, which has not been added.".format(
+                    key, dependency))
+        self.stages[key] = (function, tuple(dependencies))
+
+    def run(self):
+        """
+        Run every stage. If a stage raises, no more stages are started, the
+        running ones are waited for, and the first error is raised.
+        """
+        if self.workers == 1:
+            for function, dependencies in self.stages.values():
+                function()
+            return
+
+        done = set()
+        running = {}
+        waiting = OrderedDict(self.stages)
+        error = None
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while waiting or running:
+                if error is None:
+                    for key, (function, dependencies) in list(waiting.items()):
+                        if done.issuperset(dependencies):
+                            del waiting[key]
+                            running[executor.submit(self.run_stage, function)] = key
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    key = running.pop(future)
+                    if future.exception() is not None:
+                        error = error or future.exception()
+                    else:
+                        done.add(key)
+        if error is not None:
+            raise error
+
+    @staticmethod
+    def run_stage(function):
+        """
+        Call a stage's function in a worker thread, then close the thread's
+        database connection so that it is not left open once the pool exits.
+        """
+        try:
+            function()
+        finally:
+            connection.close()
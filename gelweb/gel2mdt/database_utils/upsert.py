@@ -0,0 +1,370 @@
+"""Copyright (c) 2018 Great Ormond Street Hospital for Children NHS Foundation
+Trust & Birmingham Women's and Children's NHS Foundation Trust
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import io
+import zlib
+from contextlib import contextmanager
+
+from django.db import connection, transaction
+from ..models import (
+    PVFlag, ProbandTranscriptVariant, ProbandVariant, TranscriptVariant)
+
+
+# The largest tables written by an update, particularly when T3 variants are
+# pulled. On PostgreSQL their rows are streamed in with COPY.
+COPY_MODELS = (
+    ProbandVariant,
+    PVFlag,
+    TranscriptVariant,
+    ProbandTranscriptVariant,
+)
+
+
+class BulkUpserter(object):
+    """
+    Inserts the new rows of a single model type in batches, letting the
+    database skip rows whose natural key already exists, and records the
+    resulting entries with a NaturalKeyResolver so that CaseModels find
+    their entry without another lookup.
+
+    On PostgreSQL, models with a unique constraint on their natural key use
+    INSERT ... ON CONFLICT (key) DO UPDATE ... RETURNING, which returns the
+    entry for every row whether it was inserted or already there. On MySQL
+    they use INSERT ... ON DUPLICATE KEY UPDATE and the entries are looked up
+    afterwards. Models without such a constraint take a lock named after
+    their table while they check for and insert missing rows, so concurrent
+    ingests cannot both insert the same row. Other backends fall back to
+    bulk_create. Of the large tables, only Variant has no constraint, since
+    MySQL cannot put its TEXT reference and alternate columns in a unique
+    index; the other models without one are small lookup tables.
+
+    Rows whose natural key contains NULL are never duplicates, since NULL
+    matches nothing in a unique constraint, so they are always inserted and
+    are not added to the resolver.
+
+    If use_copy is set, rows of the COPY_MODELS on PostgreSQL are instead
+    streamed with COPY FROM STDIN into a temporary staging table, which is
+    merged into the real table with a single INSERT ... SELECT.
+
+    If update_fields are given, rows whose natural key already exists have
+    those fields overwritten rather than being left untouched.
+
+    Attributes:
+        model_type (django.db.models.Model): the model being inserted.
+        resolver (NaturalKeyResolver): resolver for model_type, which holds
+            the entries found or created.
+        batch_size (int): the maximum number of rows per INSERT.
+        use_copy (bool): whether rows are loaded with COPY. Only set for
+            the COPY_MODELS on PostgreSQL without update_fields.
+        update_fields (tuple): names of the fields overwritten on existing
+            rows.
+    """
+    # below this many rows the staging table costs more than it saves
+    copy_min_rows = 100
+
+    def __init__(self, model_type, resolver, batch_size=500, use_copy=False,
+                 update_fields=()):
+        self.model_type = model_type
+        self.resolver = resolver
+        self.batch_size = batch_size
+        self.vendor = connection.vendor
+        self.update_fields = tuple(update_fields)
+        self.use_copy = (
+            use_copy and
+            not self.update_fields and
+            self.vendor == 'postgresql' and
+            model_type in COPY_MODELS)
+        meta = model_type._meta
+        self.fields = [
+            field for field in meta.concrete_fields
+            if field != meta.pk]
+        self.key_columns = [field.column for field in resolver.fields]
+        self.has_key_constraint = self.get_has_key_constraint()
+
+    def get_has_key_constraint(self):
+        """
+        Check whether the natural key is enforced by a unique constraint,
+        which ON CONFLICT and ON DUPLICATE KEY need to detect duplicates.
+        """
+        key_fields = set(self.resolver.key_fields)
+        if len(key_fields) == 1 and self.resolver.fields[0].unique:
+            return True
+        return any(
+            set(unique_together) == key_fields
+            for unique_together in self.model_type._meta.unique_together)
+
+    def upsert(self, new_attributes):
+        """
+        Take a list of attribute dicts, insert those whose natural key is not
+        yet in the database and add the entry for each key to the resolver.
+        Attribute dicts sharing a natural key are inserted once. With
+        update_fields, existing rows are updated instead and the last dict
+        for each key wins.
+        """
+        new_objects = {}
+        null_key_objects = []
+        for attributes in new_attributes:
+            key = self.resolver.get_key(attributes)
+            if None in key:
+                null_key_objects.append(self.model_type(**attributes))
+            elif self.update_fields or (
+                    key not in new_objects and key not in self.resolver.entries):
+                new_objects[key] = self.model_type(**attributes)
+        new_objects = list(new_objects.items())
+        self.model_type.objects.bulk_create(
+            null_key_objects, batch_size=self.batch_size)
+
+        if self.use_copy and len(new_objects) >= self.copy_min_rows:
+            self.copy_insert(new_objects)
+            return
+        for start in range(0, len(new_objects), self.batch_size):
+            batch = new_objects[start:start + self.batch_size]
+            if self.vendor == 'postgresql' and self.has_key_constraint:
+                self.insert_returning(batch)
+            elif self.vendor == 'mysql' and self.has_key_constraint:
+                self.insert_ignoring_duplicates(batch)
+            elif self.vendor in ('postgresql', 'mysql'):
+                with self.table_lock():
+                    self.insert_missing(batch)
+            else:
+                self.insert_missing(batch)
+
+    def get_insert_sql(self, objects):
+        """
+        Build an INSERT statement for a batch of (key, unsaved instance)
+        pairs, returning the sql and its parameters.
+        """
+        quote_name = connection.ops.quote_name
+        params = []
+        for key, obj in objects:
+            params += self.get_row(obj)
+        row = '({})'.format(', '.join(['%s'] * len(self.fields)))
+        sql = 'INSERT INTO {table} ({columns}) VALUES {rows}'.format(
+            table=quote_name(self.model_type._meta.db_table),
+            columns=', '.join(quote_name(field.column) for field in self.fields),
+            rows=', '.join([row] * len(objects)))
+        return sql, params
+
+    def get_row(self, obj):
+        """
+        Return the database values of an unsaved instance, in the order of
+        self.fields.
+        """
+        return [
+            field.get_db_prep_save(field.pre_save(obj, True), connection=connection)
+            for field in self.fields]
+
+    def insert_returning(self, objects):
+        """
+        PostgreSQL: insert a batch, leaving existing rows untouched unless
+        there are update_fields, and read back the entry for every key in the
+        batch in the same statement. The no-op DO UPDATE is used over DO
+        NOTHING because only updated rows are returned for conflicting keys.
+        """
+        quote_name = connection.ops.quote_name
+        key_columns = [quote_name(column) for column in self.key_columns]
+        meta = self.model_type._meta
+        attnames = [field.attname for field in meta.concrete_fields]
+        update_columns = self.get_update_columns() or [key_columns[0]]
+        sql, params = self.get_insert_sql(objects)
+        sql += ' ON CONFLICT ({key}) DO UPDATE SET {updates} RETURNING {returning}'.format(
+            key=', '.join(key_columns),
+            updates=', '.join(
+                '{column} = EXCLUDED.{column}'.format(column=column)
+                for column in update_columns),
+            returning=', '.join(
+                quote_name(field.column) for field in meta.concrete_fields))
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            rows = cursor.fetchall()
+        for row in rows:
+            entry = self.model_type.from_db(connection.alias, attnames, row)
+            self.resolver.entries[self.resolver.get_entry_key(entry)] = entry
+
+    def insert_ignoring_duplicates(self, objects):
+        """
+        MySQL: insert a batch, leaving existing rows untouched unless there
+        are update_fields, then look up the entries for the batch. MySQL has
+        no RETURNING clause.
+        """
+        pk_column = connection.ops.quote_name(self.model_type._meta.pk.column)
+        sql, params = self.get_insert_sql(objects)
+        if self.update_fields:
+            sql += ' ON DUPLICATE KEY UPDATE {updates}'.format(
+                updates=', '.join(
+                    '{column} = VALUES({column})'.format(column=column)
+                    for column in self.get_update_columns()))
+        else:
+            sql += ' ON DUPLICATE KEY UPDATE {pk} = {pk}'.format(pk=pk_column)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+        self.fetch_entries(objects)
+
+    def insert_missing(self, objects):
+        """
+        Look up which keys of a batch are already in the database and
+        bulk_create the rest. Existing rows are updated one by one if there
+        are update_fields.
+        """
+        self.fetch_entries(objects)
+        missing = []
+        for key, obj in objects:
+            entry = self.resolver.entries.get(key)
+            if entry is None:
+                missing.append((key, obj))
+            elif self.update_fields:
+                values = {
+                    name: getattr(obj, name) for name in self.update_fields}
+                self.model_type.objects.filter(pk=entry.pk).update(**values)
+                for name, value in values.items():
+                    setattr(entry, name, value)
+        self.model_type.objects.bulk_create([obj for key, obj in missing])
+        self.fetch_entries(missing)
+
+    def get_update_columns(self):
+        """
+        Return the quoted columns of the update_fields.
+        """
+        meta = self.model_type._meta
+        return [
+            connection.ops.quote_name(meta.get_field(name).column)
+            for name in self.update_fields]
+
+    def fetch_entries(self, objects):
+        """
+        Add the database entries matching the keys of a batch of (key,
+        instance) pairs to the resolver.
+        """
+        keys = set(key for key, obj in objects)
+        if not keys:
+            return
+        query = self.model_type.objects.filter(
+            self.resolver.get_chunk_filter(list(keys)))
+        for entry in query:
+            key = self.resolver.get_entry_key(entry)
+            if key in keys:
+                self.resolver.entries[key] = entry
+
+    def copy_insert(self, objects):
+        """
+        PostgreSQL: stream a list of (key, instance) pairs into a temporary
+        staging table with COPY, insert the rows whose key is not yet in the
+        real table with one INSERT ... SELECT, and read back the entry for
+        every key by joining the real table to the staging table.
+        """
+        quote_name = connection.ops.quote_name
+        meta = self.model_type._meta
+        table = quote_name(meta.db_table)
+        staging = quote_name('staging_' + meta.db_table)
+        columns = ', '.join(quote_name(field.column) for field in self.fields)
+        key_match = ' AND '.join(
+            't.{column} {operator} s.{column}'.format(
+                column=quote_name(field.column),
+                operator='IS NOT DISTINCT FROM' if field.null else '=')
+            for field in self.resolver.fields)
+
+        if self.has_key_constraint:
+            merge_sql = (
+                'INSERT INTO {table} ({columns}) SELECT {columns} FROM {staging}'
+                ' ON CONFLICT DO NOTHING')
+            lock = transaction.atomic()
+        else:
+            merge_sql = (
+                'INSERT INTO {table} ({columns}) SELECT {columns} FROM {staging} s'
+                ' WHERE NOT EXISTS (SELECT 1 FROM {table} t WHERE {key_match})')
+            lock = self.table_lock()
+
+        buffer = io.StringIO()
+        for key, obj in objects:
+            buffer.write('\t'.join(
+                self.get_copy_value(value) for value in self.get_row(obj)))
+            buffer.write('\n')
+        buffer.seek(0)
+
+        attnames = [field.attname for field in meta.concrete_fields]
+        with lock, connection.cursor() as cursor:
+            cursor.execute(
+                'CREATE TEMPORARY TABLE {staging} ON COMMIT DROP AS'
+                ' SELECT {columns} FROM {table} WITH NO DATA'.format(
+                    staging=staging, columns=columns, table=table))
+            cursor.copy_expert(
+                'COPY {staging} ({columns}) FROM STDIN'.format(
+                    staging=staging, columns=columns),
+                buffer)
+            cursor.execute(merge_sql.format(
+                table=table, columns=columns, staging=staging,
+                key_match=key_match))
+            cursor.execute(
+                'SELECT {returning} FROM {table} t JOIN {staging} s'
+                ' ON {key_match}'.format(
+                    returning=', '.join(
+                        't.' + quote_name(field.column)
+                        for field in meta.concrete_fields),
+                    table=table, staging=staging, key_match=key_match))
+            for row in cursor.fetchall():
+                entry = self.model_type.from_db(connection.alias, attnames, row)
+                self.resolver.entries[self.resolver.get_entry_key(entry)] = entry
+            # dropped now in case we are inside a longer transaction
+            cursor.execute('DROP TABLE {staging}'.format(staging=staging))
+
+    @staticmethod
+    def get_copy_value(value):
+        """
+        Format a database value for COPY's text format.
+        """
+        if value is None:
+            return '\\N'
+        if isinstance(value, bool):
+            return 't' if value else 'f'
+        return str(value).replace(
+            '\\', '\\\\').replace(
+            '\t', '\\t').replace(
+            '\n', '\\n').replace(
+            '\r', '\\r')
+
+    @contextmanager
+    def table_lock(self):
+        """
+        Hold a lock named after the model's table for the duration of the
+        block, so that only one ingest checks for and inserts its rows at a
+        time. The lock is advisory: it does not block readers or other
+        writers to the table.
+        """
+        table = self.model_type._meta.db_table
+        if self.vendor == 'postgresql':
+            with transaction.atomic():
+                with connection.cursor() as cursor:
+                    # released when the transaction ends
+                    cursor.execute(
+                        'SELECT pg_advisory_xact_lock(%s)',
+                        [zlib.crc32(table.encode('utf-8'))])
+                yield
+        else:
+            # released after the commit, so the next ingest sees our rows
+            lock_name = 'gel2mdt.' + table
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT GET_LOCK(%s, -1)', [lock_name])
+            try:
+                with transaction.atomic():
+                    yield
+            finally:
+                with connection.cursor() as cursor:
+                    cursor.execute('SELECT RELEASE_LOCK(%s)', [lock_name])
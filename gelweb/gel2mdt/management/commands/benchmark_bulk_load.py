@@ -0,0 +1,144 @@
+"""Copyright (c) 2018 Great Ormond Street Hospital for Children NHS Foundation
+Trust & Birmingham Women's and Children's NHS Foundation Trust
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from gel2mdt.database_utils.natural_keys import NaturalKeyResolver
+from gel2mdt.database_utils.upsert import BulkUpserter
+from gel2mdt.factories import GELInterpretationReportFactory
+from gel2mdt.models import (
+    PVFlag, ProbandTranscriptVariant, ProbandVariant, ToolOrAssemblyVersion,
+    Transcript, TranscriptVariant, Variant)
+
+
+class Rollback(Exception):
+    """Raised to roll back the rows written by a benchmark run."""
+
+
+class Command(BaseCommand):
+    help = """Time loading a synthetic, T3-heavy batch of ProbandVariants,
+    PVFlags, TranscriptVariants and ProbandTranscriptVariants with INSERTs
+    and with the PostgreSQL COPY path. Everything written is rolled back."""
+
+    def add_arguments(self, parser):
+        """Gather the size of the synthetic batch."""
+        parser.add_argument('--variants', type=int, default=5000,
+                            help='Number of proband variants in the batch.')
+        parser.add_argument('--transcripts', type=int, default=8,
+                            help='Number of transcripts per variant.')
+        parser.add_argument('--flags', type=int, default=2,
+                            help='Number of flags per proband variant.')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Rows per INSERT for the INSERT path.')
+
+    def handle(self, *args, **options):
+        """Build the batch, then time each loader against it."""
+        if connection.vendor != 'postgresql':
+            raise CommandError(
+                'The COPY path needs PostgreSQL, not {}'.format(connection.vendor))
+        try:
+            with transaction.atomic():
+                self.make_batch(options)
+                for use_copy in (False, True):
+                    self.run(use_copy, options['batch_size'])
+                raise Rollback()
+        except Rollback:
+            pass
+
+    def make_batch(self, options):
+        """
+        Write the parent rows of the batch - variants, transcripts and an
+        interpretation report - and set up the attribute dicts of the rows
+        to be loaded.
+        """
+        genome_build = ToolOrAssemblyVersion.objects.create(
+            tool_name='genome_build', version_number='GRCh38')
+        self.report = GELInterpretationReportFactory()
+        Variant.objects.bulk_create([
+            Variant(chromosome='1', position=position, reference='A',
+                    alternate='T', genome_assembly=genome_build)
+            for position in range(options['variants'])])
+        self.variants = list(Variant.objects.filter(genome_assembly=genome_build))
+        Transcript.objects.bulk_create([
+            Transcript(name='ENST{:011d}'.format(number), strand='+',
+                       genome_assembly=genome_build)
+            for number in range(options['transcripts'])])
+        self.transcripts = list(Transcript.objects.filter(genome_assembly=genome_build))
+        self.flags = ['flag {}'.format(number) for number in range(options['flags'])]
+
+    def run(self, use_copy, batch_size):
+        """
+        Load the batch one table at a time, in the order used by the
+        MultipleCaseAdder, and report the time taken for each.
+        """
+        timings = []
+        try:
+            with transaction.atomic():
+                proband_variants = self.load(
+                    ProbandVariant, use_copy, batch_size, timings, [
+                        {'variant': variant,
+                         'interpretation_report': self.report,
+                         'max_tier': 3,
+                         'somatic': False}
+                        for variant in self.variants])
+                self.load(PVFlag, use_copy, batch_size, timings, [
+                    {'proband_variant': proband_variant, 'flag_name': flag}
+                    for proband_variant in proband_variants
+                    for flag in self.flags])
+                self.load(TranscriptVariant, use_copy, batch_size, timings, [
+                    {'transcript': transcript,
+                     'variant': variant,
+                     'af_max': '0.01',
+                     'hgvs_c': 'c.1A>T',
+                     'hgvs_p': 'p.Met1?',
+                     'hgvs_g': 'g.1A>T'}
+                    for variant in self.variants
+                    for transcript in self.transcripts])
+                self.load(ProbandTranscriptVariant, use_copy, batch_size, timings, [
+                    {'transcript': transcript,
+                     'proband_variant': proband_variant,
+                     'effect': 'missense_variant'}
+                    for proband_variant in proband_variants
+                    for transcript in self.transcripts])
+                raise Rollback()
+        except Rollback:
+            pass
+
+        self.stdout.write('{}:'.format('COPY' if use_copy else 'INSERT'))
+        for model_type, rows, seconds in timings:
+            self.stdout.write('    {:<26} {:>8} rows {:>8.2f}s {:>10.0f} rows/s'.format(
+                model_type.__name__, rows, seconds, rows / seconds if seconds else 0))
+        self.stdout.write('    {:<26} {:>8} rows {:>8.2f}s'.format(
+            'total', sum(t[1] for t in timings), sum(t[2] for t in timings)))
+
+    def load(self, model_type, use_copy, batch_size, timings, new_attributes):
+        """
+        Upsert the rows of one table and return their entries.
+        """
+        resolver = NaturalKeyResolver(model_type)
+        upserter = BulkUpserter(
+            model_type, resolver, batch_size=batch_size, use_copy=use_copy)
+        start = time.perf_counter()
+        upserter.upsert(new_attributes)
+        timings.append((model_type, len(new_attributes), time.perf_counter() - start))
+        return list(resolver.entries.values())
@@ -0,0 +1,117 @@
+"""Copyright (c) 2018 Great Ormond Street Hospital for Children NHS Foundation
+Trust & Birmingham Women's and Children's NHS Foundation Trust
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import time
+from types import SimpleNamespace
+
+from django.core.management.base import BaseCommand
+from gel2mdt.database_utils.case_handler import join_transcript_entries
+from gel2mdt.models import ToolOrAssemblyVersion, Transcript, Variant
+
+
+class Command(BaseCommand):
+    help = """Time joining a case's VEP transcripts to its Variant and
+    Transcript entries for synthetic, T3-heavy cases of increasing size,
+    using the hash-indexed join and the nested-loop join it replaced. The
+    time per transcript should stay flat for the indexed join. Nothing is
+    written to the database."""
+
+    def add_arguments(self, parser):
+        """Gather the sizes of the synthetic cases."""
+        parser.add_argument('--transcripts', type=int, nargs='+',
+                            default=[1000, 10000, 50000],
+                            help='Number of transcripts in each case.')
+        parser.add_argument('--transcripts-per-variant', type=int, default=8,
+                            help='Number of transcripts of each variant.')
+        parser.add_argument('--nested-limit', type=int, default=10000,
+                            help='Largest case also timed with the nested'
+                            ' loop join, which is quadratic.')
+
+    def handle(self, *args, **options):
+        """Build each case and time the joins."""
+        self.stdout.write('{:>12} {:>10} {:>12} {:>14}'.format(
+            'transcripts', 'join', 'seconds', 'us/transcript'))
+        for size in options['transcripts']:
+            case = self.make_case(size, options['transcripts_per_variant'])
+            joins = [('indexed', join_transcript_entries)]
+            if size <= options['nested_limit']:
+                joins.append(('nested', self.nested_join))
+            for name, join in joins:
+                start = time.perf_counter()
+                join(*case)
+                seconds = time.perf_counter() - start
+                self.stdout.write('{:>12} {:>10} {:>12.3f} {:>14.2f}'.format(
+                    size, name, seconds, seconds / size * 1e6))
+
+    @staticmethod
+    def make_case(size, transcripts_per_variant):
+        """
+        Build the CaseTranscripts, CaseVariants and unsaved Variant and
+        Transcript entries of a synthetic case.
+        """
+        genome_assembly = ToolOrAssemblyVersion(
+            pk=1, tool_name='genome_build', version_number='GRCh38')
+        num_variants = max(size // transcripts_per_variant, 1)
+        case_variants = [
+            SimpleNamespace(case_id='1-1', variant_count=str(count),
+                            chromosome='1', position=count, ref='A', alt='T')
+            for count in range(num_variants)]
+        variant_entries = [
+            Variant(pk=count + 1, chromosome='1', position=count,
+                    reference='A', alternate='T', genome_assembly_id=1)
+            for count in range(num_variants)]
+        transcript_entries = [
+            Transcript(pk=count + 1, name='ENST{:011d}'.format(count),
+                       genome_assembly_id=1)
+            for count in range(size)]
+        case_transcripts = [
+            SimpleNamespace(case_id='1-1',
+                            variant_count=str(count % num_variants),
+                            transcript_name='ENST{:011d}'.format(count))
+            for count in range(size)]
+        return (case_transcripts, case_variants, variant_entries,
+                transcript_entries, genome_assembly)
+
+    @staticmethod
+    def nested_join(case_transcripts, case_variants, variant_entries,
+                    transcript_entries, genome_assembly):
+        """
+        The join previously done by get_transcript_variants, kept here for
+        comparison.
+        """
+        for case_transcript in case_transcripts:
+            for variant in case_variants:
+                if (case_transcript.case_id == variant.case_id and
+                        case_transcript.variant_count == variant.variant_count):
+                    case_variant = variant
+                    break
+            for variant_entry in variant_entries:
+                if (variant_entry.chromosome == case_variant.chromosome and
+                        variant_entry.position == case_variant.position and
+                        variant_entry.reference == case_variant.ref and
+                        variant_entry.alternate == case_variant.alt):
+                    case_transcript.variant_entry = variant_entry
+            for transcript_entry in transcript_entries:
+                if (transcript_entry.name == case_transcript.transcript_name and
+                        transcript_entry.genome_assembly_id == genome_assembly.pk):
+                    case_transcript.transcript_entry = transcript_entry
+                    break
+                case_transcript.transcript_entry = None
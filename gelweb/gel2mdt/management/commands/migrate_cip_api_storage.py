@@ -0,0 +1,80 @@
+"""Copyright (c) 2018 Great Ormond Street Hospital for Children NHS Foundation
+Trust & Birmingham Women's and Children's NHS Foundation Trust
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import os
+import json
+from django.core.management.base import BaseCommand, CommandError
+from tqdm import tqdm
+from gel2mdt.config import load_config
+from gel2mdt.database_utils.case_storage import CaseStorage
+from gel2mdt.database_utils.case_handler import hash_case_json
+
+
+class Command(BaseCommand):
+    help = """Move the plain json files in cip_api_storage into the
+    compressed, indexed case archive."""
+
+    def add_arguments(self, parser):
+        """Gather options for the migration."""
+        parser.add_argument('--delete', action='store_true',
+                            help='Delete each json file once it has been'
+                            ' archived and read back successfully.')
+
+    def handle(self, *args, **options):
+        """Archive every json file which is not already in the index."""
+        config_dict = load_config.LoadConfig().load()
+        storage_dir = config_dict['cip_api_storage']
+        if not os.path.isdir(storage_dir):
+            raise CommandError(
+                'cip_api_storage directory {} does not exist'.format(storage_dir))
+        case_storage = CaseStorage(storage_dir)
+
+        legacy_files = list(case_storage.legacy_files())
+        archived = 0
+        failed = []
+        for request_id, archived_version, path in tqdm(legacy_files):
+            with open(path, 'rb') as f:
+                content = f.read()
+            row = case_storage.lookup(request_id, archived_version)
+            if row is None:
+                try:
+                    sha_hash = hash_case_json(json.loads(content.decode('utf-8')))
+                except ValueError:
+                    failed.append(path)
+                    continue
+                case_storage.write(
+                    request_id, archived_version, content, sha_hash=sha_hash)
+                row = case_storage.lookup(request_id, archived_version)
+                archived += 1
+
+            if options['delete']:
+                sha_hash, archive, offset, size = row
+                if case_storage.read_member(archive, offset, size) == content:
+                    os.remove(path)
+
+        case_storage.close()
+        self.stdout.write('Archived {} of {} json files'.format(
+            archived, len(legacy_files)))
+        if failed:
+            self.stdout.write('Could not decode {} files: {}'.format(
+                len(failed), ', '.join(failed)))
+
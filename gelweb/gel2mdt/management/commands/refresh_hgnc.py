@@ -0,0 +1,60 @@
+"""Copyright (c) 2018 Great Ormond Street Hospital for Children NHS Foundation
+Trust & Birmingham Women's and Children's NHS Foundation Trust
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import os
+from django.core.management.base import BaseCommand, CommandError
+from gel2mdt.config import load_config
+from gel2mdt.database_utils.hgnc_store import (
+    HGNCStore, HGNC_STORE_FILENAME, HGNC_COMPLETE_SET_URL)
+
+
+class Command(BaseCommand):
+    help = """Load the HGNC complete set into the local HGNC store in
+    gene_storage, which is used to resolve Ensembl gene IDs to HGNC IDs."""
+
+    def add_arguments(self, parser):
+        """Gather options for the refresh."""
+        parser.add_argument('--url', default=HGNC_COMPLETE_SET_URL,
+                            help='Location to download the HGNC complete'
+                            ' set from.')
+        parser.add_argument('--file',
+                            help='Load a previously downloaded copy of'
+                            ' hgnc_complete_set.txt instead of downloading it.')
+
+    def handle(self, *args, **options):
+        """Replace the contents of the HGNC store with the complete set."""
+        config_dict = load_config.LoadConfig().load()
+        gene_storage = config_dict['gene_storage']
+        if not os.path.isdir(gene_storage):
+            raise CommandError(
+                'gene_storage directory {} does not exist'.format(gene_storage))
+        hgnc_store = HGNCStore(os.path.join(gene_storage, HGNC_STORE_FILENAME))
+        try:
+            if options['file']:
+                with open(options['file'], encoding='utf-8') as f:
+                    gene_count = hgnc_store.load(f, options['file'])
+            else:
+                gene_count = hgnc_store.refresh(options['url'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        finally:
+            hgnc_store.close()
+        self.stdout.write('Loaded {} genes into the HGNC store'.format(gene_count))
@@ -45,10 +45,24 @@ class Command(BaseCommand):
         parser.add_argument('--pullt3', action='store_true',
                             help='Include the Tier 3 variants (this is time'
                             ' consuming!)')
-        parser.add_argument('--bins', action='store',
-                            help='Whether to bin cases, and size of bins to'
-                            'use. This increases update time but reduces RAM'
-                            'usage for less powerful servers.')
+        parser.add_argument('--high-water-mark', default=None, type=int,
+                            help='Maximum number of cases held by all stages'
+                            ' of the update at once, which caps RAM usage.'
+                            ' Defaults to ingest_high_water_mark in the'
+                            ' config file, or 200.')
+        parser.add_argument('--batch-size', default=None, type=int,
+                            help='Number of cases annotated and written to'
+                            ' the database together, capped at the high-water'
+                            ' mark. Defaults to ingest_batch_size in the'
+                            ' config file, or 100.')
+        parser.add_argument('--workers', default=None, type=int,
+                            help='Number of cases to fetch from the CIP API'
+                            ' at once. Defaults to cip_api_workers in the'
+                            ' config file, or 1.')
+        parser.add_argument('--parse-processes', default=None, type=int,
+                            help='Number of processes used to parse case'
+                            ' JSON. Defaults to case_parse_processes in the'
+                            ' config file, or 1.')
 
     def handle(self, *args, **options):
         """Run the MultipleCaseAdder with the supplied options."""
@@ -58,4 +72,7 @@ class Command(BaseCommand):
                                 test_data=options['test_data'],
                                 skip_demographics=options['skip_demographics'],
                                 pullt3=options['pullt3'],
-                                bins=options['bins'])
+                                workers=options['workers'],
+                                high_water_mark=options['high_water_mark'],
+                                batch_size=options['batch_size'],
+                                parse_processes=options['parse_processes'])
@@ -0,0 +1,54 @@
+"""Copyright (c) 2018 Great Ormond Street Hospital for Children NHS Foundation
+Trust & Birmingham Women's and Children's NHS Foundation Trust
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+from django.core.management.base import BaseCommand, CommandError
+from gel2mdt.database_utils.panelapp_mirror import PanelAppMirror
+
+
+class Command(BaseCommand):
+    help = """Mirror the PanelApp panel versions used by our cases into the
+    Panel, PanelVersion and PanelVersionGene tables. Versions which have
+    already been mirrored are skipped."""
+
+    def add_arguments(self, parser):
+        """Gather options for the sync."""
+        parser.add_argument('--panel', nargs=2, action='append',
+                            metavar=('PANELAPP_ID', 'VERSION'),
+                            help='Mirror this panel version only. May be'
+                            ' given more than once.')
+        parser.add_argument('--workers', type=int, default=4,
+                            help='Number of panels fetched from PanelApp at'
+                            ' once.')
+
+    def handle(self, *args, **options):
+        """Mirror the panels and report any which failed."""
+        mirror = PanelAppMirror(workers=options['workers'])
+        panels = None
+        if options['panel']:
+            panels = set(tuple(panel) for panel in options['panel'])
+        mirrored = mirror.sync(panels)
+        self.stdout.write('Mirrored {} panel versions'.format(mirrored))
+        for panelapp_id, version, error in mirror.failed_panels:
+            self.stdout.write('Failed to mirror {} v{}: {}'.format(
+                panelapp_id, version, error))
+        if mirror.failed_panels:
+            raise CommandError('{} panel versions could not be mirrored'.format(
+                len(mirror.failed_panels)))
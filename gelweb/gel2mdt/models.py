@@ -19,11 +19,11 @@ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Exists, OuterRef, Q
 from django.utils import timezone
 from django.conf import settings
 from django.contrib.auth.models import User, Group
-import pandas as pd
 from .api_utils.poll_api import PollAPI
 from .model_utils.choices import ChoiceEnum
 from .config import load_config
@@ -50,6 +50,56 @@ class ListUpdate(models.Model):
         app_label= 'gel2mdt'
 
 
+class CaseSyncState(models.Model):
+    """
+    Records the CIP-API list metadata of each case at the time it was last
+    synced into the database, so that unchanged cases can be skipped without
+    downloading their full JSON.
+    """
+    interpretation_request_id = models.CharField(max_length=20, unique=True)
+    sample_type = models.CharField(max_length=25)
+    last_status = models.CharField(max_length=50)
+    last_modified = models.CharField(max_length=50, null=True)
+    sha_hash = models.CharField(max_length=200)
+    archived_version = models.IntegerField(null=True)
+    synced_at = models.DateTimeField()
+
+    def matches(self, case):
+        """
+        Check whether a case dict from the InterpretationList has the same
+        status and modification time as when it was synced. Cases without a
+        modification time can never be shown to be unchanged.
+        """
+        return (case.get("last_modified") is not None
+                and case["last_modified"] == self.last_modified
+                and case["last_status"] == self.last_status)
+
+    class Meta:
+        managed = True
+        db_table = 'CaseSyncState'
+        app_label= 'gel2mdt'
+
+
+class LabKeyCache(models.Model):
+    """
+    Holds the LabKey rows returned for one participant or family ID by one
+    of the DemographicsHandler lookups, so that the ID is not sent to LabKey
+    again until the rows are older than labkey_cache_ttl hours. IDs with no
+    rows are cached with an empty list.
+    """
+    sample_type = models.CharField(max_length=25)
+    lookup = models.CharField(max_length=25)
+    lookup_id = models.CharField(max_length=50)
+    rows = models.TextField()
+    fetched_at = models.DateTimeField()
+
+    class Meta:
+        managed = True
+        db_table = 'LabKeyCache'
+        app_label= 'gel2mdt'
+        unique_together = (('sample_type', 'lookup', 'lookup_id'),)
+
+
 class ToolOrAssemblyVersion(models.Model):
     """
     Represents a tool used or genome build and version used in several use cases
@@ -179,6 +229,9 @@ class PanelVersion(models.Model):
     """
     panel = models.ForeignKey(Panel, on_delete=models.CASCADE)
     version_number = models.CharField(max_length=200)
+    # set by the sync_panelapp command once the genes of this version have
+    # been mirrored into PanelVersionGene
+    mirrored_at = models.DateTimeField(null=True, blank=True)
 
     def __str__(self):
         return str(self.panel.panel_name + ' v' + self.version_number)
@@ -197,6 +250,7 @@ class PanelVersionGene(models.Model):
     class Meta:
         managed = True
         app_label= 'gel2mdt'
+        unique_together = (('panel_version', 'gene'),)
 
     panel_version = models.ForeignKey(PanelVersion, on_delete=models.CASCADE)
     gene = models.ForeignKey(Gene, on_delete=models.CASCADE)
@@ -258,21 +312,79 @@ class InterpretationReportFamilyPanel(models.Model):
 
 
 class GELInterpretationReportQuerySet(models.QuerySet):
+    def latest_versions(self):
+        """
+        Keep only the latest archived version of each ir_family. The check
+        for a newer version is a correlated subquery on the
+        (ir_family, archived_version) index, so the whole table is never
+        loaded. Duplicate version numbers are settled by the higher id.
+        """
+        newer_versions = GELInterpretationReport.objects.filter(
+            ir_family=OuterRef('ir_family')
+        ).filter(
+            Q(archived_version__gt=OuterRef('archived_version')) |
+            Q(archived_version=OuterRef('archived_version'), id__gt=OuterRef('id')))
+        return self.annotate(
+            has_newer_version=Exists(newer_versions)
+        ).filter(has_newer_version=False)
+
+    def bulk_create_versions(self, reports, batch_size=500):
+        """
+        Create a batch of new GELInterpretationReports in a handful of
+        queries. This mirrors GELInterpretationReport.save(): each report
+        takes the next archived_version of its ir_family, inherits the
+        case tracking fields of the current latest version, and the
+        MDTReports, ProbandVariants and CaseComments of that version are
+        moved across to it.
+        """
+        reports = list(reports)
+        if not reports:
+            return reports
+        ir_family_ids = set(report.ir_family_id for report in reports)
+        latest_reports = {
+            report.ir_family_id: report
+            for report in self.model.objects.filter(
+                ir_family_id__in=ir_family_ids).latest_versions()}
+
+        polled_at_datetime = timezone.now()
+        previous_ids = {}
+        for report in reports:
+            latest_report = latest_reports.get(report.ir_family_id)
+            if latest_report is None:
+                report.archived_version = 1
+            else:
+                for field in GELInterpretationReport.CARRIED_FIELDS:
+                    setattr(report, field, getattr(latest_report, field))
+                report.polled_at_datetime = polled_at_datetime
+                report.archived_version = latest_report.archived_version + 1
+                if latest_report.pk is not None:
+                    previous_ids[report.ir_family_id] = latest_report.pk
+            # a second report for the same ir_family in this batch builds
+            # on the first rather than on the stored version
+            latest_reports[report.ir_family_id] = report
+
+        with transaction.atomic():
+            self.model.objects.bulk_create(reports, batch_size=batch_size)
+            if any(report.pk is None for report in reports):
+                # backends other than PostgreSQL do not return primary keys
+                # from bulk_create, so look them up by their version
+                created_ids = {
+                    (ir_family_id, archived_version): pk
+                    for pk, ir_family_id, archived_version
+                    in self.model.objects.filter(
+                        ir_family_id__in=ir_family_ids
+                    ).values_list('id', 'ir_family_id', 'archived_version')}
+                for report in reports:
+                    report.pk = created_ids[
+                        (report.ir_family_id, report.archived_version)]
+            move_report_children({
+                previous_id: latest_reports[ir_family_id].pk
+                for ir_family_id, previous_id in previous_ids.items()},
+                batch_size=batch_size)
+        return reports
+
     def latest_cases_by_sample_type(self, sample_type):
-        qs = self.filter(sample_type=sample_type)
-        if qs:
-            # cases present
-            qs_df = pd.DataFrame(list(qs.values())).sort_values(
-                by=["ir_family_id", "archived_version"]
-            )
-            rm_dup_old = qs_df.drop_duplicates(
-                subset=["ir_family_id"],
-                keep="last"
-            )
-            ids_of_latest_cases = rm_dup_old["id"].tolist()
-            return self.filter(id__in=ids_of_latest_cases)
-        else:
-            return qs
+        return self.filter(sample_type=sample_type).latest_versions()
 
     def latest_cases_by_sample_type_and_user(self, sample_type, username):
         admin = False
@@ -283,36 +395,15 @@ class GELInterpretationReportQuerySet(models.QuerySet):
                 admin = True
             for gmc in group.grouppermissions.gmc.all():
                 allowed_gmcs.append(gmc)
-        qs = self.filter(sample_type=sample_type).prefetch_related('ir_family__participant_family__proband')
-        if qs:
-            # cases present
-            qs_df = pd.DataFrame(list(qs.values())).sort_values(
-                by=["ir_family_id", "archived_version"]
-            )
-            rm_dup_old = qs_df.drop_duplicates(
-                subset=["ir_family_id"],
-                keep="last"
-            )
-            ids_of_latest_cases = rm_dup_old["id"].tolist()
-            if admin:
-                return self.filter(id__in=ids_of_latest_cases)
-            else:
-                return self.filter(id__in=ids_of_latest_cases).filter(
-                    ir_family__participant_family__proband__gmc__in=allowed_gmcs)
-        else:
+        qs = self.filter(sample_type=sample_type).latest_versions()
+        if admin:
             return qs
+        else:
+            return qs.filter(
+                ir_family__participant_family__proband__gmc__in=allowed_gmcs)
 
     def latest_cases_by_user(self, username):
-        qs = self.all()
-        qs_df = pd.DataFrame(list(qs.values())).sort_values(
-            by=["ir_family_id", "archived_version"]
-        )
-        rm_dup_old = qs_df.drop_duplicates(
-            subset=["ir_family_id"],
-            keep="last"
-        )
-        ids_of_latest_cases = rm_dup_old["id"].tolist()
-        return self.filter(id__in=ids_of_latest_cases, assigned_user__username=username)
+        return self.latest_versions().filter(assigned_user__username=username)
 
 
 class GELInterpretationReport(models.Model):
@@ -372,15 +463,28 @@ class GELInterpretationReport(models.Model):
         related_name='second_check_user'
     )
 
+    # case tracking fields which a new version inherits from the last one
+    CARRIED_FIELDS = (
+        'assigned_user_id',
+        'first_check_id',
+        'second_check_id',
+        'mdt_status',
+        'case_sent',
+        'case_status',
+        'pilot_case',
+        'user',
+        'no_primary_findings',
+        'case_code',
+    )
+
     def save(self, overwrite=False, *args, **kwargs):
         """
         Overwrite the model's save method to auto-increment versions for
         duplicate ir_familys. Pass in a InterpretationReportFamily entry.
         """
-        archived_reports = GELInterpretationReport.objects.filter(
-            ir_family=self.ir_family)
-        if archived_reports:
-            latest_report = archived_reports.latest('polled_at_datetime')
+        latest_report = GELInterpretationReport.objects.filter(
+            ir_family=self.ir_family).latest_versions().first()
+        if latest_report:
             if overwrite:
                 latest_report.status = self.status
                 latest_report.updated = self.updated
@@ -405,35 +509,13 @@ class GELInterpretationReport(models.Model):
                 latest_report.case_code = self.case_code
                 super(GELInterpretationReport, latest_report).save(*args, **kwargs)
             else:
-                self.assigned_user = latest_report.assigned_user
-                self.first_check = latest_report.first_check
-                self.second_check = latest_report.second_check
-                self.mdt_status = latest_report.mdt_status
-                self.case_sent = latest_report.case_sent
-                self.case_status = latest_report.case_status
-                self.pilot_case = latest_report.pilot_case
+                for field in self.CARRIED_FIELDS:
+                    setattr(self, field, getattr(latest_report, field))
                 self.polled_at_datetime = timezone.now()
-                self.user = latest_report.user
-                self.no_primary_findings = latest_report.no_primary_findings
-                self.case_code = latest_report.case_code
                 # update the latest saved version.
                 self.archived_version = latest_report.archived_version + 1
                 super(GELInterpretationReport, self).save(*args, **kwargs)
-                mdt_report = MDTReport.objects.filter(interpretation_report=latest_report)
-                if mdt_report:
-                    for report in mdt_report:
-                        report.interpretation_report = self
-                        report.save()
-                proband_variants = ProbandVariant.objects.filter(interpretation_report=latest_report)
-                if proband_variants:
-                    for pv in proband_variants:
-                        pv.interpretation_report = self
-                        pv.save()
-                case_comments = CaseComment.objects.filter(interpretation_report=latest_report)
-                if case_comments:
-                    for comment in case_comments:
-                        comment.interpretation_report = self
-                        comment.save()
+                move_report_children({latest_report.pk: self.pk})
 
         else:
             self.archived_version = 1
@@ -446,6 +528,30 @@ class GELInterpretationReport(models.Model):
         managed = True
         db_table = 'GELInterpretationReport'
         app_label= 'gel2mdt'
+        indexes = [
+            models.Index(fields=['ir_family', 'archived_version']),
+        ]
+
+
+def move_report_children(moves, batch_size=500):
+    """
+    Re-point the MDTReports, ProbandVariants and CaseComments of archived
+    GELInterpretationReports to their replacements. Takes a dict of
+    {old report id: new report id} and issues one UPDATE per child model
+    for each batch of reports.
+    """
+    moves = list(moves.items())
+    for start in range(0, len(moves), batch_size):
+        batch = moves[start:start + batch_size]
+        new_report = models.Case(
+            *[models.When(interpretation_report_id=old_id, then=new_id)
+              for old_id, new_id in batch],
+            output_field=models.IntegerField())
+        old_ids = [old_id for old_id, new_id in batch]
+        for child_model in (MDTReport, ProbandVariant, CaseComment):
+            child_model.objects.filter(
+                interpretation_report_id__in=old_ids
+            ).update(interpretation_report_id=new_report)
 
 
 class ClinicalScientist(models.Model):
@@ -611,6 +717,7 @@ class TranscriptVariant(models.Model):
         managed = True
         db_table = 'TranscriptVariant'
         app_label= 'gel2mdt'
+        unique_together = (('transcript', 'variant'),)
 
 
 class Zygosities(ChoiceEnum):
@@ -747,6 +854,7 @@ class ProbandVariant(models.Model):
         managed = True
         db_table = 'ProbandVariant'
         app_label= 'gel2mdt'
+        unique_together = (('variant', 'interpretation_report'),)
 
 
 class PVFlag(models.Model):
@@ -760,6 +868,7 @@ class PVFlag(models.Model):
         managed = True
         db_table = 'PVFlag'
         app_label = 'gel2mdt'
+        unique_together = (('proband_variant', 'flag_name'),)
 
 
 class RareDiseaseReport(models.Model):
@@ -829,6 +938,7 @@ class ProbandTranscriptVariant(models.Model):
         managed = True
         db_table = 'ProbandTranscriptVariant'
         app_label= 'gel2mdt'
+        unique_together = (('transcript', 'proband_variant'),)
 
 # classes for choice
 class ModesOfInheritance(ChoiceEnum):
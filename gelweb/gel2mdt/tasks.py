@@ -22,10 +22,11 @@ SOFTWARE.
 import requests
 from bs4 import BeautifulSoup
 import os
-from .api_utils.poll_api import PollAPI
+from .api_utils.poll_api import PollAPI, get_shared_session
 from .vep_utils import run_vep_batch
 from .models import *
 from .database_utils.multiple_case_adder import GeneManager, MultipleCaseAdder
+from .database_utils.case_storage import CaseStorage
 from celery import task
 import json
 from json import JSONDecodeError
@@ -130,7 +131,7 @@ def get_gel_content(ir, ir_version):
                 panel_name = panel_section['panelName']
                 version = panel_section['panelVersion']
                 analysis_panels[panel_name] = {}
-                panel_details = requests.get(panel_app_panel_query_version.format(panelhash=panel_name, version=version),
+                panel_details = get_shared_session().get(panel_app_panel_query_version.format(panelhash=panel_name, version=version),
                                              verify=False).json()
                 analysis_panels[panel_name][panel_details['name']] = []
                 try:
@@ -214,7 +215,7 @@ def panel_app(gene_panel, gp_version):
     '''
     gene_list = []
     panel_app_panel_query_version = 'https://bioinfo.extge.co.uk/crowdsourcing/WebServices/get_panel/{gene_panel}/?version={gp_version}'
-    panel_details = requests.get(
+    panel_details = get_shared_session().get(
         panel_app_panel_query_version.format(gene_panel=gene_panel, gp_version=gp_version), verify=False).json()
 
     for gene in panel_details['result']['Genes']:
@@ -535,7 +536,7 @@ class UpdaterFromStorage:
             ]
         )
         config_dict = load_config.LoadConfig().load()
-        self.cip_api_storage = config_dict['cip_api_storage']
+        self.cip_api_storage = CaseStorage(config_dict['cip_api_storage'])
         for report in self.reports:
             self.json = self.load_json_data(report)
             if self.json:
@@ -554,12 +555,7 @@ class UpdaterFromStorage:
         '''
         :return: Dict with key as CIPid and value as value_of_interest
         '''
-        json_path = os.path.join(self.cip_api_storage, '{}.json'.format(report.ir_family.ir_family_id +  "-" +  str(report.archived_version)))
-        if os.path.isfile(json_path):
-            with open(json_path, 'r') as f:
-                return json.load(f)
-        else:
-            return None
+        return self.cip_api_storage.load_json(report.ir_family.ir_family_id, report.archived_version)
 
     def get_proband_json(self):
         """
@@ -23,7 +23,12 @@ import unittest
 from django.test import TestCase
 from gel2mdt.database_utils.multiple_case_adder import TranscriptManager, VariantManager, GeneManager, PanelManager
 import json
-from gel2mdt.database_utils.case_handler import Case
+import pickle
+import hashlib
+from gel2mdt.database_utils.case_handler import (
+    Case, PARSED_FIELDS, parse_case, join_transcript_entries)
+from gel2mdt.models import ToolOrAssemblyVersion, Transcript, Variant
+from types import SimpleNamespace
 from protocols.reports_6_0_0 import InterpretedGenome, InterpretationRequestRD
 
 
@@ -82,3 +87,70 @@ class Test_Case(object):
                                                    'affection_status': False,
                                                    'sequenced': False,
                                                    'sex': 'FEMALE'}]
+
+
+class TestParseCase(TestCase):
+    """
+    Test that cases parsed in a worker process can be sent back to the
+    MultipleCaseAdder.
+    """
+    def setUp(self):
+        self.case_json = json.load(open('gel2mdt/tests/test_files/v6_rd_example.json'))
+
+    def test_pickle_parsed_case(self):
+        parsed = pickle.loads(pickle.dumps(parse_case(self.case_json)))
+        # only the parsed fields are sent back, not the json or a Case
+        assert set(parsed) == set(PARSED_FIELDS)
+        case = Case(
+            case_json=self.case_json,
+            panel_manager=None,
+            variant_manager=None,
+            gene_manager=None,
+            skip_demographics=True,
+            parsed=parsed)
+        parsed_here = parse_case(self.case_json)
+        assert case.request_id == '{}-{}'.format(
+            self.case_json['interpretation_request_id'], self.case_json['version'])
+        assert case.json_hash == parsed_here['json_hash']
+        assert len(case.variants) == len(parsed_here['variants'])
+        assert case.proband_sample
+
+    def test_hash_case_json(self):
+        """
+        The streamed hash matches a hash of the whole sorted json.
+        """
+        parsed = parse_case(self.case_json)
+        hash_buffer = json.dumps(self.case_json, sort_keys=True).encode('utf-8')
+        assert parsed['json_hash'] == hashlib.sha512(hash_buffer).hexdigest()
+
+
+class TestJoinTranscriptEntries(TestCase):
+    """
+    Test that CaseTranscripts are joined to their Variant and Transcript
+    entries through the indexes.
+    """
+    def test_join(self):
+        genome_assembly = ToolOrAssemblyVersion(pk=1)
+        case_variants = [
+            SimpleNamespace(case_id='1-1', variant_count=str(count),
+                            chromosome='1', position=count, ref='A', alt='T')
+            for count in range(2)]
+        variant_entries = [
+            Variant(pk=count + 1, chromosome='1', position=count,
+                    reference='A', alternate='T', genome_assembly_id=1)
+            for count in range(2)]
+        transcript_entries = [
+            Transcript(pk=1, name='ENST1', genome_assembly_id=1),
+            Transcript(pk=2, name='ENST2', genome_assembly_id=2)]
+        case_transcripts = [
+            SimpleNamespace(case_id='1-1', variant_count='1', transcript_name='ENST1'),
+            SimpleNamespace(case_id='1-1', variant_count='0', transcript_name='ENST2')]
+
+        join_transcript_entries(
+            case_transcripts, case_variants, variant_entries,
+            transcript_entries, genome_assembly)
+        assert case_transcripts[0].variant_entry.pk == 2
+        assert case_transcripts[0].transcript_entry.pk == 1
+        assert case_transcripts[1].variant_entry.pk == 1
+        # ENST2 is on another assembly
+        assert case_transcripts[1].transcript_entry is None
@@ -0,0 +1,94 @@
+"""Copyright (c) 2018 Great Ormond Street Hospital for Children NHS Foundation
+Trust & Birmingham Women's and Children's NHS Foundation Trust
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import os
+import json
+import shutil
+import tempfile
+from django.test import TestCase
+from gel2mdt.database_utils.case_storage import CaseStorage
+
+
+class TestCaseStorage(TestCase):
+    """
+    Test writing and reading case jsons in the cip_api_storage archive.
+    """
+    def setUp(self):
+        self.storage_dir = tempfile.mkdtemp()
+        self.case_storage = CaseStorage(self.storage_dir)
+
+    def tearDown(self):
+        self.case_storage.close()
+        shutil.rmtree(self.storage_dir)
+
+    def test_random_access(self):
+        self.case_storage.write('1234-1', 1, b'{"case": 1}', sha_hash='a')
+        self.case_storage.write('1234-2', 1, b'{"case": 2}', sha_hash='b')
+        assert self.case_storage.read('1234-2', 1) == b'{"case": 2}'
+        assert self.case_storage.load_json('1234-1', 1) == {"case": 1}
+        assert self.case_storage.get_hash('1234-1', 1) == 'a'
+        assert self.case_storage.read('1234-3', 1) is None
+
+    def test_rewrite_case(self):
+        self.case_storage.write('1234-1', 1, b'{"case": 1}')
+        self.case_storage.write('1234-1', 1, b'{"case": 2}')
+        assert self.case_storage.read('1234-1', 1) == b'{"case": 2}'
+        assert len(list(self.case_storage.scan())) == 1
+
+    def test_archive_rollover(self):
+        self.case_storage.max_archive_size = 1
+        self.case_storage.write('1234-1', 1, b'{"case": 1}')
+        self.case_storage.write('1234-2', 1, b'{"case": 2}')
+        assert self.case_storage.lookup('1234-1', 1)[1] == 'cases_0001.json.gz'
+        assert self.case_storage.lookup('1234-2', 1)[1] == 'cases_0002.json.gz'
+        assert [case[:2] for case in self.case_storage.scan()] == [
+            ('1234-1', 1), ('1234-2', 1)]
+
+    def test_legacy_file(self):
+        with open(os.path.join(self.storage_dir, '1234-1-2.json'), 'w') as f:
+            json.dump({"case": 1}, f)
+        assert self.case_storage.contains('1234-1', 2)
+        assert self.case_storage.load_json('1234-1', 2) == {"case": 1}
+        assert list(self.case_storage.legacy_files()) == [
+            ('1234-1', 2, os.path.join(self.storage_dir, '1234-1-2.json'))]
+
+    def test_reopened_storage_continues_archive(self):
+        self.case_storage.write('1234-1', 1, b'{"case": 1}')
+        self.case_storage.max_archive_size = 1
+        self.case_storage.write('1234-1', 2, b'{"case": 2}')
+        self.case_storage.close()
+
+        self.case_storage = CaseStorage(self.storage_dir)
+        self.case_storage.write('1234-1', 3, b'{"case": 3}')
+        assert self.case_storage.lookup('1234-1', 3)[1] == 'cases_0002.json.gz'
+        assert self.case_storage.read('1234-1', 3) == b'{"case": 3}'
+
+    def test_storage_shared_between_processes(self):
+        other_storage = CaseStorage(self.storage_dir)
+        self.case_storage.write('1234-1', 1, b'{"case": 1}')
+        other_storage.write_many([
+            ('1234-2', 1, b'{"case": 2}', None),
+            ('1234-3', 1, b'{"case": 3}', None)])
+        self.case_storage.write('1234-4', 1, b'{"case": 4}')
+        other_storage.close()
+        for number in range(1, 5):
+            assert self.case_storage.load_json(
+                '1234-{}'.format(number), 1) == {"case": number}
@@ -0,0 +1,65 @@
+"""Copyright (c) 2018 Great Ormond Street Hospital for Children NHS Foundation
+Trust & Birmingham Women's and Children's NHS Foundation Trust
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import os
+import shutil
+import tempfile
+from django.test import TestCase
+from gel2mdt.database_utils.hgnc_store import HGNCStore
+
+
+COMPLETE_SET = [
+    'hgnc_id\tsymbol\tname\tstatus\tensembl_gene_id\n',
+    'HGNC:5\tA1BG\talpha-1-B glycoprotein\tApproved\tENSG00000121410\n',
+    'HGNC:1100\tBRCA1\tBRCA1 DNA repair associated\tApproved\tENSG00000012048\n',
+    'HGNC:99999\tNOENS\tno ensembl gene\tApproved\t\n',
+]
+
+
+class TestHGNCStore(TestCase):
+    """
+    Test resolving Ensembl gene IDs from the local HGNC store.
+    """
+    def setUp(self):
+        self.gene_storage = tempfile.mkdtemp()
+        self.hgnc_store = HGNCStore(os.path.join(self.gene_storage, 'hgnc.sqlite3'))
+
+    def tearDown(self):
+        self.hgnc_store.close()
+        shutil.rmtree(self.gene_storage)
+
+    def test_resolve(self):
+        assert self.hgnc_store.is_empty()
+        assert self.hgnc_store.load(COMPLETE_SET, 'test') == 2
+        resolved = self.hgnc_store.resolve(['ENSG00000012048', 'ENSG00000000000'])
+        assert resolved == {'ENSG00000012048': ('1100', 'BRCA1')}
+        assert self.hgnc_store.last_release()[1:] == ('test', 2)
+
+    def test_reload_replaces_genes(self):
+        self.hgnc_store.load(COMPLETE_SET, 'test')
+        self.hgnc_store.load(COMPLETE_SET[:2], 'test')
+        assert self.hgnc_store.resolve(['ENSG00000012048']) == {}
+
+    def test_empty_set_keeps_genes(self):
+        self.hgnc_store.load(COMPLETE_SET, 'test')
+        with self.assertRaises(ValueError):
+            self.hgnc_store.load(COMPLETE_SET[:1], 'test')
+        assert len(self.hgnc_store.get_genes()) == 2
@@ -0,0 +1,162 @@
+"""Copyright (c) 2018 Great Ormond Street Hospital for Children NHS Foundation
+Trust & Birmingham Women's and Children's NHS Foundation Trust
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import threading
+from types import SimpleNamespace
+from django.test import TestCase
+from django.utils import timezone
+from gel2mdt.database_utils.ingest_pipeline import IngestPipeline
+from gel2mdt.database_utils.multiple_case_adder import MultipleCaseAdder
+from gel2mdt.models import (
+    GELInterpretationReport, InterpretationReportFamily,
+    ToolOrAssemblyVersion)
+
+
+class StubCaseAdder(object):
+    """
+    Stands in for a MultipleCaseAdder, recording what each stage of the
+    pipeline is given and how many cases are held at once.
+    """
+    def __init__(self, fail_polls=(), fail_build=False):
+        self.sample_type = 'raredisease'
+        self.workers = 2
+        self.cases_to_skip = []
+        self.fail_polls = fail_polls
+        self.fail_build = fail_build
+        self.written = []
+        self.polled = []
+        self.held = 0
+        self.max_held = 0
+        self.lock = threading.Lock()
+
+    def poll_case_json(self, case):
+        with self.lock:
+            self.polled.append(case['interpretation_request_id'])
+            self.held += 1
+            self.max_held = max(self.max_held, self.held)
+        if case['interpretation_request_id'] in self.fail_polls:
+            with self.lock:
+                self.held -= 1
+            raise IOError('poll failed')
+        return case, None
+
+    def build_cases(self, polled_cases, on_failed=None):
+        for case, future in polled_cases:
+            if self.fail_build:
+                raise ValueError('build failed')
+            try:
+                future.result()
+            except IOError:
+                on_failed(case)
+                continue
+            yield case, SimpleNamespace(
+                request_id=case['interpretation_request_id'], json_hash='hash')
+
+    def annotate_cases(self, cases):
+        pass
+
+    def update_database(self, annotate=True):
+        cases = self.cases_to_add + self.cases_to_update
+        self.written += [c.request_id for c in cases]
+        with self.lock:
+            self.held -= len(cases)
+
+    def record_update(self, success, error, added, updated):
+        pass
+
+
+class SyncingCaseAdder(StubCaseAdder):
+    """
+    A StubCaseAdder which records and checks CaseSyncStates as the
+    MultipleCaseAdder does.
+    """
+    filter_unchanged_cases = MultipleCaseAdder.filter_unchanged_cases
+    record_sync_state = MultipleCaseAdder.record_sync_state
+
+    def __init__(self, cases_to_poll):
+        super(SyncingCaseAdder, self).__init__()
+        self.upsert_batch_size = 500
+        self.poll_metadata = None
+        self.unchanged_cases = []
+        self.cases_to_poll = self.filter_unchanged_cases(cases_to_poll)
+
+
+class TestIngestPipeline(TestCase):
+    """
+    Test the ingest pipeline with stubbed fetch, parse, annotate and write
+    stages.
+    """
+    def setUp(self):
+        self.cases = [
+            {'interpretation_request_id': '{}-1'.format(number)}
+            for number in range(20)]
+
+    def test_order_and_bound(self):
+        case_adder = StubCaseAdder()
+        pipeline = IngestPipeline(case_adder, high_water_mark=4, batch_size=10)
+        assert pipeline.batch_size == 4
+        pipeline.run(self.cases)
+        assert case_adder.written == [
+            case['interpretation_request_id'] for case in self.cases]
+        assert case_adder.max_held <= 4
+
+    def test_failed_polls_release_slots(self):
+        failed = set('{}-1'.format(number) for number in range(0, 20, 2))
+        case_adder = StubCaseAdder(fail_polls=failed)
+        pipeline = IngestPipeline(case_adder, high_water_mark=2, batch_size=1)
+        pipeline.run(self.cases)
+        assert len(case_adder.written) == 10
+        assert not failed.intersection(case_adder.written)
+
+    def test_stage_error_raised(self):
+        case_adder = StubCaseAdder(fail_build=True)
+        pipeline = IngestPipeline(case_adder, high_water_mark=4, batch_size=2)
+        with self.assertRaises(Exception) as context:
+            pipeline.run(self.cases)
+        assert 'build failed' in str(context.exception)
+
+    def test_unchanged_cases_synced(self):
+        ir_family = InterpretationReportFamily.objects.create(
+            ir_family_id='0-1', priority='routine', cip='omicia')
+        GELInterpretationReport(
+            ir_family=ir_family,
+            status='sent_to_gmcs',
+            updated=timezone.now(),
+            sample_type='raredisease',
+            assembly=ToolOrAssemblyVersion.objects.create(
+                tool_name='genome_build', version_number='GRCh38'),
+            user='test',
+            sha_hash='hash').save()
+        cases = [{
+            'interpretation_request_id': '0-1',
+            'last_status': 'sent_to_gmcs',
+            'last_modified': '2018-01-01T00:00:00'}]
+
+        case_adder = SyncingCaseAdder(cases)
+        IngestPipeline(case_adder).run(case_adder.cases_to_poll)
+        assert case_adder.polled == ['0-1']
+        assert case_adder.cases_to_skip == ['0-1']
+
+        case_adder = SyncingCaseAdder(cases)
+        assert case_adder.cases_to_poll == []
+        assert case_adder.unchanged_cases == ['0-1']
+        IngestPipeline(case_adder).run(case_adder.cases_to_poll)
+        assert case_adder.polled == []
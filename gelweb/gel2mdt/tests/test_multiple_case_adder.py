@@ -22,8 +22,12 @@ SOFTWARE.
 import unittest
 from django.test import TestCase
 
-from ..database_utils.multiple_case_adder import MultipleCaseAdder
+from ..database_utils.multiple_case_adder import MultipleCaseAdder, PanelManager
 from ..database_utils.case_handler import Case, CaseModel, ManyCaseModel
+from ..database_utils.natural_keys import NaturalKeyResolver
+from ..database_utils.upsert import BulkUpserter
+from ..database_utils.stage_scheduler import StageScheduler
+from ..database_utils.demographics_handler import DemographicsHandler
 from ..models import *
 
 import re
@@ -276,8 +280,8 @@ class TestIdentifyCases(TestCase):
 
         to_skip = case_update_handler.cases_to_skip
         assert len(to_skip) > 0
-        for case in to_skip:
-            assert case.request_id in test_cases.request_id_list
+        for request_id in to_skip:
+            assert request_id in test_cases.request_id_list
 
 
 class TestCaseModel(TestCase):
@@ -291,12 +295,13 @@ class TestCaseModel(TestCase):
         """
         Return created=False when a Clinician is not known to the db.
         """
-        clinician_objects = Clinician.objects.all()
+        clinician_objects = NaturalKeyResolver(Clinician)
         clinician = CaseModel(Clinician, {
             "name": "test",
             "email": "test",
             "hospital": "test"
         }, clinician_objects)
+        clinician_objects.resolve()
         print(clinician.entry)
         assert clinician.entry is False  # checking for a literal False
 
@@ -312,11 +317,87 @@ class TestCaseModel(TestCase):
         archived_clinician = Clinician.objects.create(
             **clinician_attributes
         )
-        clinician_objects = Clinician.objects.all()
+        clinician_objects = NaturalKeyResolver(Clinician)
 
         test_clinician = CaseModel(Clinician, clinician_attributes, clinician_objects)
+        clinician_objects.resolve()
         assert test_clinician.entry.id == archived_clinician.id
 
+    def test_resolve_shared_key(self):
+        """
+        CaseModels with the same natural key are resolved in one lookup, and
+        keys already resolved are returned without waiting for resolve().
+        """
+        clinician_attributes = {
+            "name": "test",
+            "email": "test",
+            "hospital": "test"
+        }
+        archived_clinician = Clinician.objects.create(
+            **clinician_attributes
+        )
+        clinician_objects = NaturalKeyResolver(Clinician)
+
+        first_clinician = CaseModel(Clinician, clinician_attributes, clinician_objects)
+        second_clinician = CaseModel(Clinician, clinician_attributes, clinician_objects)
+        assert first_clinician.entry is False
+        assert len(clinician_objects.pending) == 1
+        clinician_objects.resolve()
+        assert first_clinician.entry.id == archived_clinician.id
+        assert second_clinician.entry.id == archived_clinician.id
+
+        third_clinician = CaseModel(Clinician, clinician_attributes, clinician_objects)
+        assert third_clinician.entry.id == archived_clinician.id
+
+    def test_chunk_filter_matches_whole_keys(self):
+        """
+        Only rows matching a whole key are fetched, not rows which match each
+        column of a different key.
+        """
+        Clinician.objects.create(name="a", email="x", hospital="h1")
+        Clinician.objects.create(name="b", email="x", hospital="h2")
+        clinician_objects = NaturalKeyResolver(Clinician)
+        chunk_filter = clinician_objects.get_chunk_filter([
+            ("a", "h2", "x"), ("b", "h1", "x")])
+        assert not Clinician.objects.filter(chunk_filter).exists()
+
+
+class TestCaseSyncState(TestCase):
+    """
+    Test the metadata comparison used to skip cases which have not changed
+    since they were last synced.
+    """
+    def setUp(self):
+        self.sync_state = CaseSyncState.objects.create(
+            interpretation_request_id="1234-1",
+            sample_type="raredisease",
+            last_status="sent_to_gmcs",
+            last_modified="2018-01-01T00:00:00Z",
+            sha_hash="test",
+            synced_at=timezone.now()
+        )
+
+    def test_unchanged_case(self):
+        assert self.sync_state.matches({
+            "interpretation_request_id": "1234-1",
+            "last_status": "sent_to_gmcs",
+            "last_modified": "2018-01-01T00:00:00Z"
+        })
+
+    def test_changed_case(self):
+        assert not self.sync_state.matches({
+            "interpretation_request_id": "1234-1",
+            "last_status": "report_sent",
+            "last_modified": "2018-01-01T00:00:00Z"
+        })
+
+    def test_case_without_last_modified(self):
+        assert not self.sync_state.matches({
+            "interpretation_request_id": "1234-1",
+            "last_status": "sent_to_gmcs",
+            "last_modified": None
+        })
+
 
 class TestAddCases(TestCase):
     """
@@ -444,3 +525,175 @@ class TestAddCases(TestCase):
         Test that a new IR has been made and links to the correct IRfamily.
         """
         pass
+
+
+class TestMirroredPanels(TestCase):
+    """
+    Test that panel versions mirrored by sync_panelapp are read from the
+    database in the shape of a panelApp response.
+    """
+    def setUp(self):
+        panel = Panel.objects.create(
+            panelapp_id="test_panel", panel_name="Test Panel",
+            disease_group="Group", disease_subgroup="Subgroup")
+        self.mirrored = PanelVersion.objects.create(
+            panel=panel, version_number="1.0", mirrored_at=timezone.now())
+        PanelVersion.objects.create(panel=panel, version_number="2.0")
+        gene = Gene.objects.create(
+            ensembl_id="ENSG00000012048", hgnc_name="BRCA1", hgnc_id="1100")
+        PanelVersionGene.objects.create(
+            panel_version=self.mirrored, gene=gene,
+            level_of_confidence="HighEvidence")
+        self.panel_manager = PanelManager()
+
+    def test_mirrored_panel_loaded(self):
+        self.panel_manager.load_mirrored_panels([("test_panel", "1.0")])
+        response = self.panel_manager.fetch_panel_response("test_panel", "1.0")
+        assert response.results["Genes"] == [{
+            "EnsembleGeneIds": "ENSG00000012048",
+            "GeneSymbol": "BRCA1",
+            "LevelOfConfidence": "HighEvidence"}]
+        assert self.panel_manager.fetch_panel_names("test_panel")["SpecificDiseaseName"] == "Test Panel"
+
+    def test_unmirrored_panel_not_loaded(self):
+        self.panel_manager.load_mirrored_panels([("test_panel", "2.0")])
+        assert not self.panel_manager.fetch_panel_response("test_panel", "2.0")
+
+    def test_searched_panels_not_queried_again(self):
+        self.panel_manager.load_mirrored_panels([("test_panel", "1.0"), ("test_panel", "2.0")])
+        with self.assertNumQueries(0):
+            self.panel_manager.load_mirrored_panels([("test_panel", "1.0"), ("test_panel", "2.0")])
+
+
+class TestDemographicsCache(TestCase):
+    """
+    Test that LabKey rows are answered from the cache until they expire.
+    """
+    def setUp(self):
+        self.handler = DemographicsHandler('raredisease')
+        self.queried = []
+        self.handler.select_rows = self.select_rows
+        self.handler.write_cache('demographics', {
+            'p1': [{'participant_id': 'p1', 'surname': 'cached'}]})
+
+    def select_rows(self, schema_name, query_name, column, ids):
+        self.queried += ids
+        return [{column: lookup_id, 'surname': 'labkey'} for lookup_id in ids]
+
+    def test_cached_ids_not_queried(self):
+        rows = self.handler.lookup({'demographics': ['p1', 'p2']})['demographics']
+        assert rows['p1'][0]['surname'] == 'cached'
+        assert rows['p2'][0]['surname'] == 'labkey'
+        assert self.queried == ['p2']
+
+    def test_expired_ids_queried(self):
+        LabKeyCache.objects.update(fetched_at=timezone.now() - self.handler.ttl * 2)
+        rows = self.handler.lookup({'demographics': ['p1']})['demographics']
+        assert rows['p1'][0]['surname'] == 'labkey'
+
+    def test_cancer_has_no_diagnosis_lookup(self):
+        self.handler.sample_type = 'cancer'
+        assert self.handler.lookup({'diagnosis': ['p1']})['diagnosis'] is None
+
+
+class TestBulkUpserter(TestCase):
+    """
+    Test that new rows are written once per natural key and their entries
+    handed to the resolver.
+    """
+    def setUp(self):
+        self.existing = Gene.objects.create(
+            ensembl_id='ENSG1', hgnc_name='GENE1', hgnc_id='HGNC:1',
+            description='existing')
+        self.resolver = NaturalKeyResolver(Gene)
+        self.upserter = BulkUpserter(Gene, self.resolver, batch_size=1)
+
+    def get_attributes(self, number):
+        return {
+            'ensembl_id': 'ENSG{}'.format(number),
+            'hgnc_name': 'GENE{}'.format(number),
+            'hgnc_id': 'HGNC:{}'.format(number),
+            'description': 'new'}
+
+    def test_upsert(self):
+        assert self.upserter.has_key_constraint
+        self.upserter.upsert([
+            self.get_attributes(1),
+            self.get_attributes(2),
+            self.get_attributes(2)])
+        assert Gene.objects.count() == 2
+        assert Gene.objects.get(hgnc_id='HGNC:1').description == 'existing'
+        assert self.resolver.entries[('HGNC:1',)].pk == self.existing.pk
+        assert self.resolver.entries[('HGNC:2',)].hgnc_name == 'GENE2'
+
+    def test_upsert_update_fields(self):
+        CaseSyncState.objects.create(
+            interpretation_request_id='1-1', sample_type='raredisease',
+            last_status='sent_to_gmcs', sha_hash='old',
+            synced_at=timezone.now())
+        upserter = BulkUpserter(
+            CaseSyncState, NaturalKeyResolver(CaseSyncState),
+            update_fields=('last_status', 'sha_hash'))
+        assert upserter.has_key_constraint
+        upserter.upsert([{
+            'interpretation_request_id': request_id,
+            'sample_type': 'raredisease',
+            'last_status': 'report_generated',
+            'sha_hash': 'new',
+            'synced_at': timezone.now()} for request_id in ('1-1', '2-1')])
+        assert CaseSyncState.objects.count() == 2
+        assert CaseSyncState.objects.get(
+            interpretation_request_id='1-1').sha_hash == 'new'
+
+    def test_null_keys_not_deduplicated(self):
+        upserter = BulkUpserter(ReportEvent, NaturalKeyResolver(ReportEvent))
+        upserter.upsert([
+            {'re_id': 'RE1', 'penetrance': 'complete'},
+            {'re_id': 'RE1', 'penetrance': 'incomplete'}])
+        assert ReportEvent.objects.filter(re_id='RE1').count() == 2
+
+    def test_copy_only_for_postgres_variant_tables(self):
+        assert not self.upserter.use_copy
+        assert BulkUpserter.get_copy_value(None) == '\\N'
+        assert BulkUpserter.get_copy_value(True) == 't'
+        assert BulkUpserter.get_copy_value('a\tb\\c\n') == 'a\\tb\\\\c\\n'
+
+
+class TestStageScheduler(TestCase):
+    """
+    Test that stages start only once their dependencies have finished.
+    """
+    def run_stages(self, workers):
+        finished = []
+        scheduler = StageScheduler(workers=workers)
+        scheduler.add_stage('a', lambda: finished.append('a'))
+        scheduler.add_stage('b', lambda: finished.append('b'), ('a',))
+        scheduler.add_stage('c', lambda: finished.append('c'))
+        scheduler.add_stage('d', lambda: finished.append('d'), ('b', 'c'))
+        scheduler.run()
+        return finished
+
+    def test_dependencies_respected(self):
+        assert self.run_stages(1) == ['a', 'b', 'c', 'd']
+        finished = self.run_stages(3)
+        assert sorted(finished) == ['a', 'b', 'c', 'd']
+        assert finished.index('a') < finished.index('b') < finished.index('d')
+        assert finished.index('c') < finished.index('d')
+
+    def test_unknown_dependency(self):
+        scheduler = StageScheduler()
+        with self.assertRaises(ValueError):
+            scheduler.add_stage('b', lambda: None, ('a',))
+
+    def test_error_stops_later_stages(self):
+        finished = []
+
+        def fail():
+            raise RuntimeError('failed')
+
+        scheduler = StageScheduler(workers=2)
+        scheduler.add_stage('a', fail)
+        scheduler.add_stage('b', lambda: finished.append('b'), ('a',))
+        with self.assertRaises(RuntimeError):
+            scheduler.run()
+        assert finished == []
@@ -19,9 +19,16 @@ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
+import os
+import time
 import unittest
+import threading
+from unittest import mock
+import jwt
 from django.test import TestCase
-from ..api_utils.poll_api import PollAPI
+from ..api_utils.poll_api import (
+    PollAPI, TokenCache, get_credentials, get_shared_session)
+from ..config.load_config import Config
 from ..api_utils.cip_utils import InterpretationList
 
 
@@ -31,6 +38,70 @@ class Poll_CIP_API_TestCase(TestCase):
         cip_api_poll.get_json_response()
 
 
+class TestTokenCache(TestCase):
+    """
+    Test that CIP-API tokens are shared until they are close to expiry.
+    """
+    def setUp(self):
+        self.token_cache = TokenCache()
+        self.fetched = []
+
+    def fetch_token(self, lifetime):
+        token = jwt.encode({'exp': int(time.time()) + lifetime, 'n': len(self.fetched)}, 'secret')
+        if isinstance(token, bytes):
+            token = token.decode()
+        self.fetched.append(token)
+        return token
+
+    def test_token_reused(self):
+        first, decoded = self.token_cache.get_token('cip_api', lambda: self.fetch_token(3600))
+        second, decoded = self.token_cache.get_token('cip_api', lambda: self.fetch_token(3600))
+        assert first == second
+        assert len(self.fetched) == 1
+
+    def test_token_refreshed_near_expiry(self):
+        self.token_cache.get_token('cip_api', lambda: self.fetch_token(30))
+        self.token_cache.get_token('cip_api', lambda: self.fetch_token(3600))
+        assert len(self.fetched) == 2
+
+    def test_rejected_token_invalidated(self):
+        token, decoded = self.token_cache.get_token('cip_api', lambda: self.fetch_token(3600))
+        self.token_cache.invalidate('cip_api', token)
+        self.token_cache.get_token('cip_api', lambda: self.fetch_token(3600))
+        assert len(self.fetched) == 2
+
+
+class TestSharedSession(TestCase):
+    def test_session_shared(self):
+        assert get_shared_session() is get_shared_session()
+        assert PollAPI("panelapp", "get_panel/").session is None
+
+
+class TestGetCredentials(TestCase):
+    """
+    Test that missing credentials are only prompted for on the main thread.
+    """
+    def test_missing_credentials_raise_in_thread(self):
+        errors = []
+
+        def run():
+            try:
+                get_credentials(Config())
+            except ValueError as e:
+                errors.append(e)
+
+        with mock.patch.dict(os.environ, clear=True):
+            thread = threading.Thread(target=run)
+            thread.start()
+            thread.join()
+        assert len(errors) == 1
+
+    def test_credentials_set(self):
+        with mock.patch.dict(os.environ, {
+                'cip_api_username': 'user', 'cip_api_password': 'password'}):
+            get_credentials(Config())
+
+
 class TestInterpretationList(TestCase):
     def setUp(self):
         self.case_list_handler = InterpretationList()
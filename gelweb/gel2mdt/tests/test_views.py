@@ -23,6 +23,7 @@ import unittest
 from django.test import TestCase, Client
 from ..models import *
 from django.urls import reverse
+from django.utils import timezone
 from ..factories import *
 import factory
 
@@ -412,3 +413,43 @@ class ViewTests(TestCase):
         '''
         Tests that when you are a clinician, you get redirected to the correct view
         '''
+
+
+class LatestVersionTests(TestCase):
+    """
+    Testing the database-side resolution of the latest report versions.
+    """
+
+    def test_latest_versions(self):
+        ir_family = InterpretationReportFamilyFactory()
+        first = GELInterpretationReportFactory(ir_family=ir_family)
+        second = GELInterpretationReportFactory(ir_family=ir_family)
+        other = GELInterpretationReportFactory()
+
+        latest = GELInterpretationReport.objects.latest_versions()
+        self.assertEqual(second.archived_version, 2)
+        self.assertIn(second, latest)
+        self.assertIn(other, latest)
+        self.assertNotIn(first, latest)
+        self.assertEqual(
+            list(GELInterpretationReport.objects.latest_cases_by_sample_type(
+                'raredisease').filter(ir_family=ir_family)),
+            [second])
+
+    def test_bulk_create_versions(self):
+        ir_family = InterpretationReportFamilyFactory()
+        first = GELInterpretationReportFactory(
+            ir_family=ir_family, case_status='U', pilot_case=True)
+        comment = CaseComment.objects.create(
+            interpretation_report=first, comment='test', time=timezone.now())
+        new_family = InterpretationReportFamilyFactory()
+
+        reports = GELInterpretationReport.objects.bulk_create_versions([
+            GELInterpretationReportFactory.build(ir_family=ir_family),
+            GELInterpretationReportFactory.build(ir_family=new_family),
+        ])
+        self.assertEqual([report.archived_version for report in reports], [2, 1])
+        self.assertEqual(reports[0].case_status, 'U')
+        self.assertTrue(reports[0].pilot_case)
+        comment.refresh_from_db()
+        self.assertEqual(comment.interpretation_report_id, reports[0].pk)
@@ -19,11 +19,105 @@ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
+import os
+import shutil
+import tempfile
 import unittest
 from django.test import TestCase
 from ..vep_utils import run_vep_batch
+from ..vep_utils.annotation_cache import AnnotationCache
+from ..vep_utils.vep_pool import get_vep_pool
+from ..config.load_config import Config
 # from ..database_utils import multiple_case_adder
 # from ..models import *
 #
 # Family.objects.filter(gel_family_id=100).delete()
 # multiple_case_adder.MultipleCaseAdder(test_data=True)
+
+
+class TestAnnotationCache(TestCase):
+    """
+    Test that VEP annotations are reused for the same variant in other cases.
+    """
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.annotation_cache = AnnotationCache(
+            os.path.join(self.cache_dir, 'annotations.sqlite3'), 91, True)
+        self.variant = run_vep_batch.CaseVariant(
+            chromosome='1', position=100, case_id='1234-1', variant_count='1',
+            ref='A', alt='T', genome_build='GRCh37')
+        self.transcript = run_vep_batch.CaseTranscript(
+            '1234-1', '1', 'ENSG00000000001', 'GENE1', '1', 'ENST00000000001',
+            True, '1', 'missense_variant', '0.01', 'benign', 'tolerated',
+            'c.1A>T', 'p.Met1Leu', '1:g.100A>T')
+
+    def tearDown(self):
+        self.annotation_cache.close()
+        shutil.rmtree(self.cache_dir)
+
+    def test_cache_miss(self):
+        annotated, unannotated = self.annotation_cache.split([self.variant])
+        assert annotated == []
+        assert unannotated == [self.variant]
+
+    def test_cache_hit_in_other_case(self):
+        self.annotation_cache.store([self.variant], [self.transcript])
+        other_variant = run_vep_batch.CaseVariant(
+            chromosome='1', position=100, case_id='5678-1', variant_count='3',
+            ref='A', alt='T', genome_build='GRCh37')
+        annotated, unannotated = self.annotation_cache.split([other_variant])
+        assert unannotated == []
+        variant, transcripts = annotated[0]
+        assert variant is other_variant
+        assert transcripts[0]['transcript_name'] == 'ENST00000000001'
+
+    def test_store_streamed_transcripts(self):
+        transcripts = []
+        self.annotation_cache.store(
+            [self.variant],
+            run_vep_batch.collect(iter([self.transcript]), transcripts))
+        assert transcripts == [self.transcript]
+        assert not hasattr(self.transcript, '__dict__')
+        annotated, unannotated = self.annotation_cache.split([self.variant])
+        assert unannotated == []
+
+    def test_cache_version_change(self):
+        self.annotation_cache.store([self.variant], [self.transcript])
+        new_cache = AnnotationCache(
+            os.path.join(self.cache_dir, 'annotations.sqlite3'), 92, True)
+        annotated, unannotated = new_cache.split([self.variant])
+        new_cache.close()
+        assert unannotated == [self.variant]
+
+
+class TestVepWorkerPool(TestCase):
+    """
+    Test that the VEP worker pool is reused between jobs and cleans up after
+    each one.
+    """
+    def setUp(self):
+        self.config_dict = Config({'remoteVEP': 'False', 'vep': 'vep', 'cache': '/tmp',
+                                   'vep_cpu_budget': '4', 'vep_fork': '2'})
+        self.pool = get_vep_pool(self.config_dict)
+        self.pool.healthy = True
+
+    def test_pool_reused(self):
+        self.assertIs(get_vep_pool(Config(self.config_dict)), self.pool)
+        self.assertEqual(self.pool.concurrent_shards, 2)
+
+    def test_pool_rebuilt_on_config_change(self):
+        config_dict = Config(self.config_dict, vep_fork='4')
+        self.assertIsNot(get_vep_pool(config_dict), self.pool)
+
+    def test_job_directory_removed(self):
+        with self.pool.job() as directory:
+            vcf = run_vep_batch.generate_vcf([run_vep_batch.CaseVariant(
+                '1', 1000, 1, 0, 'A', 'T', 'GRCh37')], directory)
+            self.assertTrue(os.path.exists(vcf['hg19_vcf']))
+        self.assertFalse(os.path.exists(directory))
+
+    def test_failed_job_rechecks_health(self):
+        with self.assertRaises(ValueError):
+            with self.pool.job():
+                raise ValueError
+        self.assertFalse(self.pool.healthy)
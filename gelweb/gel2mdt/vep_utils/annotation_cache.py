@@ -0,0 +1,164 @@
+"""Copyright (c) 2018 Great Ormond Street Hospital for Children NHS Foundation
+Trust & Birmingham Women's and Children's NHS Foundation Trust
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import json
+import sqlite3
+
+
+# the CaseTranscript fields which come from VEP, and so can be reused for
+# the same variant in any case
+ANNOTATION_FIELDS = (
+    'gene_ensembl_id',
+    'gene_hgnc_name',
+    'gene_hgnc_id',
+    'transcript_name',
+    'transcript_canonical',
+    'transcript_strand',
+    'proband_transcript_variant_effect',
+    'transcript_variant_af_max',
+    'variant_polyphen',
+    'variant_sift',
+    'transcript_variant_hgvs_c',
+    'transcript_variant_hgvs_p',
+    'transcript_variant_hgvs_g',
+)
+
+
+def get_assembly(genome_build):
+    """
+    Reduce a genome build to the assembly VEP was run with.
+    """
+    if 'GRCh37' in genome_build:
+        return 'GRCh37'
+    elif 'GRCh38' in genome_build:
+        return 'GRCh38'
+    return genome_build
+
+
+class AnnotationCache(object):
+    """
+    Persistent store of VEP annotations, so that a variant which has been
+    annotated before is not sent to VEP again.
+
+    Annotations are keyed by chromosome, position, ref, alt and assembly of
+    the variant, together with the VEP cache_version and whether the merged
+    cache was used, so changing either of those in the config file starts a
+    fresh set of annotations. The annotation of a variant is the list of
+    ANNOTATION_FIELDS of each of its CaseTranscripts; variants which VEP gave
+    no transcripts are stored with an empty list.
+
+    Attributes:
+        path (str): location of the SQLite database holding the annotations.
+        cache_version (str): the VEP cache_version from the config file.
+        merged (bool): whether VEP is run with the merged cache.
+        chunk_size (int): the maximum number of variants looked up per query.
+    """
+    chunk_size = 500
+
+    def __init__(self, path, cache_version, merged):
+        self.path = path
+        self.cache_version = str(cache_version)
+        self.merged = int(bool(merged))
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS annotation ("
+            "variant TEXT NOT NULL, "
+            "cache_version TEXT NOT NULL, "
+            "merged INTEGER NOT NULL, "
+            "transcripts TEXT NOT NULL, "
+            "PRIMARY KEY (variant, cache_version, merged))")
+        self.connection.commit()
+
+    @staticmethod
+    def get_key(variant):
+        """
+        Return the key of a CaseVariant, without cache_version and merged.
+        """
+        return ':'.join((
+            str(variant.chromosome),
+            str(variant.position),
+            variant.ref,
+            variant.alt,
+            get_assembly(variant.genome_build)))
+
+    def fetch(self, keys):
+        """
+        Return a dict of key and list of transcript field dicts for each of
+        the keys which have been annotated.
+        """
+        keys = list(set(keys))
+        annotations = {}
+        for start in range(0, len(keys), self.chunk_size):
+            chunk = keys[start:start + self.chunk_size]
+            rows = self.connection.execute(
+                "SELECT variant, transcripts FROM annotation "
+                "WHERE cache_version = ? AND merged = ? "
+                "AND variant IN ({})".format(','.join('?' * len(chunk))),
+                [self.cache_version, self.merged] + chunk)
+            for key, transcripts in rows:
+                annotations[key] = json.loads(transcripts)
+        return annotations
+
+    def split(self, variants):
+        """
+        Split a list of CaseVariants into those which have been annotated and
+        those which need to be sent to VEP.
+        :returns: tuple of a list of (CaseVariant, list of transcript field
+            dicts) for annotated variants, and a list of CaseVariants to
+            annotate
+        """
+        annotations = self.fetch(self.get_key(variant) for variant in variants)
+        annotated = []
+        unannotated = []
+        for variant in variants:
+            transcripts = annotations.get(self.get_key(variant))
+            if transcripts is None:
+                unannotated.append(variant)
+            else:
+                annotated.append((variant, transcripts))
+        return annotated, unannotated
+
+    def store(self, variants, case_transcripts):
+        """
+        Store the annotation of each variant sent to VEP from the
+        CaseTranscripts VEP returned for them.
+        """
+        transcripts_by_id = {}
+        for case_transcript in case_transcripts:
+            variant_id = (case_transcript.case_id, str(case_transcript.variant_count))
+            transcripts_by_id.setdefault(variant_id, []).append({
+                field: getattr(case_transcript, field)
+                for field in ANNOTATION_FIELDS})
+
+        rows = {}
+        for variant in variants:
+            variant_id = (variant.case_id, str(variant.variant_count))
+            rows[self.get_key(variant)] = json.dumps(
+                transcripts_by_id.get(variant_id, []))
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO annotation "
+            "(variant, cache_version, merged, transcripts) VALUES (?, ?, ?, ?)",
+            [(key, self.cache_version, self.merged, transcripts)
+             for key, transcripts in rows.items()])
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
@@ -16,8 +16,18 @@ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
+from collections import namedtuple
 from pysam import VariantFile
 
+
+# the CSQ fields used by the ingest, in the order they are held in VepTranscript
+VEP_TRANSCRIPT_FIELDS = ('Feature', 'Gene', 'SYMBOL', 'HGNC_ID', 'CANONICAL', 'STRAND', 'Consequence', 'MAX_AF',
+                         'PolyPhen', 'SIFT', 'HGVSc', 'HGVSp', 'HGVSg')
+
+# compact record of one transcript annotation of a variant, as yielded by ParseVep.iter_transcripts()
+VepTranscript = namedtuple('VepTranscript', ('variant_id',) + VEP_TRANSCRIPT_FIELDS)
+
+
 class ParseVep:
     """
     Class of functions for parsing VEP annotated vcf files.
@@ -70,47 +80,35 @@ class ParseVep:
             csq_dict[info[0]] = info[1]
         return csq_dict
 
-    def read_file(self, file):
+    def iter_transcripts(self, file):
         """
-        Reads in a
+        Streams the transcript annotations out of a VEP annotated vcf, one VepTranscript at a time, without holding
+        the rest of the file in memory. The CSQ header is parsed once into the positions of VEP_TRANSCRIPT_FIELDS,
+        and only those fields are kept. As in read_file, a transcript listed more than once for the same variant is
+        only yielded for its last entry.
         :param file: A VCF file that as been annotated with VEP
-        :return: A list of dictionaries containing information about all the variants
+        :return: A generator of VepTranscript records
         """
         vep_vcf = VariantFile(file)
         try:
-            csq_fields = str(vep_vcf.header.info['CSQ'].record)
-            csq_fields = self.get_fields(csq_fields)
-        except:
+            csq_fields = self.get_fields(str(vep_vcf.header.info['CSQ'].record))
+            field_indexes = [csq_fields.index(field) for field in VEP_TRANSCRIPT_FIELDS]
+        except (KeyError, ValueError):
             raise ValueError('Problem parsing CSQ header in vcf.')
+        last_index = max(field_indexes)
 
-        master_list = []
-
-        for rec in vep_vcf.fetch():
-            variant_data_dict = {}
-            variant_data_dict['pos'] = rec.pos
-            variant_data_dict['chrom'] = rec.chrom
-            variant_data_dict['reference'] = rec.ref
-            variant_data_dict['format'] = rec.format.keys()
-            variant_data_dict['alt_alleles'] = rec.alts
-            variant_data_dict['quality'] = rec.qual
-            variant_data_dict['id'] = rec.id
-            filter_status = rec.filter
-            if len(filter_status.keys()) == 0:
-                variant_data_dict['filter_status'] = "."
-            else:
-                variant_data_dict['filter_status'] = ";".join(filter_status.keys())
-            for key in rec.info.keys():
-                new_key = key.replace('.', '_')
-                if key == 'CSQ':
-                    csq_data = rec.info['CSQ']
-                    all_transcript__dict = {}
-                    for transcript in csq_data:
-                        transcript_data = self.get_variant_csq(transcript)
-                        transcript_dict = self.create_csq_dict(csq_fields, transcript_data)
-                        transcript_name = transcript_dict['Feature']
-                        all_transcript__dict[transcript_name] = transcript_dict
-                    variant_data_dict['transcript_data'] = all_transcript__dict
-                else:
-                    variant_data_dict[new_key] = rec.info[key]
-            master_list.append(variant_data_dict)
-        return master_list
\ No newline at end of file
+        try:
+            for rec in vep_vcf.fetch():
+                if 'CSQ' not in rec.info:
+                    continue
+                variant_transcripts = {}
+                for transcript in rec.info['CSQ']:
+                    transcript_data = self.get_variant_csq(transcript)
+                    if len(transcript_data) <= last_index:
+                        # pad short entries, which zip() used to truncate
+                        transcript_data += [''] * (last_index + 1 - len(transcript_data))
+                    values = [transcript_data[index] for index in field_indexes]
+                    variant_transcripts[values[0]] = VepTranscript(rec.id, *values)
+                yield from variant_transcripts.values()
+        finally:
+            vep_vcf.close()
@@ -17,11 +17,17 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 import os
+import gzip
+import shlex
+import shutil
 import tempfile
 import subprocess
 import csv
+from concurrent.futures import ThreadPoolExecutor
 from ..config import load_config
 from . import parse_vep
+from .annotation_cache import AnnotationCache
+from .vep_pool import get_vep_pool
 import paramiko
 
 class CaseVariant:
@@ -56,6 +62,15 @@ class CaseSTR:
 
 
 class CaseTranscript:
+    # a batch can hold hundreds of thousands of these with T3 variants pulled,
+    # so they are slotted rather than each carrying an attribute dict
+    __slots__ = (
+        'case_id', 'variant_count', 'gene_ensembl_id', 'gene_hgnc_name', 'gene_hgnc_id', 'transcript_name',
+        'transcript_canonical', 'transcript_strand', 'proband_transcript_variant_effect', 'transcript_variant_af_max',
+        'variant_polyphen', 'variant_sift', 'transcript_variant_hgvs_c', 'transcript_variant_hgvs_p',
+        'transcript_variant_hgvs_g', 'gene_model', 'transcript_entry', 'variant_entry', 'proband_variant_entry',
+        'selected', 'canonical')
+
     def __init__(self, case_id, variant_count, gene_ensembl_id, gene_hgnc_name, gene_hgnc_id, transcript_name, transcript_canonical,
                  transcript_strand, proband_transcript_variant_effect, transcript_variant_af_max, variant_polyphen,
                  variant_sift, transcript_variant_hgvs_c, transcript_variant_hgvs_p, transcript_variant_hgvs_g):
@@ -76,239 +91,423 @@ class CaseTranscript:
         self.transcript_variant_hgvs_g = transcript_variant_hgvs_g
         self.gene_model = None
         self.transcript_entry = None
+        self.variant_entry = None
         self.proband_variant_entry = None
         self.selected = False
+        self.canonical = False
 
 
-def generate_vcf(variants):
+def generate_vcf(variants, directory=None):
     '''
     Function which creates a VCF formatted file from variant objects specified from MCA.
+    Each unique variant is written once per genome build, however many cases it appears in, and the VCFs are sorted by
+    genomic position. Variants are given IDs of the form v1, v2 etc., which are mapped back to every CaseVariant they
+    stand for by variant_ids
     :param variants: List of CaseVariant objects
-    :return: A dict of 2 vcfs. Keys are hg19_vcf and hg38_vcf which releate to the different
-    genome builds
+    :param directory: Directory to write the VCFs to, defaults to the system temporary directory
+    :return: A dict of 2 vcfs and the variant IDs. Keys are hg19_vcf and hg38_vcf which releate to the different
+    genome builds, and variant_ids which maps each VCF ID to a list of (case_id, variant_count) tuples
     '''
-    tmphg19 = tempfile.NamedTemporaryFile(mode='w+t', delete=False)
-    tmphg38 = tempfile.NamedTemporaryFile(mode='w+t', delete=False)
+    unique_variants = {'hg19_vcf': {}, 'hg38_vcf': {}}
+    variant_ids = {}
     for variant in variants:
         if 'GRCh37' in variant.genome_build:
-            row_to_write = str(variant.chromosome) + '\t' + str(variant.position) + '\t' + str(variant.case_id) + ":" + \
-                           str(variant.variant_count) + '\t' + variant.ref + '\t' + variant.alt + '\n'
-            tmphg19.writelines(row_to_write)
+            build_variants = unique_variants['hg19_vcf']
         elif 'GRCh38' in variant.genome_build:
-            row_to_write = str(variant.chromosome) + '\t' + str(variant.position) + '\t' + str(variant.case_id) + ":" + \
-                           str(variant.variant_count) + '\t' + variant.ref + '\t' + variant.alt + '\n'
-            tmphg38.writelines(row_to_write)
-    tmphg19.close()
-    tmphg38.close()
-    print(tmphg19.name, tmphg38.name)
-    variant_dict = {'hg19_vcf': tmphg19.name, 'hg38_vcf': tmphg38.name}
+            build_variants = unique_variants['hg38_vcf']
+        else:
+            continue
+        key = (str(variant.chromosome), int(variant.position), variant.ref, variant.alt)
+        variant_id = build_variants.get(key)
+        if variant_id is None:
+            variant_id = 'v' + str(len(variant_ids) + 1)
+            build_variants[key] = variant_id
+            variant_ids[variant_id] = []
+        variant_ids[variant_id].append((str(variant.case_id), str(variant.variant_count)))
+
+    variant_dict = {'variant_ids': variant_ids}
+    for vcf_key, build_variants in unique_variants.items():
+        vcf = tempfile.NamedTemporaryFile(mode='w+t', suffix='.vcf', dir=directory, delete=False)
+        if build_variants:
+            vcf.write('##fileformat=VCFv4.2\n')
+            vcf.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n')
+            for key in sorted(build_variants, key=lambda key: (chromosome_sort_key(key[0]), key[1])):
+                chromosome, position, ref, alt = key
+                vcf.write('\t'.join((
+                    chromosome, str(position), build_variants[key], ref, alt, '.', '.', '.')) + '\n')
+        vcf.close()
+        variant_dict[vcf_key] = vcf.name
+    print(variant_dict['hg19_vcf'], variant_dict['hg38_vcf'])
+    print("Wrote", len(variant_ids), "unique variants for", len(variants), "case variants")
     return variant_dict
 
 
-def run_vep(infile, config_dict):
+# VEP is slow to start, so shards are never made smaller than this
+MIN_SHARD_VARIANTS = 500
+# number of times a failed shard is rerun before the batch fails
+VEP_SHARD_RETRIES = 2
+# output keys, assembly and fasta config option for each genome build
+VEP_BUILDS = (
+    ('hg19_vcf', 'hg19_vep', 'GRCh37', 'hg19_fasta_loc'),
+    ('hg38_vcf', 'hg38_vep', 'GRCh38', 'hg38_fasta_loc'),
+)
+
+
+def chromosome_sort_key(chromosome):
+    """
+    Sort key putting chromosomes in karyotypic order: 1-22, X, Y, MT, then
+    anything else.
+    """
+    chromosome = str(chromosome)
+    if chromosome.startswith('chr'):
+        chromosome = chromosome[3:]
+    if chromosome.isdigit():
+        return (int(chromosome), '')
+    order = {'X': 23, 'Y': 24, 'M': 25, 'MT': 25}
+    return (order.get(chromosome, 26), chromosome)
+
+
+def build_vep_command(config_dict, assembly, infile, outfile, fork):
+    """
+    Build the VEP command line, as a list of arguments, to annotate infile
+    with the given assembly using options from the config file.
+    """
+    fasta_key = {'GRCh37': 'hg19_fasta_loc', 'GRCh38': 'hg38_fasta_loc'}[assembly]
+    cmd = shlex.split(config_dict['vep']) + [
+        '-i', infile, '-o', outfile, '--species', 'homo_sapiens',
+        '--force_overwrite', '--cache', '--dir_cache', config_dict['cache'],
+        '--fork', str(fork), '--vcf', '--flag_pick', '--exclude_predicted',
+        '--assembly', assembly, '--everything', '--hgvsg', '--dont_skip',
+        '--total_length', '--offline', '--fasta', config_dict[fasta_key],
+        '--cache_version', str(config_dict['cache_version'])]
+    if config_dict.get_bool("mergedVEP"):
+        cmd.append('--merged')
+    return cmd
+
+
+def split_vcf(vcf, shard_count, directory=None):
+    """
+    Split the records of a VCF sorted by generate_vcf into up to shard_count
+    contiguous shards of similar size, each at least MIN_SHARD_VARIANTS
+    records long.
+    :param vcf: Location of the VCF to split
+    :param shard_count: Maximum number of shards
+    :param directory: Directory to write the shards to
+    :return: List of locations of the shard VCFs, in genomic order
+    """
+    header = []
+    records = []
+    with open(vcf) as f:
+        for line in f:
+            if line.startswith('#'):
+                header.append(line)
+            elif line.strip():
+                records.append(line)
+
+    shard_count = max(min(shard_count, -(-len(records) // MIN_SHARD_VARIANTS)), 1)
+    shard_size = -(-len(records) // shard_count)
+    shards = []
+    for start in range(0, len(records), shard_size):
+        shard = tempfile.NamedTemporaryFile(mode='w+t', suffix='.vcf', dir=directory, delete=False)
+        shard.writelines(header)
+        shard.writelines(records[start:start + shard_size])
+        shard.close()
+        shards.append(shard.name)
+    return shards
+
+
+def run_vep_shard(shard, assembly, config_dict, fork, directory=None):
+    """
+    Run VEP on one shard, rerunning it up to VEP_SHARD_RETRIES times if VEP
+    fails.
+    :return: Location of the VEP output for the shard
+    """
+    outfile = tempfile.NamedTemporaryFile(mode='w+t', suffix='.vcf', dir=directory, delete=False)
+    outfile.close()
+    cmd = build_vep_command(config_dict, assembly, shard, outfile.name, fork)
+    attempt = 0
+    while True:
+        try:
+            subprocess.run(cmd, stderr=subprocess.STDOUT, check=True)
+            return outfile.name
+        except subprocess.CalledProcessError as e:
+            if attempt >= VEP_SHARD_RETRIES:
+                os.remove(outfile.name)
+                raise
+            attempt += 1
+            print("VEP failed on", shard, "with exit code", e.returncode,
+                  "- retrying (attempt", attempt, "of", str(VEP_SHARD_RETRIES) + ")")
+
+
+def merge_vep_outputs(shard_outputs, directory=None):
+    """
+    Concatenate the VEP outputs of the shards of one build in order, keeping
+    the header of the first shard only. The shard outputs are removed.
+    :return: Location of the merged VEP output
+    """
+    merged = tempfile.NamedTemporaryFile(mode='w+t', suffix='.vcf', dir=directory, delete=False)
+    for index, shard_output in enumerate(shard_outputs):
+        with open(shard_output) as f:
+            for line in f:
+                if index == 0 or not line.startswith('#'):
+                    merged.write(line)
+        os.remove(shard_output)
+    merged.close()
+    return merged.name
+
+
+def run_vep(infile, config_dict, executor=None, directory=None):
     '''
-    Function which runs VEP using subprocess. Takes multiple options from config.txt file
+    Function which runs VEP using subprocess. Takes multiple options from config.txt file.
+    The sorted variants of each genome build are split into genomic shards, and the shards of both builds are
+    annotated concurrently: vep_cpu_budget cores are shared between VEP processes using vep_fork cores each. The
+    outputs of each build are merged back in order
     :param infile: Dict containing VCFs for the 2 genome builds
     :param config_dict: Configuration dict
+    :param executor: Long-lived executor to run the shards on, such as that of the VepWorkerPool. If None, one is
+    created for this run
+    :param directory: Working directory for the shards and outputs
     :return: Dict which contains the locations of the 2 results files relating to the 2 genome builds
     '''
-    hg19_vcf = infile['hg19_vcf']
-    hg38_vcf = infile['hg38_vcf']
-    hg19_outfile = tempfile.NamedTemporaryFile(mode='w+t', delete=False)
-    hg38_outfile = tempfile.NamedTemporaryFile(mode='w+t', delete=False)
-    # run VEP for hg19 variants
-    annotated_variant_dict = {}
+    cpu_budget = max(int(config_dict.get('vep_cpu_budget', 4)), 1)
+    fork = max(min(int(config_dict.get('vep_fork', 4)), cpu_budget), 1)
+    concurrent_shards = max(cpu_budget // fork, 1)
+
+    shard_jobs = []
+    for vcf_key, vep_key, assembly, fasta_key in VEP_BUILDS:
+        if vcf_key in infile and os.stat(infile[vcf_key]).st_size != 0:  # if file not empty
+            for shard in split_vcf(infile[vcf_key], concurrent_shards, directory):
+                shard_jobs.append((vep_key, assembly, shard))
 
+    shard_outputs = {}
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(max_workers=concurrent_shards)
+    futures = []
+    try:
+        futures = [
+            (vep_key, executor.submit(run_vep_shard, shard, assembly, config_dict, fork, directory))
+            for vep_key, assembly, shard in shard_jobs]
+        for vep_key, future in futures:
+            shard_outputs.setdefault(vep_key, []).append(future.result())
+    except Exception:
+        # the executor may be shared, so wait for shards which are already
+        # running before removing their files
+        for vep_key, future in futures:
+            future.cancel()
+        for vep_key, future in futures:
+            if not future.cancelled() and future.exception() is None:
+                os.remove(future.result())
+        raise
+    finally:
+        if own_executor:
+            executor.shutdown()
+        for vep_key, assembly, shard in shard_jobs:
+            os.remove(shard)
 
-    if os.stat(hg19_vcf).st_size != 0: # if file not empty
-        # builds command from locations supplied in config file
-        cmd = "{vep} -i {infile} -o {outfile} --species homo_sapiens --force_overwrite --cache --dir_cache {cache} " \
-              "--fork 4 --vcf --flag_pick --exclude_predicted --assembly GRCh37 --everything " \
-              "--hgvsg --dont_skip --total_length --offline --fasta {fasta_loc} --cache_version {cache_version}".format(
-                vep=config_dict['vep'],
-                infile=hg19_vcf,
-                outfile=hg19_outfile.name,
-                cache=config_dict['cache'],
-                cache_version=config_dict['cache_version'],
-                fasta_loc=config_dict['hg19_fasta_loc'],
-        )
-        if config_dict["mergedVEP"] == 'True':
-            cmd += ' --merged'
-        subprocess.run(cmd, stderr=subprocess.STDOUT, shell=True, check=True)
-        annotated_variant_dict['hg19_vep'] = hg19_outfile.name
-    # run VEP for hg38 variants
-    if os.stat(hg38_vcf).st_size != 0:
-        cmd = "{vep} -i {infile} -o {outfile} --species homo_sapiens --force_overwrite --cache --dir_cache {cache}" \
-              " --fork 4 --vcf --flag_pick  --exclude_predicted --assembly GRCh38 --everything " \
-              "--hgvsg --dont_skip --total_length --offline --fasta {fasta_loc} --cache_version {cache_version}".format(
-                vep=config_dict['vep'],
-                infile=hg38_vcf,
-                outfile=hg38_outfile.name,
-                cache=config_dict['cache'],
-                cache_version=config_dict['cache_version'],
-                fasta_loc=config_dict['hg38_fasta_loc'],
-        )
-        if config_dict["mergedVEP"] == 'True':
-            cmd += ' --merged'
-        subprocess.run(cmd, stderr=subprocess.STDOUT, shell=True, check=True)
-        annotated_variant_dict['hg38_vep'] = hg38_outfile.name
+    annotated_variant_dict = {}
+    for vep_key, outputs in shard_outputs.items():
+        annotated_variant_dict[vep_key] = merge_vep_outputs(outputs, directory)
     return annotated_variant_dict
 
 
-def run_vep_remotely(infile, config_dict):
+def run_remote_command(ssh, cmd):
+    """
+    Run a shell command on the remote VEP host and wait for it to finish.
+    :return: The combined stdout and stderr of the command
+    :raises RuntimeError: If the command exits with a non-zero status
+    """
+    stdin, stdout, stderr = ssh.exec_command(cmd + ' 2>&1')
+    output = stdout.read().decode(errors='replace')
+    status = stdout.channel.recv_exit_status()
+    if status != 0:
+        raise RuntimeError('Remote command failed with exit status {status}: {cmd}\n{output}'.format(
+            status=status, cmd=cmd, output=output))
+    return output
+
+
+def run_remote_build(ssh, vcf, assembly, config_dict, remote_dir, directory):
+    """
+    Annotate the VCF of one genome build on the remote VEP host. The VCF is
+    uploaded gzip-compressed into the job's remote directory, and VEP's
+    output is bgzip-compressed before it is downloaded.
+    :return: Location of the downloaded, bgzipped VEP output
+    """
+    local_input = os.path.join(directory, assembly + '_input.vcf.gz')
+    with open(vcf, 'rb') as f_in, gzip.open(local_input, 'wb', compresslevel=6) as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    remote_input = remote_dir + '/' + assembly + '_input.vcf.gz'
+    remote_output = remote_dir + '/' + assembly + '_results.vcf.gz'
+    local_output = os.path.join(directory, assembly + '_results.vcf.gz')
+
+    # an SFTP session is not thread safe, so each build opens its own
+    # channel on the shared connection
+    sftp = ssh.open_sftp()
+    try:
+        sftp.put(local_input, remote_input)
+        fork = max(int(config_dict.get('vep_fork', 4)), 1)
+        cmd = build_vep_command(config_dict, assembly, remote_input, remote_output, fork)
+        cmd += ['--compress_output', 'bgzip']
+        output = run_remote_command(ssh, ' '.join(shlex.quote(arg) for arg in cmd))
+        print(assembly, 'VEP output:', output)
+        sftp.get(remote_output, local_output)
+    finally:
+        sftp.close()
+        os.remove(local_input)
+    return local_output
+
+
+def run_vep_remotely(infile, config_dict, ssh=None, directory=None):
     '''
     Function which runs VEP using paramiko on a remote machine.
+    Each run works in its own remote directory, created under remote_directory, and its own local directory, so
+    concurrent runs can not overwrite each other's files. Both genome builds are annotated at the same time, the
+    transfers are compressed, and the remote directory is removed afterwards
     :param infile: Dict containing VCFs for the 2 genome builds
     :param config_dict: Configuration dict
-    :return: Dict which contains the locations of the 2 results files relating to the 2 genome builds
+    :param ssh: Open connection to the remote machine, such as that of the VepWorkerPool. If None, a connection is
+    opened for this run
+    :param directory: Local directory to download the results to. If None, a new temporary directory is created
+    :return: Dict which contains the locations of the 2 bgzipped results files relating to the 2 genome builds
     '''
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    own_ssh = ssh is None
+    if own_ssh:
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        ssh.connect(config_dict['remote_ip'],
+                    username=config_dict['remote_username'],
+                    password=config_dict['remote_password'])
+    if directory is None:
+        directory = tempfile.mkdtemp(prefix='gel2mdt_vep_')
 
-    # builds command from locations supplied in config file
-    ssh.connect(config_dict['remote_ip'],
-                username=config_dict['remote_username'],
-                password=config_dict['remote_password'])
-    sftp = ssh.open_sftp()
-    # run VEP for hg19 variants
-    annotated_variant_dict = {}
+    builds = [
+        (vep_key, infile[vcf_key], assembly)
+        for vcf_key, vep_key, assembly, fasta_key in VEP_BUILDS
+        if vcf_key in infile and os.stat(infile[vcf_key]).st_size != 0]  # if file not empty
 
-    if not os.path.isdir('VEP'):
-        os.makedirs('VEP')
-
-    if 'hg19_vcf' in infile:
-        hg19_vcf = infile['hg19_vcf']
-        hg19_outfile = 'VEP/hg19_results.vcf'
-        if os.stat(hg19_vcf).st_size != 0:
-            sftp.put(hg19_vcf, '{remote_destination}/hg19_destination_file.txt'.format(
-                remote_destination=config_dict['remote_directory']
-            ))
-
-            cmd = "{vep} -i {remote_destination}/hg19_destination_file.txt " \
-                  " -o {remote_destination}/hg19_output.txt --species homo_sapiens --cache_version {cache_version} "  \
-                  " --force_overwrite --cache --dir_cache {cache} --fork 4 --vcf --flag_pick --assembly GRCh37 " \
-                  " --exclude_predicted --everything --hgvsg --dont_skip --total_length --offline --fasta {fasta_loc} ".format(
-                    vep=config_dict['vep'],
-                    cache=config_dict['cache'],
-                    fasta_loc=config_dict['hg19_fasta_loc'],
-                    cache_version=config_dict['cache_version'],
-                    remote_destination=config_dict['remote_directory']
-
-            )
-            if config_dict["mergedVEP"] == 'True':
-                cmd += ' --merged'
-            stdin, stdout, stderr = ssh.exec_command(cmd)
-
-            print('stdin:', stdin, 'stdout:', stdout.read(), 'stderr:', stderr.read())
-            sftp.get('{remote_destination}/hg19_output.txt'.format(
-                remote_destination=config_dict['remote_directory']), hg19_outfile
-            )
-            annotated_variant_dict['hg19_vep'] = hg19_outfile
-    # run VEP for hg38 variants
-    if 'hg38_vcf' in infile:
-        hg38_vcf = infile['hg38_vcf']
-        hg38_outfile = 'VEP/hg38_results.vcf'
-        if os.stat(hg38_vcf).st_size != 0:
-            sftp.put(hg38_vcf, '{remote_destination}/hg38_destination_file.txt'.format(
-                remote_destination=config_dict['remote_directory']
-            ))
-
-            cmd = "{vep} -i {remote_destination}/hg38_destination_file.txt " \
-                  " -o {remote_destination}/hg38_output.txt --species homo_sapiens --cache_version {cache_version} "  \
-                  " --force_overwrite --cache --dir_cache {cache} --fork 4 --vcf --flag_pick --assembly GRCh38 " \
-                  " --exclude_predicted --everything --hgvsg --dont_skip --total_length --offline --fasta {fasta_loc} ".format(
-                    vep=config_dict['vep'],
-                    cache=config_dict['cache'],
-                    cache_version=config_dict['cache_version'],
-                    fasta_loc=config_dict['hg38_fasta_loc'],
-                    remote_destination=config_dict['remote_directory']
-            )
-            if config_dict["mergedVEP"] == 'True':
-                cmd += ' --merged'
-            stdin, stdout, stderr = ssh.exec_command(cmd)
-
-            print('stdin:', stdin, 'stdout:', stdout.read(), 'stderr:', stderr.read())
-            sftp.get('{remote_destination}/hg38_output.txt'.format(remote_destination=config_dict['remote_directory']),
-                     hg38_outfile)
-            annotated_variant_dict['hg38_vep'] = hg38_outfile
-
-    sftp.close()
-    ssh.close()
+    annotated_variant_dict = {}
+    remote_dir = None
+    try:
+        if builds:
+            remote_dir = run_remote_command(ssh, 'mkdir -p {parent} && mktemp -d {template}'.format(
+                parent=shlex.quote(config_dict['remote_directory']),
+                template=shlex.quote(config_dict['remote_directory'].rstrip('/') + '/gel2mdt_vep.XXXXXXXX'),
+            )).strip().splitlines()[-1]
+            with ThreadPoolExecutor(max_workers=len(builds)) as executor:
+                futures = [
+                    (vep_key, executor.submit(
+                        run_remote_build, ssh, vcf, assembly, config_dict, remote_dir, directory))
+                    for vep_key, vcf, assembly in builds]
+                for vep_key, future in futures:
+                    annotated_variant_dict[vep_key] = future.result()
+    finally:
+        if remote_dir is not None:
+            try:
+                run_remote_command(ssh, 'rm -rf {remote_dir}'.format(remote_dir=shlex.quote(remote_dir)))
+            except Exception as e:
+                print("Could not remove remote VEP directory", remote_dir, e)
+        if own_ssh:
+            ssh.close()
     return annotated_variant_dict
 
 
-def parse_vep_annotations(infile=None):
+def iter_vep_annotations(infile=None, variant_ids=None):
     '''
-    Takes the results from VEP and converts them into CaseTranscript objects which will then be passed to CAM for
-    inserting into the database
+    Streams the results from VEP as CaseTranscript objects, reading one VEP record at a time
     :param infile: Dict from run_vep function which contains VEP vcf file locations
-    :return: List of CaseTranscript objects
+    :param variant_ids: Dict from generate_vcf mapping each VCF ID to the (case_id, variant_count) of every
+    CaseVariant it stands for. If None, VCF IDs are taken to be of the form case_id:variant_count
+    :return: Generator of CaseTranscript objects
     '''
-    transcripts_list = []
-    if infile is not None:
-        hg19_variants = []
-        hg38_variants = []
-        if 'hg19_vep' in infile:
-            if os.stat(infile['hg19_vep']).st_size != 0:
-                hg19_variants = parse_vep.ParseVep().read_file(infile['hg19_vep'])
-        if 'hg38_vep' in infile:
-            if os.stat(infile['hg38_vep']).st_size != 0:
-                hg38_variants = parse_vep.ParseVep().read_file(infile['hg38_vep'])
-        # concatenate the two lists of variant dictionaries
-        variants = hg19_variants + hg38_variants
-
-        for variant in variants:
-            case_id = variant['id'].split(":")[0]
-            variant_count = variant['id'].split(":")[1]
-            for transcript in variant['transcript_data']:
-                gene_id = variant['transcript_data'][transcript]['Gene']
-                gene_name = variant['transcript_data'][transcript]['SYMBOL']
-                hgnc_id = variant['transcript_data'][transcript]['HGNC_ID']
-                if hgnc_id.startswith('HGNC:'):
-                    hgnc_id = str(hgnc_id.split(':')[1])
-                if variant['transcript_data'][transcript]['CANONICAL'] == '':
-                    canonical = False
-                else:
-                    canonical = variant['transcript_data'][transcript]['CANONICAL']
-                transcript_name = variant['transcript_data'][transcript]['Feature']
-                transcript_strand = variant['transcript_data'][transcript]['STRAND']
-                proband_transcript_variant_effect = variant['transcript_data'][transcript]['Consequence']
-                transcript_variant_af_max = variant['transcript_data'][transcript]['MAX_AF']
-                variant_polyphen = variant['transcript_data'][transcript]['PolyPhen']
-                variant_sift = variant['transcript_data'][transcript]['SIFT']
-                transcript_variant_hgvs_c = variant['transcript_data'][transcript]['HGVSc']
-                transcript_variant_hgvs_p = variant['transcript_data'][transcript]['HGVSp'].replace('%3D', '=')
-                transcript_variant_hgvs_g = variant['transcript_data'][transcript]['HGVSg']
-                case_transcript = CaseTranscript(case_id, variant_count, gene_id, gene_name, hgnc_id, transcript_name, canonical,
-                                                 transcript_strand, proband_transcript_variant_effect,
-                                                 transcript_variant_af_max, variant_polyphen, variant_sift,
-                                                 transcript_variant_hgvs_c, transcript_variant_hgvs_p,
-                                                 transcript_variant_hgvs_g)
-                transcripts_list.append(case_transcript)
-    return transcripts_list
+    if infile is None:
+        return
+    parser = parse_vep.ParseVep()
+    for vep_key in ('hg19_vep', 'hg38_vep'):
+        if vep_key not in infile or os.stat(infile[vep_key]).st_size == 0:
+            continue
+        for transcript in parser.iter_transcripts(infile[vep_key]):
+            if variant_ids is not None:
+                case_variants = variant_ids.get(transcript.variant_id, [])
+            else:
+                case_variants = [tuple(transcript.variant_id.split(":"))]
+            hgnc_id = transcript.HGNC_ID
+            if hgnc_id.startswith('HGNC:'):
+                hgnc_id = str(hgnc_id.split(':')[1])
+            if transcript.CANONICAL == '':
+                canonical = False
+            else:
+                canonical = transcript.CANONICAL
+            transcript_variant_hgvs_p = transcript.HGVSp.replace('%3D', '=')
+            # fan the annotation out to every case with this variant
+            for case_id, variant_count in case_variants:
+                yield CaseTranscript(case_id, variant_count, transcript.Gene, transcript.SYMBOL, hgnc_id,
+                                     transcript.Feature, canonical, transcript.STRAND, transcript.Consequence,
+                                     transcript.MAX_AF, transcript.PolyPhen, transcript.SIFT, transcript.HGVSc,
+                                     transcript_variant_hgvs_p, transcript.HGVSg)
+
+
+def collect(iterable, collected):
+    '''
+    Pass the items of an iterable through unchanged, appending each to the collected list on the way
+    '''
+    for item in iterable:
+        collected.append(item)
+        yield item
 
 
 def generate_transcripts(variant_list):
     '''
     Wrapper function for running VEP for MCA. This take as input a variant_list which contains all the variants
     for the cases which MCA will update/add. If bypass_VEP function is used from the config, this will read in
-    the temp.vep.vcf file for transcripts
+    the temp.vep.vcf file for transcripts. If vep_annotation_cache is set in the config, only variants which are not
+    already in the AnnotationCache are sent to VEP. VEP is run through the long-lived VepWorkerPool of the process,
+    and each run's files are kept in a working directory which is removed afterwards
     :param variant_list: A list of Casevariant objects
     :return: A list of CaseTranscript objects for all the CaseVariants
     '''
     config_dict = load_config.LoadConfig().load()
 
-    if config_dict["bypass_VEP"] == "True":
+    if config_dict.get_bool("bypass_VEP"):
         print("Bypassing VEP")
-        transcript_list = parse_vep_annotations()
+        transcript_list = list(iter_vep_annotations())
 
-    elif config_dict["bypass_VEP"] == "False":
-        print("Running VEP")
-        variant_vcf_dict = generate_vcf(variant_list)
-        if config_dict['remoteVEP'] == 'True':
-            annotated_files_dict = run_vep_remotely(variant_vcf_dict, config_dict)
-        else:
-            annotated_files_dict = run_vep(variant_vcf_dict, config_dict)
-        transcript_list = parse_vep_annotations(annotated_files_dict)
+    else:
+        # reuse annotations of variants which VEP has seen before
+        annotation_cache = None
+        transcript_list = []
+        if config_dict.get('vep_annotation_cache'):
+            annotation_cache = AnnotationCache(
+                config_dict['vep_annotation_cache'],
+                config_dict['cache_version'],
+                config_dict.get_bool('mergedVEP'))
+            annotated_variants, variant_list = annotation_cache.split(variant_list)
+            for variant, transcripts in annotated_variants:
+                for transcript_fields in transcripts:
+                    transcript_list.append(CaseTranscript(
+                        case_id=variant.case_id,
+                        variant_count=variant.variant_count,
+                        **transcript_fields))
+            print("Found", len(annotated_variants), "variants in the VEP annotation cache")
+
+        if variant_list:
+            print("Running VEP")
+            pool = get_vep_pool(config_dict)
+            with pool.job() as directory:
+                variant_vcf_dict = generate_vcf(variant_list, directory)
+                if pool.remote:
+                    annotated_files_dict = pool.run_remote(
+                        lambda ssh: run_vep_remotely(variant_vcf_dict, config_dict, ssh, directory))
+                else:
+                    annotated_files_dict = run_vep(variant_vcf_dict, config_dict, pool.executor, directory)
+                # stream the annotations into the cache and the transcript list
+                # together, rather than collecting them into a list first
+                annotations = iter_vep_annotations(annotated_files_dict, variant_vcf_dict['variant_ids'])
+                if annotation_cache:
+                    annotation_cache.store(variant_list, collect(annotations, transcript_list))
+                else:
+                    transcript_list.extend(annotations)
+
+        if annotation_cache:
+            annotation_cache.close()
 
     return transcript_list
\ No newline at end of file
@@ -0,0 +1,223 @@
+"""Copyright (c) 2018 Great Ormond Street Hospital for Children NHS Foundation
+Trust & Birmingham Women's and Children's NHS Foundation Trust
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import os
+import atexit
+import shlex
+import shutil
+import socket
+import tempfile
+import threading
+import subprocess
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import paramiko
+
+
+# config options which, if changed, mean the pool has to be rebuilt
+POOL_CONFIG_KEYS = (
+    'remoteVEP', 'remote_ip', 'remote_username', 'remote_password', 'vep', 'cache',
+    'vep_cpu_budget', 'vep_fork',
+)
+# errors which mean the SSH connection to the remote VEP host has gone
+CONNECTION_ERRORS = (paramiko.SSHException, socket.error, EOFError)
+
+
+class VepWorkerPool(object):
+    """
+    Long-lived resources for running VEP, shared by every annotation job in
+    a process.
+
+    VEP has no server mode which could be fed one batch after another, so
+    each shard is still annotated by its own VEP process. What the pool
+    keeps warm between jobs is everything around those processes: the
+    worker threads which share the CPU budget between concurrent jobs, the
+    SSH connection to the remote VEP host, and the result of the health
+    check, so that a small update goes straight to VEP. Each job is given
+    its own working directory, which is removed when the job finishes.
+
+    Attributes:
+        config_dict (dict): the configuration the pool was built from.
+        remote (bool): whether VEP is run on the remote host over SSH.
+        fork (int): the number of cores given to each VEP process.
+        concurrent_shards (int): the number of VEP processes run at once.
+        executor (ThreadPoolExecutor): worker threads which run the local
+            VEP processes.
+        ssh (paramiko.SSHClient): the connection to the remote VEP host,
+            opened on first use.
+        healthy (bool): True if the last health check passed and no job
+            has failed since.
+        pid (int): the process the pool was built in. Threads and sockets
+            do not survive a fork, so a forked process builds its own pool.
+    """
+    def __init__(self, config_dict):
+        self.config_dict = config_dict
+        self.remote = config_dict.get_bool('remoteVEP')
+        cpu_budget = max(config_dict.get_int('vep_cpu_budget', 4), 1)
+        self.fork = max(min(config_dict.get_int('vep_fork', 4), cpu_budget), 1)
+        self.concurrent_shards = max(cpu_budget // self.fork, 1)
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrent_shards)
+        self.ssh = None
+        self.ssh_lock = threading.Lock()
+        self.healthy = False
+        self.pid = os.getpid()
+
+    def get_ssh(self):
+        """
+        Return the connection to the remote VEP host, reconnecting if it has
+        dropped since it was last used.
+        """
+        with self.ssh_lock:
+            if self.ssh is not None and not self.check_ssh():
+                print("Connection to the remote VEP host was lost - reconnecting")
+                self.close_ssh()
+            if self.ssh is None:
+                ssh = paramiko.SSHClient()
+                ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+                ssh.connect(self.config_dict['remote_ip'],
+                            username=self.config_dict['remote_username'],
+                            password=self.config_dict['remote_password'])
+                transport = ssh.get_transport()
+                if transport is not None:
+                    transport.set_keepalive(30)
+                self.ssh = ssh
+            return self.ssh
+
+    def check_ssh(self):
+        """
+        Check that the connection to the remote host is open and can still
+        run commands.
+        """
+        transport = self.ssh.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            stdin, stdout, stderr = self.ssh.exec_command('true', timeout=30)
+            return stdout.channel.recv_exit_status() == 0
+        except CONNECTION_ERRORS:
+            return False
+
+    def close_ssh(self):
+        if self.ssh is not None:
+            try:
+                self.ssh.close()
+            except CONNECTION_ERRORS:
+                pass
+            self.ssh = None
+
+    def check_health(self):
+        """
+        Check that VEP can be started, locally or on the remote host, and
+        that its cache can be found. Raises a RuntimeError describing the
+        problem if not.
+        """
+        vep = self.config_dict['vep']
+        cache = self.config_dict['cache']
+        if self.remote:
+            ssh = self.get_ssh()
+            cmd = '{vep} --help && test -d {cache}'.format(vep=vep, cache=shlex.quote(cache))
+            stdin, stdout, stderr = ssh.exec_command(cmd, timeout=120)
+            output = stdout.read().decode(errors='replace')
+            if stdout.channel.recv_exit_status() != 0 or 'VARIANT EFFECT PREDICTOR' not in output.upper():
+                raise RuntimeError('VEP could not be started on {host}: {error}'.format(
+                    host=self.config_dict['remote_ip'], error=stderr.read().decode(errors='replace')))
+        else:
+            try:
+                result = subprocess.run(
+                    shlex.split(vep) + ['--help'], stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT, timeout=120)
+            except (OSError, subprocess.TimeoutExpired) as e:
+                raise RuntimeError('VEP could not be started: {error}'.format(error=e))
+            if 'VARIANT EFFECT PREDICTOR' not in result.stdout.decode(errors='replace').upper():
+                raise RuntimeError('VEP could not be started: {output}'.format(
+                    output=result.stdout.decode(errors='replace')))
+            if not os.path.isdir(cache):
+                raise RuntimeError('VEP cache {cache} does not exist'.format(cache=cache))
+        self.healthy = True
+
+    @contextmanager
+    def job(self):
+        """
+        Context manager for one annotation job. Runs the health check if it
+        has not passed since the last failure, and yields a working
+        directory for the job's files which is removed when the job ends.
+        """
+        if not self.healthy:
+            self.check_health()
+        directory = tempfile.mkdtemp(prefix='gel2mdt_vep_')
+        try:
+            yield directory
+        except Exception:
+            # check VEP and the connection again before the next job
+            self.healthy = False
+            raise
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def run_remote(self, function):
+        """
+        Call function with the connection to the remote VEP host. If the
+        connection drops part way through, reconnect and call it once more.
+        """
+        try:
+            return function(self.get_ssh())
+        except CONNECTION_ERRORS as e:
+            print("Lost connection to the remote VEP host:", e, "- reconnecting")
+            with self.ssh_lock:
+                self.close_ssh()
+            return function(self.get_ssh())
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        with self.ssh_lock:
+            self.close_ssh()
+
+
+_pool = None
+_pool_key = None
+_pool_lock = threading.Lock()
+
+
+def get_vep_pool(config_dict):
+    """
+    Return the VepWorkerPool of this process, building it on first use or
+    when the VEP settings in the config have changed.
+    """
+    global _pool, _pool_key
+    key = tuple(config_dict.get(option) for option in POOL_CONFIG_KEYS)
+    with _pool_lock:
+        if _pool is not None and (_pool_key != key or _pool.pid != os.getpid()):
+            if _pool.pid == os.getpid():
+                _pool.close()
+            _pool = None
+        if _pool is None:
+            _pool = VepWorkerPool(config_dict)
+            _pool_key = key
+        return _pool
+
+
+@atexit.register
+def close_vep_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None and _pool.pid == os.getpid():
+            _pool.close()
+        _pool = None
@@ -1315,7 +1315,7 @@ def recent_mdts(request, sample_type):
         first_check_count = 0
         second_check_count = 0
         for report in report_list:
-            if config_dict['cip_as_id'] == 'True':
+            if config_dict.get_bool('cip_as_id'):
                 probands_in_mdt[mdt.id].append((report.interpretation_report.id,
                                                 report.interpretation_report.ir_family.ir_family_id))
             else:
@@ -1583,10 +1583,18 @@ def report(request, report_id, outcome):
 
     report = GELInterpretationReport.objects.get(id=report_id)
     genome_build = report.assembly
-    panels = InterpretationReportFamilyPanel.objects.filter(ir_family=report.ir_family)
+    panels = InterpretationReportFamilyPanel.objects.filter(
+        ir_family=report.ir_family
+    ).select_related('panel__panel').annotate(
+        green_gene_count=Count('panel__panelversiongene', filter=Q(
+            panel__panelversiongene__level_of_confidence="HighEvidence")))
 
     panel_genes = {}
     for panel in panels:
+        if panel.panel.mirrored_at:
+            # genes have been mirrored into PanelVersionGene by sync_panelapp
+            panel_genes[panel] = panel.green_gene_count
+            continue
         panelapp_file = f'{config_dict["panelapp_storage"]}/{panel.panel.panel.panelapp_id}_{panel.panel.version_number}.json'
         if os.path.isfile(panelapp_file):
             panelapp_json = json.load(open(panelapp_file))
@@ -1643,22 +1651,16 @@ def audit(request, sample_type):
     :return:
     '''
     config_dict = load_config.LoadConfig().load()
-    # Getting all GELIRs
-    qs = GELInterpretationReport.objects.filter(
-        sample_type=sample_type).prefetch_related(*['ir_family', 'ir_family__participant_family__proband'])
-
-    # Filtering out duplicates
-    qs_df = pd.DataFrame(list(qs.values())).sort_values(by=['ir_family_id', 'archived_version'])
-    multi_archived = qs_df.drop_duplicates(subset=['ir_family_id'], keep='last')
-    ids_of_latest = multi_archived["id"].tolist()
-    queryset = GELInterpretationReport.objects.filter(id__in=ids_of_latest).filter(~Q(status='blocked'))
+    # Getting the latest version of each GELIR
+    queryset = GELInterpretationReport.objects.latest_cases_by_sample_type(
+        sample_type).filter(~Q(status='blocked'))
 
     # Getting case status options
     status_choices = dict(GELInterpretationReport._meta.get_field('case_status').choices)
     status_names = list(status_choices.values())
 
     # Total case breakdown
-    if config_dict['plot_pilot_and_main_status_breakdown'] == 'False':
+    if not config_dict.get_bool('plot_pilot_and_main_status_breakdown'):
         case_status_breakdown = queryset.values(
             'case_status').annotate(Count('case_status'))
         case_status_breakdown = {item['case_status']: item['case_status__count'] for item in case_status_breakdown}